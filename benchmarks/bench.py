@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# Measures the overhead of vaspmd itself, using fake_vasp.py in place of vasp.
+#
+#     python3 benchmarks/bench.py [--quick] [-o results.json]
+#
+# Reports (as JSON):
+#
+#   md:          End-to-end md-run over one cycle, for each combination of block size, NVE steps
+#                and WAVECAR size.  'overhead' is the wall time not spent inside (fake) vasp, and
+#                'overhead-per-run' divides it by the number of vasp runs (stages and blocks).
+#   search:      End-to-end vasp-search (grid strategy) for a few depths, likewise.
+#   copy:        Throughput of handoff_file in each handoff mode, for each WAVECAR size.
+#   state-save:  Mean latency of a persistent_loop iteration that does no work, for each state
+#                backend, with a state that grows by one leaf per iteration (like md.state).
+#
+# Compare the output between releases to catch regressions in these hot paths.
+# Fake vasp sleeps for no time by default, so everything measured here is overhead;
+#  the --step-time option makes it behave a little more like the real thing.
+
+import os
+import sys
+import json
+from time import time
+from tempfile import mkdtemp
+from shutil import rmtree
+from subprocess import check_call
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from vaspmd import md # noqa
+
+FAKE_VASP = os.path.join(HERE, 'fake_vasp.py')
+
+MiB = 1 << 20
+
+POSCAR = '''bench
+1.0
+  10.0 0.0 0.0
+  0.0 10.0 0.0
+  0.0 0.0 10.0
+Si
+{natoms}
+Direct
+{coords}
+'''
+
+def main():
+	from argparse import ArgumentParser
+	parser = ArgumentParser(description='benchmark the orchestration overhead of vaspmd')
+	parser.add_argument('-o', '--output', help='write results here (default: stdout)')
+	parser.add_argument('--quick', action='store_true', help='a smaller set of cases')
+	parser.add_argument('--step-time', type=float, default=0.0, help='seconds per fake vasp step')
+	parser.add_argument('--natoms', type=int, default=64)
+	parser.add_argument('--tmpdir', help='where to run (this should be on the filesystem you care about)')
+	args = parser.parse_args()
+
+	if args.quick:
+		blocksizes, nve_steps, wavecar_sizes = [10], [40], [1 * MiB]
+		state_iters = 200
+	else:
+		blocksizes, nve_steps, wavecar_sizes = [5, 20, 100], [100, 400], [1 * MiB, 64 * MiB]
+		state_iters = 2000
+
+	results = {
+		'python': sys.version.split()[0],
+		'step-time': args.step_time,
+		'natoms': args.natoms,
+		'md': [],
+		'search': [],
+		'copy': [],
+		'state-save': [],
+	}
+
+	for wavecar in wavecar_sizes:
+		for steps in nve_steps:
+			for blocksize in blocksizes:
+				results['md'].append(bench_md(blocksize=blocksize, nve_steps=steps, wavecar_bytes=wavecar,
+					step_time=args.step_time, natoms=args.natoms, tmpdir=args.tmpdir))
+				log(results['md'][-1])
+
+	for npoints in ([4] if args.quick else [4, 16]):
+		results['search'].append(bench_search(npoints=npoints, depths=3, nsw=10,
+			step_time=args.step_time, natoms=args.natoms, tmpdir=args.tmpdir))
+		log(results['search'][-1])
+
+	for wavecar in wavecar_sizes:
+		for mode in md.HANDOFF_MODES:
+			results['copy'].append(bench_copy(mode=mode, nbytes=wavecar, tmpdir=args.tmpdir))
+			log(results['copy'][-1])
+
+	for backend in md.STATE_BACKENDS:
+		results['state-save'].append(bench_state_save(backend=backend, iterations=state_iters, tmpdir=args.tmpdir))
+		log(results['state-save'][-1])
+
+	text = json.dumps(results, indent=1)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(text + '\n')
+	else:
+		print(text)
+
+def log(result):
+	print(json.dumps(result), file=sys.stderr)
+
+#-----------------------------------------------------
+
+def write_md_inputs(d, *, natoms):
+	coords = '\n'.join('  {:.6f} {:.6f} {:.6f}'.format(*[(i * k * 0.137) % 1 for k in (1, 2, 3)]) for i in range(natoms))
+	files = {
+		'POSCAR': POSCAR.format(natoms=natoms, coords=coords),
+		'KPOINTS': 'Gamma\n0\nGamma\n1 1 1\n',
+		'POTCAR': 'fake\n',
+		'INCAR.part': 'IBRION = 0\nPOTIM = 1.0\n',
+		'INCAR.linear': 'NSW = {}\nTEBEG = {}\nTEEND = 300\nSMASS = -1\n'.format(md.STEPS_REPL, md.TEBEG_REPL),
+		'INCAR.nose': 'NSW = {}\nTEBEG = 300\nSMASS = 0\n'.format(md.STEPS_REPL),
+		'INCAR.nve': 'NSW = {}\nTEBEG = 300\nSMASS = -3\n'.format(md.STEPS_REPL),
+	}
+	for fname, text in files.items():
+		with open(os.path.join(d, fname), 'w') as f:
+			f.write(text)
+
+def fake_vasp_env(*, log_path, wavecar_bytes, step_time):
+	return dict(os.environ,
+		PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''),
+		VASPMD_VASP_CMD='{} {}'.format(sys.executable, FAKE_VASP),
+		FAKE_VASP_LOG=log_path,
+		FAKE_VASP_WAVECAR_BYTES=str(wavecar_bytes),
+		FAKE_VASP_STEP_TIME=str(step_time),
+	)
+
+# (number of vasp runs, seconds spent in them)
+def read_fake_vasp_log(path):
+	with open(path) as f:
+		runs = [json.loads(line) for line in f]
+	return len(runs), sum(r['end'] - r['start'] for r in runs)
+
+def bench_md(*, blocksize, nve_steps, wavecar_bytes, step_time, natoms, tmpdir):
+	d = mkdtemp(prefix='vaspmd-bench-', dir=tmpdir)
+	try:
+		write_md_inputs(d, natoms=natoms)
+		md.write_conf(d, temperature=300, from_zero=True, blocksize=blocksize,
+			linear_steps=blocksize, nose_steps=blocksize, nve_steps=nve_steps, cycles=1)
+		with open(os.path.join(d, 'md.conf')) as f:
+			conf = json.load(f)
+		conf[md.CONF_STATUS_INTERVAL] = 0
+		with open(os.path.join(d, 'md.conf'), 'w') as f:
+			json.dump(conf, f)
+
+		log_path = os.path.join(d, 'fake-vasp.log')
+		start = time()
+		check_call([sys.executable, '-c', 'from vaspmd.md import main; main()'], cwd=d,
+			env=fake_vasp_env(log_path=log_path, wavecar_bytes=wavecar_bytes, step_time=step_time),
+			stdout=open(os.devnull, 'w'))
+		wall = time() - start
+
+		nruns, vasp_time = read_fake_vasp_log(log_path)
+		return {
+			'blocksize': blocksize,
+			'nve-steps': nve_steps,
+			'wavecar-bytes': wavecar_bytes,
+			'runs': nruns,
+			'wall': wall,
+			'vasp': vasp_time,
+			'overhead': wall - vasp_time,
+			'overhead-per-run': (wall - vasp_time) / nruns,
+		}
+	finally:
+		rmtree(d)
+
+def bench_search(*, npoints, depths, nsw, step_time, natoms, tmpdir):
+	d = mkdtemp(prefix='vaspmd-bench-', dir=tmpdir)
+	try:
+		os.mkdir(os.path.join(d, 'inputs'))
+		write_md_inputs(os.path.join(d, 'inputs'), natoms=natoms)
+		with open(os.path.join(d, 'inputs', 'INCAR'), 'w') as f:
+			f.write('NSW = {}\n'.format(nsw))
+
+		scripts = {
+			# cmd-init TRIALNAME VALUE
+			'init.sh': '#!/bin/sh\nmkdir -p "$1" && cp inputs/* "$1/" && echo "$2" > "$1/value"\n',
+			# cmd-next TRIALNAME...  (narrow by half around the middle)
+			'next.sh': '#!/bin/sh\ncat "$1/value" "$(eval echo \\${$#})/value" | '
+				'awk \'NR==1{a=$1} NR==2{b=$1} END{m=(a+b)/2; w=(b-a)/4; print m-w, m+w}\'\n',
+		}
+		for fname, text in scripts.items():
+			path = os.path.join(d, fname)
+			with open(path, 'w') as f:
+				f.write(text)
+			os.chmod(path, 0o755)
+
+		with open(os.path.join(d, 'search.toml'), 'w') as f:
+			f.write('\n'.join([
+				'start-min = 0.0',
+				'start-max = 1.0',
+				'npoints = {}'.format(npoints),
+				'cmd-init = "../init.sh"',
+				'cmd-run = "{} {}"'.format(sys.executable, FAKE_VASP),
+				'cmd-next = "../next.sh"',
+				'files = ["inputs"]',
+				'max-depth = {}'.format(depths),
+			]) + '\n')
+
+		log_path = os.path.join(d, 'fake-vasp.log')
+		start = time()
+		check_call([sys.executable, '-c', 'from vaspmd.search import main; main()'], cwd=d,
+			env=fake_vasp_env(log_path=log_path, wavecar_bytes=MiB, step_time=step_time),
+			stdout=open(os.devnull, 'w'))
+		wall = time() - start
+
+		nruns, vasp_time = read_fake_vasp_log(log_path)
+		return {
+			'npoints': npoints,
+			'depths': depths,
+			'runs': nruns,
+			'wall': wall,
+			'vasp': vasp_time,
+			'overhead': wall - vasp_time,
+			'overhead-per-run': (wall - vasp_time) / nruns,
+		}
+	finally:
+		rmtree(d)
+
+#-----------------------------------------------------
+
+def bench_copy(*, mode, nbytes, tmpdir, repeat=3):
+	d = mkdtemp(prefix='vaspmd-bench-', dir=tmpdir)
+	try:
+		src = os.path.join(d, 'src')
+		times = []
+		for i in range(repeat):
+			with open(src, 'wb') as f:
+				f.write(os.urandom(min(nbytes, MiB)) * (nbytes // MiB or 1))
+			os.sync()
+			dest = os.path.join(d, 'dest{}'.format(i))
+			start = time()
+			md.handoff_file(src, dest, mode=mode, writable=True)
+			times.append(time() - start)
+			os.remove(dest)
+			md.remove_if_exists(src)
+
+		best = min(times)
+		return {
+			'mode': mode,
+			'bytes': nbytes,
+			'seconds': best,
+			'bytes-per-second': nbytes / best if best else None,
+		}
+	finally:
+		rmtree(d)
+
+def bench_state_save(*, backend, iterations, tmpdir):
+	d = mkdtemp(prefix='vaspmd-bench-', dir=tmpdir)
+	try:
+		def do_iter(i=0, leaves=()):
+			if i == iterations:
+				return md.EndLoop(None)
+			return i + 1, leaves + ('{}-nve/{:03d}'.format(i // 100 + 1, i % 100 + 1),)
+
+		start = time()
+		md.persistent_loop(do_iter, os.path.join(d, 'bench.state'), backend=backend)
+		wall = time() - start
+		return {
+			'backend': backend,
+			'iterations': iterations,
+			'seconds-per-save': wall / iterations,
+		}
+	finally:
+		rmtree(d)
+
+if __name__ == '__main__':
+	main()
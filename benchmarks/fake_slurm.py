@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# A stand-in for slurm's sbatch, squeue and scancel, for exercising md-run --chain (and the
+#  walltime queries of adaptive block sizing) without a cluster.
+#
+# Put links to this script named sbatch, squeue and scancel first on PATH:
+#
+#     mkdir fakebin
+#     for cmd in sbatch squeue scancel; do ln -s $PWD/benchmarks/fake_slurm.py fakebin/$cmd; done
+#     export PATH=$PWD/fakebin:$PATH FAKE_SLURM_DIR=$PWD/queue
+#
+# sbatch only queues a job.  `fake_slurm.py run` then plays the scheduler:  it starts each job
+#  whose dependencies allow it, one at a time, in the directory it was submitted from (with
+#  SLURM_JOB_ID set, and output to slurm-ID.out there), until no job can start.
+#
+# Supported:
+#
+#     sbatch [--parsable] [--kill-on-invalid-dep=yes|no] [--dependency=afterok:ID[:ID...]]
+#            [--time=MINUTES] [-J NAME] SCRIPT [ARGS...]
+#     squeue -h -j ID -o FORMAT      (FORMAT is one of %i, %T (state), %L (time left))
+#     scancel ID...
+#     fake_slurm.py run [--max-jobs N]
+#
+# Like slurm:
+#
+#   * A job whose 'afterok' dependency did not complete successfully is cancelled if it was
+#     submitted with --kill-on-invalid-dep=yes, and otherwise stays PENDING forever.
+#   * A job still running at its time limit gets SIGTERM, then SIGKILL KILL_WAIT seconds later,
+#     and ends up TIMEOUT.
+#   * `squeue -j ID` fails with "Invalid job id" once a job has finished.  (finished jobs are
+#     kept in the queue file, for inspection by tests)
+#
+# The environment:
+#
+#    FAKE_SLURM_DIR          Directory holding the queue (queue.json).  (required)
+#    FAKE_SLURM_TIME_LIMIT   Time limit in seconds of jobs submitted without --time.
+#                            (default: unlimited)
+
+import os
+import sys
+import json
+import fcntl
+import signal
+import subprocess
+from time import time
+
+FIRST_JOB_ID = 1001
+KILL_WAIT = 5
+
+ACTIVE_STATES = ['PENDING', 'RUNNING']
+# Exit codes for sbatch/squeue/scancel errors, as slurm uses
+ERROR_EXIT = 1
+
+def main():
+	cmd = os.path.basename(sys.argv[0])
+	args = sys.argv[1:]
+	if cmd not in COMMANDS and args:
+		cmd, args = args[0], args[1:]
+	if cmd not in COMMANDS:
+		die('usage: fake_slurm.py {} ...'.format('|'.join(COMMANDS)))
+	COMMANDS[cmd](args)
+
+def die(msg):
+	print(msg, file=sys.stderr)
+	sys.exit(ERROR_EXIT)
+
+#-----------------------------------------------------
+# The queue.  Every change is a read-modify-write under an exclusive lock, since jobs
+#  call sbatch and scancel while the scheduler is running.
+
+def queue_dir():
+	d = os.environ.get('FAKE_SLURM_DIR')
+	if not d:
+		die('fake_slurm: FAKE_SLURM_DIR is not set')
+	os.makedirs(d, exist_ok=True)
+	return d
+
+class locked_queue:
+	def __enter__(self):
+		d = queue_dir()
+		self.path = os.path.join(d, 'queue.json')
+		self.lock = open(os.path.join(d, 'queue.lock'), 'w')
+		fcntl.flock(self.lock, fcntl.LOCK_EX)
+		if os.path.exists(self.path):
+			with open(self.path) as f:
+				self.queue = json.load(f)
+		else:
+			self.queue = {'next-id': FIRST_JOB_ID, 'jobs': {}}
+		return self.queue
+
+	def __exit__(self, exc_type, exc, tb):
+		try:
+			if exc_type is None:
+				with open(self.path + '.tmp', 'w') as f:
+					json.dump(self.queue, f, indent=1)
+				os.rename(self.path + '.tmp', self.path)
+		finally:
+			self.lock.close()
+		return False
+
+def read_queue():
+	with locked_queue() as queue:
+		return queue
+
+#-----------------------------------------------------
+
+def sbatch(args):
+	parsable = False
+	kill_on_invalid_dep = False
+	dependency = []
+	time_limit = os.environ.get('FAKE_SLURM_TIME_LIMIT')
+	time_limit = float(time_limit) if time_limit else None
+	name = None
+
+	while args and args[0].startswith('-'):
+		arg = args.pop(0)
+		key, _, value = arg.partition('=')
+		if key in ('-J', '--job-name', '-t', '--time') and not value:
+			value = args.pop(0)
+
+		if key == '--parsable':
+			parsable = True
+		elif key == '--kill-on-invalid-dep':
+			kill_on_invalid_dep = (value == 'yes')
+		elif key in ('-d', '--dependency'):
+			kind, _, ids = value.partition(':')
+			if kind != 'afterok':
+				die('fake_slurm: unsupported dependency: {}'.format(value))
+			dependency += ids.split(':')
+		elif key in ('-t', '--time'):
+			time_limit = float(value) * 60
+		elif key in ('-J', '--job-name'):
+			name = value
+		else:
+			die('fake_slurm: unsupported option: {}'.format(arg))
+
+	if not args:
+		die('sbatch: error: no script given')
+	script, args = args[0], args[1:]
+
+	with locked_queue() as queue:
+		for dep in dependency:
+			if dep not in queue['jobs']:
+				die('sbatch: error: Batch job submission failed: Job dependency problem')
+		jobid = str(queue['next-id'])
+		queue['next-id'] += 1
+		queue['jobs'][jobid] = {
+			'id': jobid,
+			'name': name or os.path.basename(script),
+			'script': os.path.abspath(script),
+			'args': args,
+			'cwd': os.getcwd(),
+			'dependency': dependency,
+			'kill-on-invalid-dep': kill_on_invalid_dep,
+			'time-limit': time_limit,
+			'state': 'PENDING',
+			'submitted-by': os.environ.get('SLURM_JOB_ID'),
+			'start': None,
+			'end': None,
+			'exit': None,
+		}
+
+	print(jobid if parsable else 'Submitted batch job {}'.format(jobid))
+
+def squeue(args):
+	jobid = fmt = None
+	while args:
+		arg = args.pop(0)
+		if arg == '-h':
+			continue
+		elif arg == '-j':
+			jobid = args.pop(0)
+		elif arg == '-o':
+			fmt = args.pop(0)
+		else:
+			die('fake_slurm: unsupported option: {}'.format(arg))
+	if jobid is None or fmt is None:
+		die('fake_slurm: squeue needs -j and -o')
+
+	job = read_queue()['jobs'].get(jobid)
+	if job is None or job['state'] not in ACTIVE_STATES:
+		die('slurm_load_jobs error: Invalid job id specified')
+
+	if fmt == '%i':
+		print(jobid)
+	elif fmt == '%T':
+		print(job['state'])
+	elif fmt == '%L':
+		print(format_time_left(job))
+	else:
+		die('fake_slurm: unsupported format: {}'.format(fmt))
+
+def scancel(args):
+	with locked_queue() as queue:
+		for jobid in args:
+			job = queue['jobs'].get(jobid)
+			if job is None:
+				print('scancel: error: Invalid job id {}'.format(jobid), file=sys.stderr)
+				continue
+			if job['state'] == 'PENDING':
+				job['state'] = 'CANCELLED'
+				job['end'] = time()
+			elif job['state'] == 'RUNNING':
+				job['cancel'] = True # (the scheduler kills it)
+
+def format_time_left(job):
+	if job['time-limit'] is None:
+		return 'UNLIMITED'
+	left = job['time-limit']
+	if job['start'] is not None:
+		left -= time() - job['start']
+	left = max(0, int(left))
+	days, left = divmod(left, 86400)
+	hours, left = divmod(left, 3600)
+	minutes, seconds = divmod(left, 60)
+	if days:
+		return '{}-{:02d}:{:02d}:{:02d}'.format(days, hours, minutes, seconds)
+	if hours:
+		return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+	return '{}:{:02d}'.format(minutes, seconds)
+
+#-----------------------------------------------------
+# The scheduler
+
+def run(args):
+	max_jobs = None
+	if args[:1] == ['--max-jobs']:
+		max_jobs = int(args[1])
+
+	nrun = 0
+	while max_jobs is None or nrun < max_jobs:
+		job = next_job()
+		if job is None:
+			break
+		run_job(job)
+		nrun += 1
+	print('fake_slurm: ran {} jobs'.format(nrun))
+
+# Mark the next job that can start as RUNNING, and return it (or None).
+# Cancels jobs whose dependencies can never be satisfied, if they asked for that.
+def next_job():
+	with locked_queue() as queue:
+		jobs = queue['jobs']
+		for jobid in sorted(jobs, key=int):
+			job = jobs[jobid]
+			if job['state'] != 'PENDING':
+				continue
+			states = [jobs[dep]['state'] for dep in job['dependency']]
+			if any(s not in ACTIVE_STATES + ['COMPLETED'] for s in states):
+				if job['kill-on-invalid-dep']:
+					job['state'] = 'CANCELLED'
+					job['end'] = time()
+				continue
+			if all(s == 'COMPLETED' for s in states):
+				job['state'] = 'RUNNING'
+				job['start'] = time()
+				return dict(job)
+	return None
+
+def run_job(job):
+	env = dict(os.environ, SLURM_JOB_ID=job['id'], SLURM_JOB_NAME=job['name'])
+	cmd = [job['script']] + job['args']
+	if not os.access(job['script'], os.X_OK):
+		cmd = ['/bin/sh'] + cmd
+
+	with open(os.path.join(job['cwd'], 'slurm-{}.out'.format(job['id'])), 'w') as out:
+		p = subprocess.Popen(cmd, cwd=job['cwd'], env=env, stdout=out, stderr=subprocess.STDOUT)
+		state = wait_job(p, job)
+
+	with locked_queue() as queue:
+		record = queue['jobs'][job['id']]
+		record.update(state=state, end=time(), exit=p.returncode)
+
+# Wait for a job, enforcing its time limit and scancel.  Returns its final state.
+def wait_job(p, job):
+	deadline = None if job['time-limit'] is None else job['start'] + job['time-limit']
+	while True:
+		try:
+			p.wait(timeout=0.1)
+			return 'COMPLETED' if p.returncode == 0 else 'FAILED'
+		except subprocess.TimeoutExpired:
+			pass
+
+		if deadline is not None and time() >= deadline:
+			terminate(p)
+			return 'TIMEOUT'
+		if read_queue()['jobs'][job['id']].get('cancel'):
+			terminate(p)
+			return 'CANCELLED'
+
+def terminate(p):
+	p.send_signal(signal.SIGTERM)
+	try:
+		p.wait(timeout=KILL_WAIT)
+	except subprocess.TimeoutExpired:
+		p.kill()
+		p.wait()
+
+COMMANDS = {
+	'sbatch': sbatch,
+	'squeue': squeue,
+	'scancel': scancel,
+	'run': run,
+}
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# A stand-in for vasp, for measuring the overhead of vaspmd itself.
+#
+# Reads INCAR (NSW, TEBEG, TEEND, NBLOCK) and POSCAR from the current directory, and writes
+#  OSZICAR, XDATCAR, CONTCAR and WAVECAR in the same formats as an MD run of vasp.
+# Like vasp, it stops early (after the current step) if a STOPCAR with LSTOP appears.
+#
+# Behavior is controlled through the environment:
+#
+#    FAKE_VASP_STARTUP         Seconds to sleep before the first step.  (default: 0)
+#    FAKE_VASP_STEP_TIME       Seconds to sleep per ionic step.  (default: 0)
+#    FAKE_VASP_WAVECAR_BYTES   Size of the WAVECAR written at the end.  (default: 1 MiB)
+#    FAKE_VASP_LOG             If set, a JSON line describing the run is appended to this file:
+#                              {"dir": ..., "start": ..., "end": ..., "steps": ...}
+#                              so that time spent "in vasp" can be separated from overhead.
+
+import os
+import re
+import json
+import random
+from time import time, sleep
+
+def main():
+	start = time()
+
+	incar = read_incar('INCAR')
+	nsw = int(incar.get('NSW', 0))
+	tebeg = float(incar.get('TEBEG', 300))
+	teend = float(incar.get('TEEND', tebeg))
+	nblock = int(incar.get('NBLOCK', 1))
+
+	startup = float(os.environ.get('FAKE_VASP_STARTUP', 0))
+	step_time = float(os.environ.get('FAKE_VASP_STEP_TIME', 0))
+	wavecar_bytes = int(os.environ.get('FAKE_VASP_WAVECAR_BYTES', 1 << 20))
+
+	with open('POSCAR') as f:
+		poscar = f.read().splitlines()
+	header, coords = split_poscar(poscar)
+	natoms = len(coords)
+
+	sleep(startup)
+	rng = random.Random(nsw)
+
+	nsteps = 0
+	with open('OSZICAR', 'w') as osz, open('XDATCAR', 'w') as xdat:
+		xdat.write('\n'.join(header[:-1]) + '\n') # (everything up to the coordinate mode line)
+		for step in range(1, nsw + 1):
+			if stop_requested():
+				break
+			sleep(step_time)
+
+			temp = tebeg + (teend - tebeg) * step / max(nsw, 1) + rng.gauss(0, 5)
+			energy = -100.0 + rng.gauss(0, 0.05)
+			for scf in range(1, 4):
+				osz.write('DAV: {:3d}   {: .12E}   {: .5E}   {: .5E}  {:5d}   {:.3E}\n'.format(
+					scf, energy, 10**-scf, -10**-scf, 64, 10**-scf))
+			osz.write('{:6d} T= {:6.0f}. E= {:.8E} F= {:.8E} E0= {:.8E}  EK= {:.5E} SP= {:.2E} SK= {:.2E}\n'.format(
+				step, temp, energy + 1.5, energy, energy + 0.001, 1.5, 0.12, 0.03))
+			osz.flush()
+
+			coords = [[(x + rng.gauss(0, 0.001)) % 1.0 for x in c] for c in coords]
+			if step % nblock == 0:
+				xdat.write('Direct configuration= {:5d}\n'.format(step))
+				for c in coords:
+					xdat.write('  {:.8f}  {:.8f}  {:.8f}\n'.format(*c))
+				xdat.flush()
+			nsteps = step
+
+	with open('CONTCAR', 'w') as f:
+		f.write('\n'.join(header) + '\n')
+		for c in coords:
+			f.write('  {:.16f}  {:.16f}  {:.16f}\n'.format(*c))
+
+	write_wavecar('WAVECAR', wavecar_bytes, rng)
+
+	if os.environ.get('FAKE_VASP_LOG'):
+		with open(os.environ['FAKE_VASP_LOG'], 'a') as f:
+			f.write(json.dumps({'dir': os.getcwd(), 'start': start, 'end': time(), 'steps': nsteps}) + '\n')
+
+def read_incar(path):
+	out = {}
+	with open(path) as f:
+		for line in f:
+			line = line.split('#')[0].split('!')[0]
+			for part in line.split(';'):
+				if '=' in part:
+					key, value = part.split('=', 1)
+					out[key.strip().upper()] = value.split()[0] if value.split() else ''
+	return out
+
+# Returns (header lines up to and including the coordinate mode line, list of coordinates)
+def split_poscar(lines):
+	i = 5
+	if not re.match(r'^\s*\d', lines[i]):
+		i += 1 # species line
+	natoms = sum(int(x) for x in lines[i].split())
+	i += 1
+	if lines[i].strip()[:1] in 'sS':
+		i += 1
+	header = lines[:i+1]
+	coords = [[float(x) for x in line.split()[:3]] for line in lines[i+1:i+1+natoms]]
+	return header, coords
+
+def stop_requested():
+	if not os.path.exists('STOPCAR'):
+		return False
+	with open('STOPCAR') as f:
+		return 'LSTOP' in f.read().upper()
+
+# Incompressible data, without paying for a random number per byte.
+def write_wavecar(path, nbytes, rng):
+	chunk = bytes(rng.getrandbits(8) for _ in range(min(nbytes, 1 << 20)))
+	with open(path, 'wb') as f:
+		while nbytes > 0:
+			f.write(chunk[:nbytes])
+			nbytes -= len(chunk)
+
+if __name__ == '__main__':
+	main()
@@ -22,6 +22,12 @@ setup(
 		'console_scripts':[
 			'md-init = vaspmd.md_init:main',
 			'vasp-search = vaspmd.search:main',
+			'md-collect = vaspmd.md_collect:main',
+			'vaspmd-state = vaspmd.state:main',
+			'md-pack = vaspmd.md_pack:main',
+			'md-profile = vaspmd.md_profile:main',
+			'md-fork = vaspmd.md_fork:main',
+			'vaspmd-index = vaspmd.index:main',
 		],
 	},
 
@@ -31,6 +37,7 @@ setup(
 
 	install_requires=[
 		'pytoml',
+		'numpy',
 	],
 
 	packages=find_packages(), # include sub-packages
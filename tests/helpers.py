@@ -0,0 +1,190 @@
+# Helpers for running md-run and vasp-search against benchmarks/fake_vasp.py.
+#
+# Both are run as subprocesses (like bench.py does), since they change the working directory,
+#  install signal handlers, and keep a process-wide event log.
+
+import os
+import sys
+import json
+import subprocess
+from time import time, sleep
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+BENCHMARKS = join(ROOT, 'benchmarks')
+FAKE_VASP = join(BENCHMARKS, 'fake_vasp.py')
+FAKE_SLURM = join(BENCHMARKS, 'fake_slurm.py')
+MD_RUN = join(ROOT, 'scripts', 'md-run')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCHMARKS)
+
+import bench # noqa
+from vaspmd import md # noqa
+
+FAKE_VASP_CMD = '{} {}'.format(sys.executable, FAKE_VASP)
+
+# Environment for md-run and vasp-search, with fake_vasp as vasp.
+# Extra variables can be given as keyword arguments (None to unset one).
+def fake_env(d, **extra):
+	env = bench.fake_vasp_env(log_path=join(d, 'fake-vasp.log'), wavecar_bytes=4096, step_time=0.0)
+	for key, value in extra.items():
+		if value is None:
+			env.pop(key, None)
+		else:
+			env[key] = str(value)
+	return env
+
+# Add fake_slurm to an environment from fake_env, as sbatch, squeue and scancel (and the python
+#  running the tests as python3, for scripts/md-run), with its queue in `d`/queue.
+def fake_slurm_env(d, env, **extra):
+	bindir = join(d, 'fakebin')
+	os.makedirs(bindir, exist_ok=True)
+	for cmd in ['sbatch', 'squeue', 'scancel']:
+		if not os.path.lexists(join(bindir, cmd)):
+			os.symlink(FAKE_SLURM, join(bindir, cmd))
+	if not os.path.lexists(join(bindir, 'python3')):
+		os.symlink(sys.executable, join(bindir, 'python3'))
+
+	env = dict(env, PATH=bindir + os.pathsep + env['PATH'], FAKE_SLURM_DIR=join(d, 'queue'))
+	for key in [md.ENV_SLURM_JOB_ID, md.ENV_SLURM_JOB_END_TIME, md.ENV_END_TIME]:
+		env.pop(key, None) # (in case the tests themselves are run under slurm)
+	for key, value in extra.items():
+		env[key] = str(value)
+	return env
+
+#-----------------------------------------------------
+
+# Write the inputs and md.conf of an md directory.  Keyword arguments are md.conf keys
+#  (with '_' for '-') that override the defaults here.
+def make_md_dir(d, *, natoms=4, incar_part='', **conf):
+	os.makedirs(d, exist_ok=True)
+	bench.write_md_inputs(d, natoms=natoms)
+	if incar_part:
+		with open(join(d, 'INCAR.part'), 'a') as f:
+			f.write(incar_part)
+
+	settings = {
+		md.CONF_TEMPERATURE: 300,
+		md.CONF_FROM_ZERO: True,
+		md.CONF_BLOCKSIZE: 3,
+		md.CONF_LINEAR_STEPS: 3,
+		md.CONF_NOSE_STEPS: 3,
+		md.CONF_NVE_STEPS: 7,
+		md.CONF_CYCLES: 1,
+		md.CONF_STATUS_INTERVAL: 0,
+	}
+	settings.update({key.replace('_', '-'): value for (key, value) in conf.items()})
+	with open(join(d, 'md.conf'), 'w') as f:
+		json.dump(settings, f, indent=1)
+	return d
+
+def run_md(d, *args, env=None, check=True, timeout=120):
+	return subprocess.run([sys.executable, '-c', 'from vaspmd.md import main; main()'] + list(args),
+		cwd=d, env=env or fake_env(d), check=check, timeout=timeout,
+		stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+# Start md-run, and send it `signum` once `oszicar` shows at least `steps` steps.
+# SIGKILL goes to vasp as well, as when a job is killed.  Returns the output of md-run.
+def signal_md_during(d, oszicar, *, steps, signum, env, args=(), timeout=60):
+	import signal
+	p = subprocess.Popen([sys.executable, '-c', 'from vaspmd.md import main; main()'] + list(args),
+		cwd=d, env=env, start_new_session=True,
+		stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+	try:
+		deadline = time() + timeout
+		while not (os.path.exists(oszicar) and md.count_completed_steps(oszicar) >= steps):
+			assert p.poll() is None, 'md-run exited before it could be signalled:\n' + p.stdout.read()
+			assert time() < deadline, 'timed out'
+			sleep(0.02)
+		if signum == signal.SIGKILL:
+			os.killpg(p.pid, signum)
+		else:
+			p.send_signal(signum)
+		out, _ = p.communicate(timeout=timeout)
+	finally:
+		if p.poll() is None:
+			p.kill()
+			p.wait()
+	if signum != signal.SIGKILL:
+		assert p.returncode == 0, out
+	return out
+
+# Keep running md-run with --max-units 1 until it finishes.  Returns the number of md-runs.
+def run_md_one_unit_at_a_time(d, *, env=None, limit=100):
+	for n in range(1, limit + 1):
+		run_md(d, '--max-units', '1', env=env)
+		if is_finished(join(d, 'md.state')):
+			return n
+	raise AssertionError('md-run did not finish after {} runs'.format(limit))
+
+def is_finished(state_path):
+	return os.path.exists(state_path) and isinstance(md.load_loop_state(state_path), md.EndLoop)
+
+def read_lines(path):
+	with open(path) as f:
+		return [line.strip() for line in f if line.strip()]
+
+# Number of ionic steps in each leaf of an md directory.
+def leaf_steps(d):
+	return {leaf: md.count_completed_steps(join(d, leaf, 'OSZICAR')) for leaf in read_lines(join(d, md.VARFILE_MD_ALLDIRS))}
+
+# Names of the vasp runs recorded in the fake vasp log, relative to `d`.
+def fake_vasp_runs(d):
+	path = join(d, 'fake-vasp.log')
+	if not os.path.exists(path):
+		return []
+	with open(path) as f:
+		return [os.path.relpath(json.loads(line)['dir'], d) for line in f]
+
+#-----------------------------------------------------
+
+# Scripts for a search whose trials just run fake_vasp:
+#   init.sh TRIALNAME VALUE:  copy the inputs, and record the value.
+#   next.sh TRIALNAME...:     narrow by half around the middle.
+#   value.sh TRIALNAME:       (x - 0.3)^2
+SEARCH_SCRIPTS = {
+	'init.sh': '#!/bin/sh\nmkdir -p "$1" && cp inputs/* "$1/" && echo "$2" > "$1/value"\n',
+	'next.sh': '#!/bin/sh\ncat "$1/value" "$(eval echo \\${$#})/value" | '
+		'awk \'NR==1{a=$1} NR==2{b=$1} END{m=(a+b)/2; w=(b-a)/4; print m-w, m+w}\'\n',
+	'value.sh': '#!/bin/sh\nawk \'{print ($1 - 0.3) ^ 2}\' "$1/value"\n',
+}
+
+# Write a search directory.  Keyword arguments are search.toml keys (with '_' for '-').
+def make_search_dir(d, *, natoms=4, nsw=3, **conf):
+	os.makedirs(join(d, 'inputs'), exist_ok=True)
+	bench.write_md_inputs(join(d, 'inputs'), natoms=natoms)
+	with open(join(d, 'inputs', 'INCAR'), 'w') as f:
+		f.write('NSW = {}\n'.format(nsw))
+
+	for fname, text in SEARCH_SCRIPTS.items():
+		with open(join(d, fname), 'w') as f:
+			f.write(text)
+		os.chmod(join(d, fname), 0o755)
+
+	settings = {
+		'start-min': 0.0,
+		'start-max': 1.0,
+		'npoints': 4,
+		'cmd-init': '../init.sh',
+		'cmd-run': FAKE_VASP_CMD,
+		'cmd-next': '../next.sh',
+		'files': ['inputs'],
+	}
+	settings.update({key.replace('_', '-'): value for (key, value) in conf.items()})
+	write_search_toml(d, settings)
+	return d
+
+def write_search_toml(d, settings):
+	with open(join(d, 'search.toml'), 'w') as f:
+		for key, value in settings.items():
+			if value is not None:
+				f.write('{} = {}\n'.format(key, json.dumps(value)))
+
+def run_search(d, *, env=None, check=True, timeout=120):
+	return subprocess.run([sys.executable, '-c', 'from vaspmd.search import main; main()'],
+		cwd=d, env=env or fake_env(d), check=check, timeout=timeout,
+		stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+def read_json(path):
+	with open(path) as f:
+		return json.load(f)
@@ -0,0 +1,46 @@
+# The on-the-fly analysis of NVE blocks.
+
+from os.path import join
+
+import numpy as np
+import pytest
+
+from helpers import md, make_md_dir, run_md
+
+# g(r) the obvious way, with every pair at once.
+def naive_rdf_histogram(frac, cell, *, bins, rmax):
+	i, j = np.triu_indices(len(frac), k=1)
+	d = frac[i] - frac[j]
+	d -= np.rint(d)
+	r = np.sqrt((d.dot(cell) ** 2).sum(axis=-1))
+	return np.histogram(r, bins=bins, range=(0, rmax))[0]
+
+CELL = np.array([[10.0, 0, 0], [1.0, 9.0, 0], [0.5, 0.5, 11.0]])
+
+@pytest.mark.parametrize('natoms', [1, 2, 5, 64])
+@pytest.mark.parametrize('chunk', [1, 7, 64, 1 << 18])
+def test_rdf_histogram_in_chunks(monkeypatch, natoms, chunk):
+	monkeypatch.setattr(md, 'RDF_CHUNK_PAIRS', chunk)
+	frac = np.random.RandomState(natoms).rand(natoms, 3)
+	rmax = 0.5 * md.min_cell_width(CELL)
+	hist = md.rdf_histogram(frac, CELL, bins=50, rmax=rmax)
+	assert hist.sum() <= natoms * (natoms - 1) // 2
+	assert np.array_equal(hist, naive_rdf_histogram(frac, CELL, bins=50, rmax=rmax))
+
+def test_rdf_of_a_run(tmp_path, monkeypatch):
+	d = make_md_dir(str(tmp_path), natoms=20, **{md.CONF_BLOCKSIZE: 7, md.CONF_NVE_STEPS: 10})
+	run_md(d)
+
+	def analyze(chunk):
+		monkeypatch.setattr(md, 'RDF_CHUNK_PAIRS', chunk)
+		blockdir = join(d, '1-nve', '001')
+		state = md.new_analysis_state(blockdir, kinds=[md.ANALYSIS_RDF], window=10, rdf_rmax=None, rdf_bins=40)
+		for name in ['001', '002']:
+			for cell, _species, _counts, frac in md.iter_xdatcar(join(d, '1-nve', name, 'XDATCAR')):
+				md.consume_analysis_frame(state, cell, frac)
+		return state
+
+	whole, chunked = analyze(1 << 18), analyze(3)
+	assert whole['rdf-frames'] == chunked['rdf-frames'] == 10
+	assert whole['rdf-hist'].sum() > 0
+	assert np.array_equal(whole['rdf-hist'], chunked['rdf-hist'])
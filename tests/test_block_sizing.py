@@ -0,0 +1,106 @@
+# Adaptive NVE block sizing (block-sizing = "adaptive").
+
+import signal
+from time import time
+from os.path import join, exists
+
+import pytest
+
+from helpers import md, make_md_dir, run_md, fake_env, fake_vasp_runs, signal_md_during, is_finished
+
+def test_measured_sec_per_step():
+	assert md.measured_sec_per_step([], []) is None
+	assert md.measured_sec_per_step([10], [None]) is None
+	assert md.measured_sec_per_step([10, 5], [None, 2.0]) == pytest.approx(0.4)
+	assert md.measured_sec_per_step([10, 10], [2.0, 4.0]) == pytest.approx(0.3)
+
+@pytest.mark.parametrize('left, expected', [
+	(None, 8),    # no walltime limit
+	(1000, 8),    # plenty
+	(70, 6),      # (70 - 10) / 10
+	(40, 3),      # just enough for min_block
+])
+def test_adaptive_block_size(monkeypatch, left, expected):
+	monkeypatch.setattr(md, 'remaining_walltime', lambda: left)
+	assert md.adaptive_block_size(remaining_steps=20, blocksize=8, sec_per_step=10.0,
+		walltime_margin=10, min_block=3) == expected
+
+def test_adaptive_block_size_suspends(monkeypatch):
+	monkeypatch.setattr(md, 'remaining_walltime', lambda: 39)
+	with pytest.raises(md.Suspend) as info:
+		md.adaptive_block_size(remaining_steps=20, blocksize=8, sec_per_step=10.0, walltime_margin=10, min_block=3)
+	assert str(info.value) == 'only 39.0s of walltime remain; the next block needs at least 40.0s'
+
+	# the last block of a stage may be smaller than min_block
+	monkeypatch.setattr(md, 'remaining_walltime', lambda: 25)
+	assert md.adaptive_block_size(remaining_steps=1, blocksize=8, sec_per_step=10.0, walltime_margin=10, min_block=3) == 1
+
+def test_adaptive_block_size_without_measurements(monkeypatch):
+	monkeypatch.setattr(md, 'remaining_walltime', lambda: 0)
+	assert md.adaptive_block_size(remaining_steps=20, blocksize=8, sec_per_step=None, walltime_margin=10, min_block=3) == 8
+
+#-----------------------------------------------------
+# With fake_vasp.  The walltime is given to each md-run through VASPMD_END_TIME.
+
+STEP_TIME = 0.2
+BLOCKSIZE = 8
+
+@pytest.fixture
+def adaptive_dir(tmp_path):
+	return make_md_dir(str(tmp_path), **{
+		md.CONF_BLOCK_SIZING: md.BLOCK_SIZING_ADAPTIVE, md.CONF_BLOCKSIZE: BLOCKSIZE,
+		md.CONF_NVE_STEPS: 24, md.CONF_LINEAR_STEPS: 1, md.CONF_NOSE_STEPS: 1,
+		md.CONF_WALLTIME_MARGIN: 0, md.CONF_MIN_BLOCK: 2,
+	})
+
+def env_with_walltime(d, seconds):
+	end = None if seconds is None else time() + seconds
+	return fake_env(d, FAKE_VASP_STEP_TIME=STEP_TIME, **{md.ENV_END_TIME: end})
+
+def nve_state(d):
+	return md.load_loop_state(join(d, '1-nve', 'nve.state'))
+
+def block_steps(d, name):
+	return md.count_completed_steps(join(d, '1-nve', name, 'OSZICAR'))
+
+def test_blocks_shrink_as_walltime_runs_out(adaptive_dir):
+	d = adaptive_dir
+	# the first block has nothing to go on, so it is full size
+	run_md(d, '--max-units', '3', env=env_with_walltime(d, 1000))
+	assert block_steps(d, '001') == BLOCKSIZE
+
+	# about 8 steps' worth, less md-run's own startup, leaves room for a smaller block
+	run_md(d, '--max-units', '1', env=env_with_walltime(d, 8 * STEP_TIME))
+	second = block_steps(d, '002')
+	assert 2 <= second < BLOCKSIZE
+	i, sizes, names = nve_state(d)[:3]
+	assert (i, list(sizes), list(names)) == (2, [BLOCKSIZE, second], ['001', '002'])
+
+	# no time at all:  md-run suspends before starting a block
+	p = run_md(d, env=env_with_walltime(d, 0))
+	assert 'suspended: only' in p.stdout and 'the next block needs at least' in p.stdout
+	assert not exists(join(d, '1-nve', '003'))
+	assert len(fake_vasp_runs(d)) == 4
+
+	# and with time again, the rest is done in full blocks
+	run_md(d, env=env_with_walltime(d, None))
+	assert is_finished(join(d, 'md.state'))
+	sizes = [block_steps(d, name) for name in nve_state(d).value]
+	assert sizes[:2] == [BLOCKSIZE, second]
+	assert all(n == BLOCKSIZE for n in sizes[2:-1])
+	assert sum(sizes) == 24
+
+def test_killed_block_is_resized_on_rerun(adaptive_dir):
+	d = adaptive_dir
+	run_md(d, '--max-units', '3', env=env_with_walltime(d, 1000))
+
+	# killed partway through a full-size second block
+	signal_md_during(d, join(d, '1-nve', '002', 'OSZICAR'), steps=2, signum=signal.SIGKILL,
+		env=env_with_walltime(d, 1000))
+	assert nve_state(d)[0] == 1 # (not recorded)
+
+	# rerun with less walltime; the block is sized again
+	run_md(d, '--max-units', '1', env=env_with_walltime(d, 8 * STEP_TIME))
+	second = block_steps(d, '002')
+	assert 2 <= second < BLOCKSIZE
+	assert list(nve_state(d)[1]) == [BLOCKSIZE, second]
@@ -0,0 +1,146 @@
+# md-run --chain, with fake_slurm as the scheduler and fake_vasp as vasp.
+
+import os
+import sys
+import subprocess
+from os.path import join
+
+import pytest
+
+from helpers import md, make_md_dir, fake_env, fake_slurm_env, is_finished, read_lines, read_json
+from helpers import fake_vasp_runs, FAKE_SLURM, FAKE_VASP_CMD, MD_RUN
+
+LEAVES = ['1-linear', '1-nose', '1-nve/001', '1-nve/002', '1-nve/003']
+
+def slurm(d, *args, env):
+	return subprocess.run(list(args), cwd=d, env=env, check=True,
+		stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+
+# Run the fake scheduler until no job can start (or for `max_jobs` jobs).
+def run_scheduler(d, *, env, max_jobs=None):
+	args = [] if max_jobs is None else ['--max-jobs', str(max_jobs)]
+	return slurm(d, sys.executable, FAKE_SLURM, 'run', *args, env=env)
+
+def read_jobs(d):
+	jobs = read_json(join(d, 'queue', 'queue.json'))['jobs']
+	return [jobs[k] for k in sorted(jobs, key=int)]
+
+def job_output(d, job):
+	with open(join(d, 'slurm-{}.out'.format(job['id']))) as f:
+		return f.read()
+
+@pytest.fixture
+def chain_dir(tmp_path):
+	d = make_md_dir(str(tmp_path))
+	return d, fake_slurm_env(d, fake_env(d))
+
+def test_chain_runs_to_the_end(chain_dir):
+	d, env = chain_dir
+	slurm(d, 'sbatch', MD_RUN, '--chain', '--max-units', '2', env=env)
+	run_scheduler(d, env=env)
+
+	jobs = read_jobs(d)
+	# 5 units of 2 per job:  the third job finishes the plan and cancels the fourth
+	assert [j['state'] for j in jobs] == ['COMPLETED', 'COMPLETED', 'COMPLETED', 'CANCELLED'], \
+		[job_output(d, j) for j in jobs if j['start']]
+	assert is_finished(join(d, 'md.state'))
+	assert fake_vasp_runs(d) == LEAVES
+
+	# each job was submitted by the one before it, to run after it, with the same arguments
+	for prev, job in zip(jobs, jobs[1:]):
+		assert job['submitted-by'] == prev['id']
+		assert job['dependency'] == [prev['id']]
+		assert job['kill-on-invalid-dep']
+		assert job['script'] == MD_RUN
+		assert job['args'] == ['--chain', '--max-units', '2']
+	assert read_lines(join(d, md.VARFILE_MD_CHAIN)) == [jobs[-1]['id']]
+	assert 'cancelled successor {}'.format(jobs[-1]['id']) in job_output(d, jobs[2])
+
+def test_failed_job_breaks_the_chain(chain_dir):
+	d, env = chain_dir
+	env['VASPMD_VASP_CMD'] = 'test ! -e {} && {}'.format(join(d, 'FAIL'), FAKE_VASP_CMD)
+	slurm(d, 'sbatch', MD_RUN, '--chain', '--max-units', '2', env=env)
+	run_scheduler(d, env=env, max_jobs=1)
+
+	open(join(d, 'FAIL'), 'w').close()
+	run_scheduler(d, env=env)
+	jobs = read_jobs(d)
+	assert [j['state'] for j in jobs] == ['COMPLETED', 'FAILED', 'CANCELLED']
+	assert jobs[2]['start'] is None # it never ran
+	assert fake_vasp_runs(d) == LEAVES[:2]
+
+	# a new chain picks up where the failed job left off
+	os.remove(join(d, 'FAIL'))
+	slurm(d, 'sbatch', MD_RUN, '--chain', '--max-units', '2', env=env)
+	run_scheduler(d, env=env)
+	assert is_finished(join(d, 'md.state'))
+	assert fake_vasp_runs(d) == LEAVES
+
+def test_requeued_job_does_not_submit_twice(chain_dir):
+	d, env = chain_dir
+	jobid = slurm(d, 'sbatch', '--parsable', MD_RUN, env=env).strip()
+	# the same job started twice (as when slurm requeues it), without the scheduler
+	env = dict(env, SLURM_JOB_ID=jobid)
+	for _ in range(2):
+		subprocess.run([MD_RUN, '--chain', '--max-units', '1'], cwd=d, env=env, check=True,
+			stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+	jobs = read_jobs(d)
+	assert len(jobs) == 2
+	assert jobs[1]['dependency'] == [jobid]
+	assert read_lines(join(d, md.VARFILE_MD_CHAIN)) == [jobs[1]['id']]
+	assert fake_vasp_runs(d) == LEAVES[:2]
+
+def test_chain_outside_slurm_is_refused(chain_dir):
+	d, env = chain_dir
+	p = subprocess.run([MD_RUN, '--chain'], cwd=d, env=env,
+		stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+	assert p.returncode != 0
+	assert '--chain must be used inside a slurm job' in p.stdout
+	assert fake_vasp_runs(d) == []
+
+#-----------------------------------------------------
+# Walltime
+
+@pytest.mark.parametrize('s, expected', [
+	('1-02:03:04', 93784),
+	('02:03:04', 7384),
+	('03:04', 184),
+	('4', 4),
+	('0:00', 0),
+	('UNLIMITED', None),
+	('NOT_SET', None),
+	('1:2:3:4', None),
+])
+def test_parse_slurm_duration(s, expected):
+	assert md.parse_slurm_duration(s) == expected
+
+@pytest.mark.parametrize('limit, expected', [
+	(90061, 90061), # squeue prints 1-01:01:01
+	(3725, 3725),   # 1:02:05
+	(59, 59),       # 0:59
+	(None, None),   # UNLIMITED
+])
+def test_remaining_walltime_from_squeue(tmp_path, monkeypatch, limit, expected):
+	d = str(tmp_path)
+	extra = {} if limit is None else {'FAKE_SLURM_TIME_LIMIT': limit}
+	env = fake_slurm_env(d, dict(os.environ), **extra)
+	jobid = slurm(d, 'sbatch', '--parsable', MD_RUN, env=env).strip()
+
+	for key in ['PATH', 'FAKE_SLURM_DIR', 'FAKE_SLURM_TIME_LIMIT']:
+		if key in env:
+			monkeypatch.setenv(key, env[key])
+	for key in [md.ENV_SLURM_JOB_END_TIME, md.ENV_END_TIME]:
+		monkeypatch.delenv(key, raising=False)
+	monkeypatch.setenv(md.ENV_SLURM_JOB_ID, jobid)
+	assert md.remaining_walltime() == expected
+
+	# once the job has left the queue, there is nothing to go on
+	slurm(d, 'scancel', jobid, env=env)
+	assert md.remaining_walltime() is None
+
+def test_remaining_walltime_prefers_end_time(monkeypatch):
+	from time import time
+	monkeypatch.setenv(md.ENV_SLURM_JOB_END_TIME, str(time() + 600))
+	monkeypatch.delenv(md.ENV_END_TIME, raising=False)
+	assert 590 < md.remaining_walltime() <= 600
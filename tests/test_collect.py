@@ -0,0 +1,89 @@
+# md-collect, on runs with fake_vasp.
+
+import os
+from os.path import join
+
+import numpy as np
+import pytest
+
+from helpers import md, make_md_dir, run_md, leaf_steps
+from vaspmd import md_collect
+
+# With NBLOCK = 2, each leaf of 3 steps has a single frame (at step 2), and a step after it.
+NBLOCK = 2
+
+@pytest.fixture
+def nblock_dir(tmp_path):
+	return make_md_dir(str(tmp_path / 'md'), incar_part='NBLOCK = {}\n'.format(NBLOCK), **{md.CONF_NVE_STEPS: 8})
+
+def oszicar_rows(d, leaf):
+	data = md.read_oszicar_arrays(join(d, leaf, 'OSZICAR'))
+	return np.array([data[name] for name in md.OSZICAR_FIELDS]).T
+
+def test_every_step_is_collected(nblock_dir):
+	d = nblock_dir
+	run_md(d)
+	output = join(d, md_collect.DEFAULT_OUTPUT)
+	assert md_collect.collect(d, output) == 5
+
+	index, positions, _, energies = md_collect.open_trajectory(output)
+	steps = md_collect.open_steps(output)
+	expected_steps = leaf_steps(d)
+	assert index['nsteps'] == sum(expected_steps.values()) == len(steps) == 14
+	assert index['nframes'] == len(positions) == len(energies) == 5
+
+	for leaf in index['leaves']:
+		name = leaf['leaf']
+		assert leaf['nblock'] == NBLOCK
+		assert leaf['step-count'] == expected_steps[name]
+
+		# every step, including those after the last frame
+		rows = oszicar_rows(d, name)
+		assert np.array_equal(steps[md_collect.leaf_steps(index, name)], rows)
+
+		# and the frames are at every NBLOCK-th step
+		frames = md_collect.leaf_frames(index, name)
+		assert np.array_equal(energies[frames], rows[NBLOCK-1::NBLOCK][:leaf['count']])
+		assert np.array_equal(energies[frames], steps[md_collect.frame_steps(index, name)])
+
+def test_incremental_collect_does_not_duplicate_steps(nblock_dir):
+	d = nblock_dir
+	output = join(d, md_collect.DEFAULT_OUTPUT)
+	run_md(d, '--max-units', '3')
+	assert md_collect.collect(d, output) == 3
+	assert md_collect.read_index(output)['nsteps'] == 9
+
+	# left over from an interrupted md-collect
+	with open(join(output, md_collect.STEPS_FILE), 'ab') as f:
+		f.write(b'\0' * 56)
+
+	run_md(d)
+	assert md_collect.collect(d, output) == 2
+	index = md_collect.read_index(output)
+	assert index['nsteps'] == 14
+	assert os.path.getsize(join(output, md_collect.STEPS_FILE)) == 14 * len(md.OSZICAR_FIELDS) * 8
+	assert [x['step-start'] for x in index['leaves']] == [0, 3, 6, 9, 12]
+	assert md_collect.collect(d, output) == 0
+
+def test_step_energies_are_indexed_by_step(tmp_path):
+	path = str(tmp_path / 'OSZICAR')
+	with open(path, 'w') as f:
+		f.write('     1 T=   300. E= -.1E+03 F= -.2E+03 E0= -.3E+03  EK= 0.1E+01 SP= 0.1 SK= 0.2\n')
+		f.write('     3 T=   310. E= -.1E+03 F= -.2E+03 E0= -.3E+03  EK= 0.1E+01 SP= 0.1 SK= 0.2\n')
+	steps = md_collect.step_energies(path)
+	assert steps.shape == (3, len(md.OSZICAR_FIELDS))
+	assert list(steps[:, 0][[0, 2]]) == [300, 310]
+	assert np.isnan(steps[1]).all()
+
+def test_older_collection_needs_rebuild(nblock_dir):
+	d = nblock_dir
+	run_md(d)
+	output = join(d, md_collect.DEFAULT_OUTPUT)
+	md_collect.collect(d, output)
+	index = md_collect.read_index(output)
+	del index['nsteps']
+	md_collect.write_index(output, index)
+
+	with pytest.raises(RuntimeError, match='Use --rebuild'):
+		md_collect.collect(d, output)
+	assert md_collect.collect(d, output, rebuild=True) == 5
@@ -0,0 +1,109 @@
+# Equilibration detection (check_equilibrated), and ending the nose stage early with it.
+
+import os
+import random
+from os.path import join, exists
+
+import numpy as np
+import pytest
+
+from helpers import md, make_md_dir, run_md, fake_env, fake_vasp_runs, is_finished, read_json, read_lines
+
+def oszicar_data(temps, energies=None):
+	temps = np.asarray(temps, dtype=float)
+	if energies is None:
+		energies = -100 + noise(len(temps), 0.05, seed=1)
+	return {
+		'step': np.arange(1, len(temps) + 1),
+		'T': temps,
+		'F': np.asarray(energies, dtype=float),
+	}
+
+def check(data, window=40):
+	return md.check_equilibrated(data, target=300, window=window, temp_tol=0.05, drift_tol=1.0)
+
+def noise(n, sigma, seed=0):
+	rng = random.Random(seed)
+	return np.array([rng.gauss(0, sigma) for _ in range(n)])
+
+def test_equilibrated():
+	stats = check(oszicar_data(300 + noise(60, 3)))
+	assert stats['equilibrated']
+	assert stats['first-step'] == 21 and stats['step'] == 60
+	assert all(stats['tests'].values())
+
+def test_too_few_steps():
+	stats = check(oszicar_data(300 + noise(30, 3)))
+	assert not stats['equilibrated']
+	assert 'tests' not in stats
+
+def test_wrong_temperature():
+	stats = check(oszicar_data(330 + noise(60, 3)))
+	assert not stats['equilibrated']
+	assert not stats['tests']['mean']
+
+def test_drifting_temperature():
+	# (mean and blocks within tolerance, but heading steadily upwards)
+	stats = check(oszicar_data(np.linspace(290, 310, 60) + noise(60, 0.5)))
+	assert stats['tests']['mean'] and stats['tests']['blocks']
+	assert not stats['tests']['temperature-drift']
+	assert not stats['equilibrated']
+
+def test_only_the_window_counts():
+	# heating up at first, then settled
+	temps = np.concatenate([np.linspace(0, 300, 50), 300 + noise(40, 3)])
+	assert check(oszicar_data(temps), window=40)['equilibrated']
+	assert not check(oszicar_data(temps), window=80)['equilibrated']
+
+def test_nan_is_not_equilibrated():
+	temps = 300 + noise(60, 3)
+	temps[-5] = np.nan
+	assert not check(oszicar_data(temps))['equilibrated']
+
+#-----------------------------------------------------
+# With fake_vasp, whose nose temperatures are TEBEG plus gaussian noise (sigma 5K), and whose
+#  energies are flat plus noise.  The drift test is loosened so that a short window of noise
+#  always passes.
+
+NOSE_STEPS = 400
+
+@pytest.fixture
+def early_stop_dir(tmp_path):
+	return make_md_dir(str(tmp_path), **{
+		md.CONF_NOSE_EARLY_STOP: True, md.CONF_NOSE_STEPS: NOSE_STEPS,
+		md.CONF_EQUIL_WINDOW: 8, md.CONF_EQUIL_TEMP_TOL: 0.1, md.CONF_EQUIL_DRIFT_TOL: 100.0,
+		md.CONF_STATUS_INTERVAL: 0.05,
+	})
+
+def read(path):
+	with open(path) as f:
+		return f.read()
+
+def test_nose_stage_ends_when_equilibrated(early_stop_dir):
+	d = early_stop_dir
+	run_md(d, env=fake_env(d, FAKE_VASP_STEP_TIME=0.02))
+	assert is_finished(join(d, 'md.state'))
+
+	# the nose stage stopped well short of its steps, once the window was full
+	nose = join(d, '1-nose')
+	done = md.count_completed_steps(join(nose, 'OSZICAR'))
+	assert 8 <= done < NOSE_STEPS
+	stats = read_json(join(nose, md.EQUIL_FILE))
+	assert stats['equilibrated'] and stats['window'] == 8
+	assert stats['step'] <= done
+
+	# without a continuation
+	assert not [name for name in os.listdir(nose) if name.startswith('cont-')]
+	assert md.load_loop_state(join(nose, 'segments.state')).value == ('.',)
+	assert '1-nose' in read_lines(join(d, md.VARFILE_MD_ALLDIRS))
+	assert fake_vasp_runs(d) == ['1-linear', '1-nose', '1-nve/001', '1-nve/002', '1-nve/003']
+
+	# and the next stage started from where it stopped
+	assert read(join(d, '1-nve', 'POSCAR')) == read(join(nose, 'CONTCAR'))
+	assert read(join(d, '1-nve', '001', 'POSCAR')) == read(join(nose, 'CONTCAR'))
+
+def test_nose_stage_runs_in_full_without_early_stop(tmp_path):
+	d = make_md_dir(str(tmp_path), **{md.CONF_NOSE_STEPS: NOSE_STEPS, md.CONF_STATUS_INTERVAL: 0.05})
+	run_md(d)
+	assert md.count_completed_steps(join(d, '1-nose', 'OSZICAR')) == NOSE_STEPS
+	assert not exists(join(d, '1-nose', md.EQUIL_FILE))
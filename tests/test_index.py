@@ -0,0 +1,81 @@
+# vaspmd-index, over a tree of md runs made with fake_vasp.
+
+import os
+import shutil
+from os.path import join
+
+import pytest
+
+from helpers import md, make_md_dir, run_md, leaf_steps
+from vaspmd import index
+
+@pytest.fixture
+def tree(tmp_path):
+	root = str(tmp_path / 'runs')
+	for name in ['a', 'b', 'c']:
+		d = make_md_dir(join(root, name))
+		run_md(d, '--max-units', '2')
+	return root
+
+@pytest.fixture
+def db(tmp_path):
+	db = index.open_db(str(tmp_path / 'index.sqlite'))
+	yield db
+	db.close()
+
+def runs(db):
+	return {os.path.basename(d): (finished, nleaves, steps) for (d, finished, nleaves, steps)
+		in db.execute('SELECT dir, finished, nleaves, steps FROM runs')}
+
+def leaves(db, d):
+	return db.execute('SELECT leaf, steps FROM leaves WHERE dir = ? ORDER BY leaf', (d,)).fetchall()
+
+def test_unchanged_runs_are_skipped(tree, db):
+	assert index.scan(db, [tree]) == (3, 3, 0)
+	assert runs(db) == {name: (0, 2, 6) for name in 'abc'}
+	scanned = dict(db.execute('SELECT dir, scanned FROM runs'))
+
+	assert index.scan(db, [tree]) == (3, 0, 0)
+	assert dict(db.execute('SELECT dir, scanned FROM runs')) == scanned
+
+def test_deleted_run_is_removed(tree, db):
+	index.scan(db, [tree])
+	shutil.rmtree(join(tree, 'b'))
+	assert index.scan(db, [tree]) == (2, 0, 1)
+	assert sorted(runs(db)) == ['a', 'c']
+	assert leaves(db, join(tree, 'b')) == []
+
+def test_runs_outside_the_scanned_tree_are_kept(tree, tmp_path, db):
+	other = make_md_dir(str(tmp_path / 'runs-2' / 'd'))
+	index.scan(db, [tree, str(tmp_path / 'runs-2')])
+	# (runs-2 is not a subdirectory of runs, despite the common prefix)
+	assert index.scan(db, [tree]) == (3, 0, 0)
+	assert sorted(runs(db)) == ['a', 'b', 'c', 'd']
+	shutil.rmtree(other)
+	assert index.scan(db, [str(tmp_path / 'runs-2')]) == (0, 0, 1)
+	assert sorted(runs(db)) == ['a', 'b', 'c']
+
+def test_grown_run_is_reindexed(tree, db):
+	index.scan(db, [tree])
+	d = join(tree, 'a')
+	run_md(d)
+	assert index.scan(db, [tree]) == (3, 1, 0)
+
+	expected = leaf_steps(d)
+	assert leaves(db, d) == sorted(expected.items())
+	assert runs(db)['a'] == (1, len(expected), sum(expected.values()))
+	assert db.execute('SELECT COUNT(*) FROM leaves').fetchone()[0] == len(expected) + 2 + 2
+
+	# the last step is that of the new last leaf
+	last_temp = md.read_last_oszicar_step(join(d, '1-nve', '003', 'OSZICAR')).T
+	assert db.execute('SELECT last_temp FROM runs WHERE dir = ?', (d,)).fetchone()[0] == last_temp
+
+def test_rewritten_leaf_is_reread(tree, db):
+	index.scan(db, [tree])
+	d = join(tree, 'c')
+	with open(join(d, '1-linear', 'OSZICAR'), 'a') as f:
+		f.write('     4 T=   123. E= -.1E+03 F= -.2E+03 E0= -.3E+03  EK= 0.1E+01 SP= 0.1 SK= 0.2\n')
+	# (leaves are only looked at when the state of their run changes)
+	run_md(d, '--max-units', '1')
+	assert index.scan(db, [tree]) == (3, 1, 0)
+	assert dict(leaves(db, d))['1-linear'] == 4
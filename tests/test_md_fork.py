@@ -0,0 +1,64 @@
+# md-fork, from leaves of a run made with fake_vasp.
+
+import os
+import signal
+import shutil
+from os.path import join, exists
+
+import pytest
+
+from helpers import md, make_md_dir, run_md, fake_env, signal_md_during, read_lines
+from vaspmd import md_fork
+
+def fork_arguments(**kw):
+	args = dict(temperature=300, ladder=None, linear_steps=3, nose_steps=3, nve_steps=3,
+		blocksize=3, npar=1, kpar=None, no_zero=True, handoff=md.HANDOFF_COPY, cycles=1,
+		block_sizing=md.BLOCK_SIZING_FIXED, nose_early_stop=False)
+	args.update(kw)
+	return args
+
+# md-init reads the INCAR templates from the current directory.
+@pytest.fixture
+def inputs(tmp_path, monkeypatch):
+	d = make_md_dir(str(tmp_path / 'inputs'))
+	shutil.copyfile(join(d, 'INCAR.part'), join(d, 'INCAR.general'))
+	monkeypatch.chdir(d)
+	return d
+
+def fork(mddir, leaf, outdir, *, stage):
+	md_fork._main(mddir=mddir, leaf=leaf, outdir=outdir, stage=stage, run_arguments=fork_arguments())
+	return md.load_loop_state(join(outdir, 'md.state'))
+
+def test_fork_from_nve_block(tmp_path, inputs):
+	d = make_md_dir(str(tmp_path / 'md'))
+	run_md(d)
+	state = fork(d, '1-nve/002', str(tmp_path / 'fork'), stage=md.STAGE_LINEAR)
+	assert state == (md.START_NUM, md.STAGE_LINEAR, md.read_final_temp(join(d, '1-nve', '002', 'OSZICAR')), None, ())
+	with open(join(d, '1-nve', '002', 'CONTCAR')) as a, open(join(str(tmp_path / 'fork'), 'POSCAR')) as b:
+		assert a.read() == b.read()
+
+# A run whose nose stage was stopped partway, and continued in 1-nose/cont-001.
+@pytest.fixture
+def continued_nose(tmp_path):
+	d = make_md_dir(str(tmp_path / 'md'), **{md.CONF_NOSE_STEPS: 10})
+	env = fake_env(d, FAKE_VASP_STEP_TIME=0.05)
+	signal_md_during(d, join(d, '1-nose', 'OSZICAR'), steps=3, signum=signal.SIGUSR1, env=env)
+	run_md(d, env=env)
+	assert read_lines(join(d, md.VARFILE_MD_ALLDIRS))[:3] == ['1-linear', '1-nose', '1-nose/cont-001']
+	return d
+
+def test_fork_from_continued_stage(tmp_path, inputs, continued_nose):
+	d = continued_nose
+	state = fork(d, '1-nose', str(tmp_path / 'fork'), stage=md.STAGE_LINEAR)
+	# the temperature is that of the segment the CONTCAR came from, not of the first one
+	expected = md.read_final_temp(join(d, '1-nose', 'cont-001', 'OSZICAR'))
+	assert expected != md.read_final_temp(join(d, '1-nose', 'OSZICAR'))
+	assert state[2] == expected
+
+def test_fork_from_continued_stage_without_oszicar_fails(tmp_path, inputs, continued_nose):
+	d = continued_nose
+	os.remove(join(d, '1-nose', 'cont-001', 'OSZICAR'))
+	with pytest.raises(RuntimeError) as info:
+		fork(d, '1-nose', str(tmp_path / 'fork'), stage=md.STAGE_LINEAR)
+	assert 'cont-001: missing OSZICAR' in str(info.value)
+	assert not exists(str(tmp_path / 'fork'))
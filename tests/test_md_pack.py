@@ -0,0 +1,79 @@
+# md-pack, with a fake launcher around fake_vasp.
+
+import os
+import sys
+import subprocess
+from os.path import join
+
+import pytest
+
+from helpers import make_md_dir, run_md, fake_env, is_finished, read_lines, FAKE_VASP_CMD
+from vaspmd import md_pack
+
+# Runs fake_vasp, given SLOTS FIRST LAST.  While it runs, its slice is claimed by a directory
+#  in $PACK_LOG, so that a slice given out twice at once is an error.  Each launch is logged
+#  with the number of launches that were running at the time.
+LAUNCHER = '''#!/bin/sh
+mkdir "$PACK_LOG/running-$2" || exit 1
+echo "$(ls -d "$PACK_LOG"/running-* | wc -l) $1 $2 $3 $PWD" >> "$PACK_LOG/launches"
+{vasp}
+status=$?
+rmdir "$PACK_LOG/running-$2"
+exit $status
+'''
+
+def run_pack(d, *args, env):
+	# (polling much faster than a real md-pack)
+	code = 'from vaspmd import md_pack; md_pack.POLL_INTERVAL = 0.02; md_pack.main()'
+	return subprocess.run([sys.executable, '-c', code] + list(args), cwd=d, env=env, timeout=120,
+		stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+@pytest.fixture
+def pack(tmp_path):
+	d = str(tmp_path)
+	launcher = join(d, 'launch.sh')
+	with open(launcher, 'w') as f:
+		f.write(LAUNCHER.format(vasp=FAKE_VASP_CMD))
+	os.chmod(launcher, 0o755)
+	os.mkdir(join(d, 'log'))
+
+	mddirs = [make_md_dir(join(d, 'run-{}'.format(i))) for i in range(5)]
+	env = fake_env(d, FAKE_VASP_STEP_TIME=0.02, PACK_LOG=join(d, 'log'))
+	return d, mddirs, env, '{} {{slots}} {{first}} {{last}}'.format(launcher)
+
+def test_runs_share_the_budget(pack):
+	d, mddirs, env, launcher = pack
+	# one is already done
+	run_md(mddirs[0])
+
+	p = run_pack(d, '--budget', '5', '--per-run', '2', '--launcher', launcher, *mddirs, env=env)
+	assert p.returncode == 0, p.stdout
+	assert 'md-pack: {}: already finished'.format(mddirs[0]) in p.stdout
+	assert all(is_finished(join(x, 'md.state')) for x in mddirs)
+
+	launches = [line.split() for line in read_lines(join(d, 'log', 'launches'))]
+	# the finished one was not run again
+	assert {os.path.relpath(x[4], d).split(os.sep)[0] for x in launches} == {'run-1', 'run-2', 'run-3', 'run-4'}
+
+	# at most 5 // 2 at a time, each in its own slice
+	assert max(int(x[0]) for x in launches) == 2
+	assert {(x[1], x[2], x[3]) for x in launches} == {('2', '0', '1'), ('2', '2', '3')}
+
+def test_failed_run(pack):
+	d, mddirs, env, launcher = pack
+	p = run_pack(d, '--budget', '4', '--per-run', '4', '--launcher', launcher + ' && false', *mddirs[:2], env=env)
+	assert p.returncode != 0
+	assert 'md-pack: 2 run(s) failed: {} {}'.format(*mddirs[:2]) in p.stdout
+	# one after the other
+	assert [x.split()[0] for x in read_lines(join(d, 'log', 'launches'))] == ['1', '1']
+
+def test_bad_launcher(pack):
+	d, mddirs, env, _ = pack
+	p = run_pack(d, '--budget', '4', '--per-run', '2', '--launcher', 'vasp -n {cores}', *mddirs, env=env)
+	assert p.returncode != 0
+	assert 'bad template' in p.stdout
+	assert not os.path.exists(join(d, 'log', 'launches'))
+
+def test_launcher_cmd():
+	assert md_pack.launcher_cmd('srun -n {slots}', slots=4, share=2) == 'srun -n 4'
+	assert md_pack.launcher_cmd('taskset -c {first}-{last} vasp', slots=4, share=2) == 'taskset -c 8-11 vasp'
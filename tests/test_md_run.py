@@ -0,0 +1,178 @@
+# md-run end to end, with fake_vasp.
+
+import os
+import signal
+from os.path import join, exists
+
+import pytest
+
+from helpers import md, make_md_dir, run_md, run_md_one_unit_at_a_time, is_finished
+from helpers import read_lines, leaf_steps, fake_vasp_runs, fake_env, signal_md_during, read_json
+
+LEAVES = ['1-linear', '1-nose', '1-nve/001', '1-nve/002', '1-nve/003']
+
+@pytest.mark.parametrize('backend', md.STATE_BACKENDS)
+@pytest.mark.parametrize('handoff', md.HANDOFF_MODES)
+def test_one_cycle(tmp_path, handoff, backend):
+	d = make_md_dir(str(tmp_path), handoff=handoff, state_backend=backend)
+	run_md(d)
+
+	assert is_finished(join(d, 'md.state'))
+	assert read_lines(join(d, md.VARFILE_MD_ALLDIRS)) == LEAVES
+	assert leaf_steps(d) == {'1-linear': 3, '1-nose': 3, '1-nve/001': 3, '1-nve/002': 3, '1-nve/003': 1}
+	assert fake_vasp_runs(d) == LEAVES
+	for stage in ['1-linear', '1-nose', '1-nve']:
+		assert exists(join(d, stage, 'CONTCAR'))
+
+	# the CONTCAR of each run is the POSCAR of the next
+	for prev, cur in zip(LEAVES, LEAVES[1:]):
+		with open(join(d, prev, 'CONTCAR')) as a, open(join(d, cur, 'POSCAR')) as b:
+			assert a.read() == b.read()
+
+@pytest.mark.parametrize('backend', md.STATE_BACKENDS)
+@pytest.mark.parametrize('handoff', md.HANDOFF_MODES)
+def test_resume_after_every_unit(tmp_path, handoff, backend):
+	d = make_md_dir(str(tmp_path), handoff=handoff, state_backend=backend, cycles=2)
+	run_md_one_unit_at_a_time(d)
+
+	leaves = LEAVES + [x.replace('1-', '2-') for x in LEAVES]
+	assert read_lines(join(d, md.VARFILE_MD_ALLDIRS)) == leaves
+	# nothing was run twice
+	assert fake_vasp_runs(d) == leaves
+
+def test_finished_run_does_nothing(tmp_path):
+	d = make_md_dir(str(tmp_path))
+	run_md(d)
+	run_md(d)
+	assert fake_vasp_runs(d) == LEAVES
+
+def test_cycles_and_temperature(tmp_path):
+	d = make_md_dir(str(tmp_path), cycles=2, temperature=500)
+	run_md(d)
+	assert len(read_lines(join(d, md.VARFILE_MD_ALLDIRS))) == 2 * len(LEAVES)
+	incar = md.read_incar_values(join(d, '2-linear', 'INCAR'))
+	# the second linear stage starts from where the first cycle ended
+	assert float(incar['TEBEG']) == md.read_final_temp(join(d, '1-nve', '003', 'OSZICAR'))
+
+def test_ladder(tmp_path):
+	d = make_md_dir(str(tmp_path), ladder=[200, 300], cycles=None)
+	run_md(d)
+	assert len(read_lines(join(d, md.VARFILE_MD_ALLDIRS))) == 2 * len(LEAVES)
+	steps = leaf_steps(d)
+	# 3 steps per 200K
+	assert steps['1-linear'] == 3
+	endtemp = md.read_final_temp(join(d, '1-nve', '003', 'OSZICAR'))
+	assert steps['2-linear'] == md.ladder_linear_steps(3, rate_temp=200, from_temp=endtemp, to_temp=300)
+
+def test_ladder_without_zero_is_refused(tmp_path):
+	d = make_md_dir(str(tmp_path), ladder=[200, 300], cycles=None, **{md.CONF_FROM_ZERO: False})
+	p = run_md(d, check=False)
+	assert p.returncode != 0
+	assert "'ladder' requires 'start-from-zero' to be true" in p.stdout
+	assert fake_vasp_runs(d) == []
+
+#-----------------------------------------------------
+# NPAR tuning
+
+def tuning_conf(**kw):
+	return dict({md.CONF_NPAR: md.PAR_AUTO, md.CONF_TUNE_NPAR: [1, 2], md.CONF_TUNE_STEPS: 2}, **kw)
+
+def test_tuning_uses_the_linear_stage(tmp_path):
+	d = make_md_dir(str(tmp_path), **tuning_conf())
+	run_md(d)
+	assert read_json(join(d, md.TUNE_DIR, 'results.json'))['best']['npar'] in [1, 2]
+	incar = md.read_incar_values(join(d, md.TUNE_DIR, '001', 'INCAR'))
+	assert (incar['NSW'], incar['SMASS'], incar['TEBEG']) == ('2', '-1', '300')
+
+# e.g. a run made by md-fork, which begins at NVE
+def test_tuning_uses_the_first_stage_to_run(tmp_path):
+	d = make_md_dir(str(tmp_path), **tuning_conf())
+	md.write_loop_snapshot(join(d, 'md.state'), (md.START_NUM, md.STAGE_NVE, 300.0, None, ()))
+	run_md(d)
+	for trial in ['001', '002']:
+		incar = md.read_incar_values(join(d, md.TUNE_DIR, trial, 'INCAR'))
+		assert (incar['NSW'], incar['SMASS']) == ('2', '-3')
+		assert read_json(join(d, md.TUNE_DIR, trial, md.TUNE_FILE))['stage'] == md.STAGE_NVE
+	assert read_lines(join(d, md.VARFILE_MD_ALLDIRS)) == LEAVES[2:]
+
+#-----------------------------------------------------
+# Handoff in 'move' mode, when a rerun finds the source already gone
+
+# Suspends just before the second NVE block runs, after the WAVECAR of the first was moved to it.
+def suspend_before_second_block(d):
+	run_md(d, '--max-units', '3')
+	assert fake_vasp_runs(d) == LEAVES[:3]
+	assert not exists(join(d, '1-nve', '001', 'WAVECAR'))
+	return join(d, '1-nve', '002', 'WAVECAR')
+
+def test_move_resume(tmp_path):
+	d = make_md_dir(str(tmp_path), handoff=md.HANDOFF_MOVE)
+	suspend_before_second_block(d)
+	run_md(d)
+	assert read_lines(join(d, md.VARFILE_MD_ALLDIRS)) == LEAVES
+	assert fake_vasp_runs(d) == LEAVES
+
+def test_move_resume_with_lost_wavecar_fails(tmp_path):
+	d = make_md_dir(str(tmp_path), handoff=md.HANDOFF_MOVE)
+	os.remove(suspend_before_second_block(d))
+
+	p = run_md(d, check=False)
+	assert p.returncode != 0
+	assert '001/WAVECAR was moved to 002/WAVECAR, which is now missing' in p.stdout
+
+def test_move_resume_with_truncated_wavecar_fails(tmp_path):
+	d = make_md_dir(str(tmp_path), handoff=md.HANDOFF_MOVE)
+	with open(suspend_before_second_block(d), 'r+b') as f:
+		f.truncate(100) # as though vasp was killed while writing it
+
+	p = run_md(d, check=False)
+	assert p.returncode != 0
+	assert 'which is now 100 bytes rather than 4096' in p.stdout
+
+def test_missing_source_without_record_fails(tmp_path):
+	d = make_md_dir(str(tmp_path), handoff=md.HANDOFF_COPY)
+	run_md(d, '--max-units', '2')
+	os.remove(join(d, '1-nose', 'WAVECAR'))
+	os.remove(join(d, '1-nve', 'WAVECAR'))
+
+	p = run_md(d, check=False)
+	assert p.returncode != 0
+	assert 'cannot hand off 1-nose/WAVECAR: neither it nor 1-nve/WAVECAR exists' in p.stdout
+
+#-----------------------------------------------------
+# Stopping on a signal
+
+@pytest.mark.parametrize('scratch', [False, True])
+def test_signal_splits_nve_block(tmp_path, scratch):
+	conf = {md.CONF_BLOCKSIZE: 10, md.CONF_NVE_STEPS: 35}
+	scratch_dir = str(tmp_path / 'scratch')
+	if scratch:
+		os.mkdir(scratch_dir)
+		conf.update({md.CONF_SCRATCH: scratch_dir, md.CONF_SCRATCH_SYNC: 0.05})
+	d = make_md_dir(str(tmp_path / 'md'), **conf)
+	env = fake_env(d, FAKE_VASP_STEP_TIME=0.05)
+
+	out = signal_md_during(d, join(d, '1-nve', '002', 'OSZICAR'), steps=6, signum=signal.SIGUSR1, env=env)
+	assert 'suspended: received SIGUSR1' in out
+	assert not is_finished(join(d, 'md.state'))
+	# vasp stops after the step it is on when the STOPCAR appears
+	stopped = md.count_completed_steps(join(d, '1-nve', '002', 'OSZICAR'))
+	assert 6 <= stopped < 10
+	assert not exists(join(d, '1-nve', '003', 'OSZICAR')) # (it is set up, but not run)
+	if scratch:
+		assert os.listdir(scratch_dir) == []
+
+	run_md(d, env=env)
+	assert is_finished(join(d, 'md.state'))
+	blocks = ['1-nve/{:03d}'.format(i) for i in range(1, 6)]
+	assert read_lines(join(d, md.VARFILE_MD_ALLDIRS)) == ['1-linear', '1-nose'] + blocks
+	# the rest of the interrupted block is a block of its own, and the blocks after it are unchanged
+	sizes = [leaf_steps(d)[b] for b in blocks]
+	assert sizes == [10, stopped, 10 - stopped, 10, 5]
+	assert sum(sizes) == 35
+	for leaf in blocks:
+		assert not exists(join(d, leaf, 'STOPCAR'))
+	if scratch:
+		assert os.listdir(scratch_dir) == []
+	else:
+		assert fake_vasp_runs(d) == ['1-linear', '1-nose'] + blocks
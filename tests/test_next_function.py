@@ -0,0 +1,208 @@
+# next-function, and the parsing of trial output behind it (Trial, ParsedCache).
+
+import os
+import json
+from os.path import join
+
+import numpy as np
+import pytest
+
+from helpers import md, make_search_dir, run_search, read_lines, read_json
+from vaspmd import search
+
+# A parser that counts its calls.
+class CountingParser:
+	__name__ = 'CountingParser'
+
+	def __init__(self):
+		self.calls = 0
+
+	def __call__(self, path):
+		self.calls += 1
+		with open(path) as f:
+			return f.read()
+
+@pytest.fixture
+def parsed_file(tmp_path):
+	path = str(tmp_path / 'OSZICAR')
+	with open(path, 'w') as f:
+		f.write('one\n')
+	return path
+
+def test_parsed_cache_reuses_entries(tmp_path, parsed_file):
+	cache = search.ParsedCache(str(tmp_path / 'search.parsed'))
+	parser = CountingParser()
+	assert cache.get(parsed_file, parser) == 'one\n'
+	assert cache.get(parsed_file, parser) == 'one\n'
+	assert parser.calls == 1
+
+	# through a symlink, as for trials from the trial cache
+	os.symlink(parsed_file, str(tmp_path / 'link'))
+	assert cache.get(str(tmp_path / 'link'), parser) == 'one\n'
+	assert parser.calls == 1
+
+def test_parsed_cache_sees_changes(tmp_path, parsed_file):
+	cache = search.ParsedCache(str(tmp_path / 'search.parsed'))
+	parser = CountingParser()
+	cache.get(parsed_file, parser)
+
+	# same size, new mtime
+	st = os.stat(parsed_file)
+	with open(parsed_file, 'w') as f:
+		f.write('two\n')
+	os.utime(parsed_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+	assert cache.get(parsed_file, parser) == 'two\n'
+	assert parser.calls == 2
+
+	# same mtime, new size
+	st = os.stat(parsed_file)
+	with open(parsed_file, 'w') as f:
+		f.write('three\n')
+	os.utime(parsed_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+	assert cache.get(parsed_file, parser) == 'three\n'
+	assert parser.calls == 3
+
+def test_parsed_cache_survives_a_restart(tmp_path, parsed_file):
+	path = str(tmp_path / 'search.parsed')
+	cache = search.ParsedCache(path)
+	cache.get(parsed_file, CountingParser())
+	cache.save()
+
+	parser = CountingParser()
+	assert search.ParsedCache(path).get(parsed_file, parser) == 'one\n'
+	assert parser.calls == 0
+
+	# a damaged cache is simply started over
+	with open(path, 'wb') as f:
+		f.write(b'garbage')
+	assert search.ParsedCache(path).get(parsed_file, parser) == 'one\n'
+	assert parser.calls == 1
+
+#-----------------------------------------------------
+
+POSCAR_LINES = [
+	'comment',
+	'2.0',
+	'2.0 0.0 0.0',
+	'0.0 2.0 0.0',
+	'0.0 0.0 3.0',
+]
+
+def write(path, lines):
+	with open(path, 'w') as f:
+		f.write('\n'.join(lines) + '\n')
+	return path
+
+def test_parse_poscar_direct(tmp_path):
+	path = write(str(tmp_path / 'POSCAR'), POSCAR_LINES + ['Si O', '1 2', 'Direct', '0 0 0', '0.5 0.5 0.5', '0.25 0 0.75'])
+	poscar = search.parse_poscar(path)
+	assert np.allclose(poscar['cell'], np.diag([4, 4, 6]))
+	assert poscar['species'] == ['Si', 'O']
+	assert poscar['counts'] == [1, 2]
+	assert np.allclose(poscar['frac'], [[0, 0, 0], [0.5, 0.5, 0.5], [0.25, 0, 0.75]])
+
+def test_parse_poscar_cartesian_without_species(tmp_path):
+	# (vasp 4 style, with selective dynamics)
+	path = write(str(tmp_path / 'POSCAR'), POSCAR_LINES + ['1 1', 'Selective dynamics', 'Cartesian',
+		'1 1 1 T T T', '0.5 0 0 F F F'])
+	poscar = search.parse_poscar(path)
+	assert poscar['species'] is None
+	assert poscar['counts'] == [1, 1]
+	# cartesian coordinates are scaled too
+	assert np.allclose(poscar['frac'], [[0.5, 0.5, 1/3], [0.25, 0, 0]])
+
+def test_parse_poscar_volume(tmp_path):
+	lines = list(POSCAR_LINES)
+	lines[1] = '-96.0' # (the cell is 2 x 2 x 3, so scaled by 2)
+	path = write(str(tmp_path / 'POSCAR'), lines + ['H', '1', 'Direct', '0 0 0'])
+	assert np.allclose(search.parse_poscar(path)['cell'], np.diag([4, 4, 6]))
+
+def test_parse_oszicar_of_a_relaxation(tmp_path):
+	path = write(str(tmp_path / 'OSZICAR'), [
+		'       N       E                     dE             d eps       ncg     rms          rms(c)',
+		'DAV:   1    -0.12345678E+03   -0.12345E+03   -0.12345E+03  1234   0.123E+02',
+		'   1 F= -.12345678E+03 E0= -.12345600E+03  d E =-.123456E+03  mag=     2.0000',
+		'DAV:   1    -0.12345678E+03   -0.12345E+03   -0.12345E+03  1234   0.123E+02',
+		'   2 F= -.12355678E+03 E0= -.12355600E+03  d E =-.100000E-00',
+	])
+	data = search.parse_oszicar(path)
+	assert list(data['step']) == [1, 2]
+	assert list(data['F']) == [-123.45678, -123.55678]
+	assert list(data['dE']) == [-123.456, -0.1]
+	assert data['mag'][0] == 2.0 and np.isnan(data['mag'][1])
+
+#-----------------------------------------------------
+# With fake_vasp
+
+# Records what it was given in ../calls.jsonl, and narrows to the second tenth of the range,
+#  or fails if there is a file ../FAIL (after looking at every trial).
+NEXT_MODULE = '''
+import os
+import json
+
+def narrow(trials):
+	call = {
+		'names': [t.name for t in trials],
+		'values': [t.value for t in trials],
+		'energies': [t.energy for t in trials],
+		'natoms': [sum(t.structure['counts']) for t in trials],
+	}
+	with open('../calls.jsonl', 'a') as f:
+		f.write(json.dumps(call) + '\\n')
+	if os.path.exists('../FAIL'):
+		raise RuntimeError('asked to fail')
+
+	lo, hi = min(call['values']), max(call['values'])
+	return lo + 0.1 * (hi - lo), lo + 0.2 * (hi - lo)
+'''
+
+@pytest.fixture
+def next_function_dir(tmp_path):
+	d = make_search_dir(str(tmp_path), max_depth=2, cmd_next=None, next_function='nextmod:narrow')
+	with open(join(d, 'nextmod.py'), 'w') as f:
+		f.write(NEXT_MODULE)
+	return d
+
+def read_calls(d):
+	return [json.loads(line) for line in read_lines(join(d, 'calls.jsonl'))]
+
+def trial_values(d, depth):
+	return [float(read_lines(join(d, 'set-{:03d}'.format(depth), name, 'value'))[0]) for name in ['001', '002', '003', '004']]
+
+def test_next_function_chooses_the_range(next_function_dir):
+	d = next_function_dir
+	run_search(d)
+
+	calls = read_calls(d)
+	assert len(calls) == 2
+	assert calls[0]['names'] == ['001', '002', '003', '004']
+	assert calls[0]['values'] == pytest.approx([0, 1/3, 2/3, 1])
+	assert calls[0]['natoms'] == [4] * 4
+	for name, energy in zip(calls[0]['names'], calls[0]['energies']):
+		assert energy == md.read_last_oszicar_step(join(d, 'set-001', name, 'OSZICAR')).F
+
+	# the range it returned is used for the next depth, and as the final range
+	assert trial_values(d, 2) == pytest.approx(list(np.linspace(0.1, 0.2, 4)))
+	assert calls[1]['values'] == pytest.approx(trial_values(d, 2))
+	result = read_json(join(d, 'search.result'))
+	assert (result['minval'], result['maxval']) == (pytest.approx(0.11), pytest.approx(0.12))
+
+def test_parsed_output_survives_a_failed_next_function(next_function_dir):
+	d = next_function_dir
+	open(join(d, 'FAIL'), 'w').close()
+	p = run_search(d, check=False)
+	assert p.returncode != 0
+	assert 'asked to fail' in p.stdout
+
+	# what it parsed before failing was saved, and is what a rerun gets
+	cache = search.ParsedCache(join(d, search.VARFILE_PARSED))
+	def no_parsing(path):
+		raise AssertionError('parsed again: ' + path)
+	no_parsing.__name__ = 'parse_oszicar'
+	for name in ['001', '002', '003', '004']:
+		assert cache.get(join(d, 'set-001', name, 'OSZICAR'), no_parsing)['step'][-1] == 3
+
+	os.remove(join(d, 'FAIL'))
+	run_search(d)
+	assert len(read_calls(d)) == 3
+	assert read_json(join(d, 'search.result'))['minval'] == pytest.approx(0.11)
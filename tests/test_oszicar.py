@@ -0,0 +1,79 @@
+# Reading OSZICARs (read_last_oszicar_step, read_oszicar_arrays).
+
+import numpy as np
+import pytest
+
+from helpers import md
+
+def dav_line(i):
+	return 'DAV: {:3d}    -0.10000000000E+03   -0.10000E+03   -0.10000E+03  64   0.100E+00\n'.format(i)
+
+def step_line(step):
+	return '{:6d} T= {:6.0f}. E= {:.8E} F= {:.8E} E0= {:.8E}  EK= {:.5E} SP= {:.2E} SK= {:.2E}\n'.format(
+		step, 300 + step, -100.0 - step, -101.0 - step, -102.0, 1.5, 0.12, 0.03)
+
+def oszicar_text(nsteps, ndav=3):
+	return ''.join(''.join(dav_line(i) for i in range(1, ndav + 1)) + step_line(step) for step in range(1, nsteps + 1))
+
+@pytest.fixture
+def oszicar(tmp_path):
+	def write(text):
+		path = str(tmp_path / 'OSZICAR')
+		with open(path, 'w') as f:
+			f.write(text)
+		return path
+	return write
+
+# (a step line is 119 bytes, so small chunks split it, and the lines around it, every which way)
+@pytest.mark.parametrize('chunksize', [1, 7, 50, 118, 119, 120, 200, 1 << 14])
+def test_last_step_across_chunks(oszicar, chunksize):
+	path = oszicar(oszicar_text(5))
+	last = md.read_last_oszicar_step(path, chunksize=chunksize)
+	assert last == md.parse_oszicar_step(step_line(5))
+	assert (last.step, last.T, last.F) == (5, 305, -106)
+
+# the last step line is followed by enough DAV lines to fill several chunks
+@pytest.mark.parametrize('chunksize', [16, 100, 1 << 14])
+def test_last_step_before_many_dav_lines(oszicar, chunksize):
+	path = oszicar(oszicar_text(2) + ''.join(dav_line(i) for i in range(40)))
+	assert md.read_last_oszicar_step(path, chunksize=chunksize).step == 2
+
+@pytest.mark.parametrize('chunksize', [7, 1 << 14])
+@pytest.mark.parametrize('partial', [
+	step_line(6)[:20],           # cut off in the middle of a step line
+	step_line(6).rstrip('\n'),   # a whole step line, but not yet its newline
+	dav_line(1)[:10],
+])
+def test_file_ending_mid_line(oszicar, chunksize, partial):
+	path = oszicar(oszicar_text(5) + partial)
+	assert md.read_last_oszicar_step(path, chunksize=chunksize).step == 5
+	assert list(md.read_oszicar_arrays(path)['step']) == [1, 2, 3, 4, 5]
+
+@pytest.mark.parametrize('chunksize', [7, 1 << 14])
+def test_only_dav_lines(oszicar, chunksize):
+	path = oszicar(''.join(dav_line(i) for i in range(1, 30)))
+	assert md.read_last_oszicar_step(path, chunksize=chunksize) is None
+	assert md.count_completed_steps(path) == 0
+	data = md.read_oszicar_arrays(path)
+	assert set(data) == {'step'} | set(md.OSZICAR_FIELDS)
+	assert all(len(x) == 0 for x in data.values())
+
+@pytest.mark.parametrize('text', ['', step_line(1)[:30]])
+def test_no_complete_lines(oszicar, text):
+	path = oszicar(text)
+	assert md.read_last_oszicar_step(path, chunksize=7) is None
+	assert len(md.read_oszicar_arrays(path)['step']) == 0
+
+def test_read_oszicar_arrays(oszicar):
+	path = oszicar(oszicar_text(4))
+	data = md.read_oszicar_arrays(path)
+	assert list(data['step']) == [1, 2, 3, 4]
+	assert list(data['T']) == [301, 302, 303, 304]
+	assert list(data['F']) == [-102, -103, -104, -105]
+	assert data['step'].dtype.kind == 'i'
+
+def test_missing_fields_are_nan(oszicar):
+	path = oszicar('     1 T=   300. E= -.10000000E+03 F= -.10100000E+03\n')
+	data = md.read_oszicar_arrays(path)
+	assert data['F'][0] == -101
+	assert np.isnan(data['E0'][0]) and np.isnan(data['SK'][0])
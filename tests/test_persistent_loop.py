@@ -0,0 +1,203 @@
+# persistent_loop, and especially the journal backend, which must survive being killed at any
+#  point.
+
+import os
+import pickle
+import random
+
+import pytest
+
+from helpers import md
+from vaspmd.md import persistent_loop, read_loop_journal, load_loop_state, EndLoop
+from vaspmd.md import diff_loop_state, apply_loop_delta, STATE_BACKENDS, STATE_BACKEND_JOURNAL
+
+class Interrupt(Exception):
+	pass
+
+# A loop with the kinds of state md-run has:  a counter, a value that is replaced, and tuples
+#  and lists that grow.  Records each state it is called with in `seen`.
+# Raises Interrupt when called with i == interrupt_at.
+def make_iter(n, *, seen, interrupt_at=None):
+	def do_iter(i=0, temp=0.0, leaves=(), sizes=[], name=None): # pylint: disable=dangerous-default-value
+		if i == interrupt_at:
+			raise Interrupt()
+		seen.append((i, temp, leaves, sizes, name))
+		if i == n:
+			return EndLoop(leaves)
+		if i % 4 == 3:
+			return i + 1, temp, leaves, sizes, name # nothing but the counter changes
+		return i + 1, temp + 1.5, leaves + ('leaf-{}'.format(i),), list(sizes) + [i], 'dir-{}'.format(i % 3)
+	return do_iter
+
+# The states that an uninterrupted loop is called with, and its EndLoop.
+def expected_states(n):
+	seen = []
+	do_iter = make_iter(n, seen=seen)
+	state = ()
+	while not isinstance(state, EndLoop):
+		state = do_iter(*state)
+	return seen, state
+
+def test_diff_round_trip():
+	rng = random.Random(0)
+	old = (1, 'a', ('x',), [1, 2], None)
+	for _ in range(200):
+		new = (
+			rng.randrange(5),
+			rng.choice(['a', 'b']),
+			old[2] + tuple('y' * rng.randrange(3)) if rng.random() < 0.8 else ('z',),
+			old[3] + [rng.random()] if rng.random() < 0.8 else [],
+			rng.choice([None, 'dir', old[4]]),
+		)
+		delta = diff_loop_state(old, new)
+		assert apply_loop_delta(old, delta) == new
+		old = new
+
+	assert diff_loop_state((1, 2), EndLoop(3)) is None
+	assert diff_loop_state((1, 2), (1, 2, 3)) is None
+
+@pytest.mark.parametrize('backend', STATE_BACKENDS)
+def test_uninterrupted(tmp_path, backend):
+	seen = []
+	result = persistent_loop(make_iter(20, seen=seen), str(tmp_path / 'loop.state'), backend=backend)
+	expected, end = expected_states(20)
+	assert seen == expected
+	assert result == end.value
+	assert isinstance(load_loop_state(str(tmp_path / 'loop.state')), EndLoop)
+
+@pytest.mark.parametrize('backend', STATE_BACKENDS)
+@pytest.mark.parametrize('compact_every', [1, 3, 100])
+def test_interrupt_and_resume(tmp_path, backend, compact_every):
+	path = str(tmp_path / 'loop.state')
+	expected, end = expected_states(20)
+
+	seen = []
+	for interrupt_at in [5, 6, 13]:
+		with pytest.raises(Interrupt):
+			persistent_loop(make_iter(20, seen=seen, interrupt_at=interrupt_at), path,
+				backend=backend, compact_every=compact_every)
+		# the state on disk is the one that the interrupted iteration was called with
+		assert load_loop_state(path) == expected[interrupt_at]
+
+	result = persistent_loop(make_iter(20, seen=seen), path, backend=backend, compact_every=compact_every)
+	assert result == end.value
+	# every iteration ran exactly once
+	assert seen == expected
+
+@pytest.mark.parametrize('first, second', [('pickle', 'journal'), ('journal', 'pickle')])
+def test_switch_backends(tmp_path, first, second):
+	path = str(tmp_path / 'loop.state')
+	seen = []
+	with pytest.raises(Interrupt):
+		persistent_loop(make_iter(10, seen=seen, interrupt_at=4), path, backend=first)
+	persistent_loop(make_iter(10, seen=seen), path, backend=second)
+	assert seen == expected_states(10)[0]
+
+def test_compaction(tmp_path):
+	path = str(tmp_path / 'loop.state')
+	with pytest.raises(Interrupt):
+		persistent_loop(make_iter(50, seen=[], interrupt_at=37), path, backend=STATE_BACKEND_JOURNAL, compact_every=10)
+	state, seq, nrecords, end = read_loop_journal(path)
+	assert state == expected_states(50)[0][37]
+	assert seq == 37
+	# Once the journal reaches 10 records (a snapshot and 9 deltas), it is replaced by a
+	#  snapshot; i.e. at 9, 18, 27 and 36.  So this is the snapshot at 36 and one delta.
+	assert nrecords == 2
+	assert end == os.path.getsize(path)
+
+#-----------------------------------------------------
+# Torn writes
+
+# Offsets just past each record of a journal.
+def record_boundaries(path):
+	out = []
+	with open(path, 'rb') as f:
+		while True:
+			try:
+				pickle.load(f)
+			except EOFError:
+				return out
+			out.append(f.tell())
+
+def write_interrupted_journal(path, n=12, interrupt_at=9):
+	with pytest.raises(Interrupt):
+		persistent_loop(make_iter(n, seen=[], interrupt_at=interrupt_at), path,
+			backend=STATE_BACKEND_JOURNAL, compact_every=1000)
+
+def test_truncated_at_every_offset(tmp_path):
+	path = str(tmp_path / 'loop.state')
+	write_interrupted_journal(path)
+	# (the first record is the initial state, which is empty, since the loop uses its defaults)
+	expected = [()] + expected_states(12)[0][1:]
+	boundaries = record_boundaries(path)
+	assert len(boundaries) == 10 # the snapshot, and one delta per iteration
+	assert boundaries[-1] == os.path.getsize(path)
+
+	with open(path, 'rb') as f:
+		data = f.read()
+	torn = str(tmp_path / 'torn.state')
+	for offset in range(len(data) + 1):
+		with open(torn, 'wb') as f:
+			f.write(data[:offset])
+
+		complete = [b for b in boundaries if b <= offset]
+		if not complete:
+			with pytest.raises(RuntimeError):
+				read_loop_journal(torn)
+			continue
+		state, seq, nrecords, end = read_loop_journal(torn)
+		assert state == expected[len(complete) - 1], offset
+		assert (seq, nrecords, end) == (len(complete) - 1, len(complete), complete[-1])
+
+@pytest.mark.parametrize('cut', [1, 7, 'half'])
+def test_resume_from_torn_record(tmp_path, cut):
+	path = str(tmp_path / 'loop.state')
+	write_interrupted_journal(path)
+	boundaries = record_boundaries(path)
+	# cut into the last record, as if killed while writing it
+	last = boundaries[-1] - boundaries[-2]
+	os.truncate(path, boundaries[-1] - (last // 2 if cut == 'half' else cut))
+
+	expected, end = expected_states(12)
+	seen = []
+	result = persistent_loop(make_iter(12, seen=seen), path, backend=STATE_BACKEND_JOURNAL, compact_every=1000)
+	assert result == end.value
+	# the torn record is discarded, so the iteration that wrote it runs again
+	assert seen == expected[8:]
+	assert record_boundaries(path)[-1] == os.path.getsize(path)
+
+def test_garbage_after_last_record(tmp_path):
+	path = str(tmp_path / 'loop.state')
+	write_interrupted_journal(path)
+	good = read_loop_journal(path)
+	with open(path, 'ab') as f:
+		f.write(b'\x80\x04\x95garbage')
+	assert read_loop_journal(path) == good
+
+def test_gap_in_sequence(tmp_path):
+	path = str(tmp_path / 'loop.state')
+	write_interrupted_journal(path)
+	state, seq, nrecords, end = read_loop_journal(path)
+	with open(path, 'ab') as f:
+		pickle.dump((md.JOURNAL_TAG, seq + 2, md.JOURNAL_DELTA, [('!', 99)] * len(state)), f)
+	assert read_loop_journal(path) == (state, seq, nrecords, end)
+
+#-----------------------------------------------------
+
+@pytest.mark.parametrize('fsync_every', [0, 1, 3])
+def test_fsync_batching(tmp_path, monkeypatch, fsync_every):
+	calls = []
+	real_fsync = os.fsync
+	def fsync(fd):
+		calls.append(fd)
+		real_fsync(fd)
+	monkeypatch.setattr(os, 'fsync', fsync)
+
+	path = str(tmp_path / 'loop.state')
+	persistent_loop(make_iter(10, seen=[]), path, backend=STATE_BACKEND_JOURNAL,
+		fsync_every=fsync_every, compact_every=1000)
+
+	# The initial snapshot is always synced.  Then there are 11 records (10 iterations, and the
+	#  EndLoop), of which every `fsync_every`-th is synced.
+	records = 11
+	assert len(calls) == 1 + (records // fsync_every if fsync_every else 0)
@@ -0,0 +1,82 @@
+# Post-block hooks (PostBlockWork), with fake_vasp.
+
+import os
+from os.path import join
+
+import pytest
+
+from helpers import md, make_md_dir, run_md, fake_env, is_finished, read_lines, run_md_one_unit_at_a_time
+
+LEAVES = ['1-linear', '1-nose', '1-nve/001', '1-nve/002', '1-nve/003']
+
+# Appends "LEAF STAGE" to hooks.log in the md directory.
+LOG_HOOK = 'echo "$VASPMD_LEAF $VASPMD_STAGE" >> "$VASPMD_MDDIR/hooks.log"'
+# Fails unless the md directory has a file named OK.
+CHECK_HOOK = 'test -e "$VASPMD_MDDIR/OK"'
+
+def hook_dir(tmp_path, hooks, **conf):
+	return make_md_dir(str(tmp_path), **dict({md.CONF_POST_BLOCK_HOOKS: hooks}, **conf))
+
+def hook_log(d):
+	path = join(d, 'hooks.log')
+	return read_lines(path) if os.path.exists(path) else []
+
+def done_hooks(d, leaf):
+	return read_lines(join(d, leaf, md.POST_BLOCK_DONE))
+
+def expected_log(leaves):
+	return ['{} {}'.format(leaf, md.parse_stage_dir_name(leaf.split('/')[0])[1]) for leaf in leaves]
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_hooks_run_once_per_leaf(tmp_path, workers):
+	d = hook_dir(tmp_path, [LOG_HOOK], **{md.CONF_POST_BLOCK_WORKERS: workers})
+	run_md(d)
+	assert is_finished(join(d, 'md.state'))
+	assert sorted(hook_log(d)) == sorted(expected_log(LEAVES))
+	for leaf in LEAVES:
+		assert done_hooks(d, leaf) == [LOG_HOOK]
+
+	# nothing is left to do
+	run_md(d)
+	assert len(hook_log(d)) == len(LEAVES)
+
+def test_hooks_are_not_rerun_after_a_restart(tmp_path):
+	d = hook_dir(tmp_path, [LOG_HOOK])
+	run_md_one_unit_at_a_time(d)
+	assert hook_log(d) == expected_log(LEAVES)
+
+def test_done_hooks_are_skipped(tmp_path):
+	d = hook_dir(tmp_path, [LOG_HOOK, CHECK_HOOK])
+	p = run_md(d, check=False)
+	assert p.returncode != 0
+	assert 'post-block task failed' in p.stdout
+	assert '{} post-block task(s) failed'.format(len(LEAVES)) in p.stdout
+	# the run itself went on to the end
+	assert is_finished(join(d, 'md.state'))
+	for leaf in LEAVES:
+		assert done_hooks(d, leaf) == [LOG_HOOK]
+
+	# the failed hook is retried, but not the one before it
+	open(join(d, 'OK'), 'w').close()
+	p = run_md(d)
+	assert 'post-block task failed' not in p.stdout
+	assert sorted(hook_log(d)) == sorted(expected_log(LEAVES))
+	for leaf in LEAVES:
+		assert done_hooks(d, leaf) == [LOG_HOOK, CHECK_HOOK]
+
+def test_failed_hook_is_retried_by_the_next_unit(tmp_path):
+	d = hook_dir(tmp_path, [CHECK_HOOK, LOG_HOOK])
+	# (a suspended md-run reports failures, but leaves them to the next one)
+	p = run_md(d, '--max-units', '2')
+	assert p.stdout.count('post-block task failed') == 2
+	assert 'suspended: ran 2 units' in p.stdout
+	assert hook_log(d) == []
+
+	open(join(d, 'OK'), 'w').close()
+	run_md(d, '--max-units', '1')
+	# the first two leaves catch up, along with the one that this md-run ran
+	assert sorted(hook_log(d)) == sorted(expected_log(LEAVES[:3]))
+	assert not os.path.exists(join(d, LEAVES[3], 'OSZICAR'))
+
+	run_md(d)
+	assert sorted(hook_log(d)) == sorted(expected_log(LEAVES))
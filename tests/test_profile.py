@@ -0,0 +1,69 @@
+# md-profile, on the event logs of md-run and vasp-search with fake_vasp.
+
+import sys
+import json
+import subprocess
+from os.path import join
+
+import pytest
+
+from helpers import md, make_md_dir, run_md, make_search_dir, run_search, fake_env, fake_vasp_runs
+from vaspmd import md_profile, search
+
+def run_profile(path, *args):
+	return subprocess.run([sys.executable, '-c', 'from vaspmd.md_profile import main; main()', path] + list(args),
+		check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+
+def kind_totals(rows):
+	out = {}
+	for _, totals in rows:
+		for kind, (count, wall, nbytes) in totals.items():
+			c, w, b = out.get(kind, (0, 0.0, 0))
+			out[kind] = (c + count, w + wall, b + nbytes)
+	return out
+
+def fake_vasp_log(d):
+	with open(join(d, 'fake-vasp.log')) as f:
+		return [json.loads(line) for line in f]
+
+def test_md_run_profile(tmp_path):
+	d = make_md_dir(str(tmp_path))
+	run_md(d, env=fake_env(d, FAKE_VASP_STEP_TIME=0.02))
+	events = md_profile.read_events(md_profile.event_log_path(d))
+
+	by_stage = md_profile.summarize(events, key=lambda ev: md_profile.path_prefix(ev['where'], 1))
+	by_block = md_profile.summarize(events, key=lambda ev: md_profile.path_prefix(ev['where'], 2))
+	assert sorted(group for (group, _) in by_stage) == ['.', '1-linear', '1-nose', '1-nve']
+	assert sorted(group for (group, _) in by_block) == ['.', '1-linear', '1-nose', '1-nve', '1-nve/001', '1-nve/002', '1-nve/003']
+
+	# every event is counted once, under its kind, in either table
+	totals = kind_totals(by_stage)
+	for kind, (count, wall, nbytes) in kind_totals(by_block).items():
+		assert totals[kind][0] == count
+		assert totals[kind][1] == pytest.approx(wall)
+		assert totals[kind][2] == nbytes
+	assert sum(count for (count, _, _) in totals.values()) == len(events)
+	assert sum(wall for (_, wall, _) in totals.values()) == pytest.approx(sum(ev['wall'] for ev in events))
+
+	# one vasp event per vasp run, each lasting at least as long as the run itself
+	runs = fake_vasp_log(d)
+	assert totals['vasp'][0] == len(runs) == 5
+	assert totals['vasp'][1] >= sum(r['end'] - r['start'] for r in runs)
+	assert {kind for kind in totals} >= {'vasp', 'copy', 'state-save', 'setup'}
+	assert totals['copy'][2] > 0 # (WAVECARs, among others)
+
+	out = run_profile(d)
+	assert out.splitlines()[0].split()[:2] == ['stage', 'total']
+	assert '1-nve/003' in out
+
+def test_search_profile(tmp_path):
+	d = make_search_dir(str(tmp_path), max_depth=2)
+	run_search(d)
+	events = md_profile.read_events(md_profile.event_log_path(d))
+	assert md_profile.event_log_path(d) == join(d, search.VARFILE_EVENTS)
+
+	totals = kind_totals(md_profile.summarize(events, key=lambda ev: md_profile.path_prefix(ev['where'], 1)))
+	assert totals['vasp'][0] == len(fake_vasp_runs(d)) == 8
+	assert totals['subprocess'][0] == 8 + 2 # cmd-init for each trial, cmd-next for each depth
+	assert sum(count for (count, _, _) in totals.values()) == len(events)
+	assert 'set-002' in run_profile(d, '--no-blocks')
@@ -0,0 +1,107 @@
+# ScratchRun, and md-run with scratch staging.
+
+import os
+from os.path import join, exists
+
+import pytest
+
+from helpers import md, make_md_dir, run_md, fake_env, is_finished, leaf_steps, FAKE_VASP_CMD
+
+class VaspFailed(Exception):
+	pass
+
+@pytest.fixture
+def leaf(tmp_path, monkeypatch):
+	leaf = tmp_path / 'leaf'
+	leaf.mkdir()
+	(tmp_path / 'scratch').mkdir()
+	(leaf / 'INCAR').write_text('NSW = 3\n')
+	(leaf / 'OSZICAR').write_text('from an earlier sync\n')
+	monkeypatch.chdir(leaf)
+	return str(leaf)
+
+def scratch_of(leaf):
+	return join(os.path.dirname(leaf), 'scratch')
+
+# Makes copies back to the leaf directory differ from their originals.
+@pytest.fixture
+def bad_copies(monkeypatch):
+	real_copy_file = md.copy_file
+	def copy_file(src, dest):
+		real_copy_file(src, dest)
+		if dest.endswith('.sync-tmp'):
+			with open(dest, 'a') as f:
+				f.write('garbage')
+	monkeypatch.setattr(md, 'copy_file', copy_file)
+
+def read(path):
+	with open(path) as f:
+		return f.read()
+
+def test_outputs_are_synced_back(leaf):
+	with md.ScratchRun(scratch_of(leaf), sync_interval=1000) as rundir:
+		assert rundir.startswith(scratch_of(leaf))
+		assert read(join(rundir, 'INCAR')) == 'NSW = 3\n'
+		with open(join(rundir, 'OSZICAR'), 'w') as f:
+			f.write('new\n')
+		with open(join(rundir, 'CONTCAR'), 'w') as f:
+			f.write('contcar\n')
+
+	assert read(join(leaf, 'OSZICAR')) == 'new\n'
+	assert read(join(leaf, 'CONTCAR')) == 'contcar\n'
+	assert os.listdir(scratch_of(leaf)) == []
+
+def test_bad_copy_does_not_replace_the_leaf_copy(leaf, bad_copies):
+	with pytest.raises(RuntimeError) as info:
+		with md.ScratchRun(scratch_of(leaf), sync_interval=1000) as rundir:
+			with open(join(rundir, 'OSZICAR'), 'w') as f:
+				f.write('new\n')
+
+	assert 'could not sync the outputs of vasp back from {}'.format(rundir) in str(info.value)
+	assert 'differs from the original' in str(info.value.__cause__)
+	# the leaf directory keeps what it had, and nothing half-synced
+	assert read(join(leaf, 'OSZICAR')) == 'from an earlier sync\n'
+	assert sorted(os.listdir(leaf)) == ['INCAR', 'OSZICAR']
+	# and the scratch directory is left for a human to recover from
+	assert read(join(rundir, 'OSZICAR')) == 'new\n'
+
+def test_failed_vasp_is_synced_and_cleaned_up(leaf):
+	with pytest.raises(VaspFailed):
+		with md.ScratchRun(scratch_of(leaf), sync_interval=1000) as rundir:
+			with open(join(rundir, 'OSZICAR'), 'w') as f:
+				f.write('partial\n')
+			raise VaspFailed()
+
+	assert read(join(leaf, 'OSZICAR')) == 'partial\n'
+	assert os.listdir(scratch_of(leaf)) == []
+
+def test_failed_vasp_with_bad_copy_reports_vasp_error(leaf, bad_copies, capsys):
+	with pytest.raises(VaspFailed):
+		with md.ScratchRun(scratch_of(leaf), sync_interval=1000) as rundir:
+			with open(join(rundir, 'OSZICAR'), 'w') as f:
+				f.write('partial\n')
+			raise VaspFailed()
+
+	assert 'could not sync the outputs of vasp back from {}'.format(rundir) in capsys.readouterr().out
+	assert read(join(leaf, 'OSZICAR')) == 'from an earlier sync\n'
+	assert os.listdir(scratch_of(leaf)) == [os.path.basename(rundir)]
+
+#-----------------------------------------------------
+
+def test_md_run_with_failing_vasp_leaves_no_scratch(tmp_path):
+	scratch = str(tmp_path / 'scratch')
+	os.mkdir(scratch)
+	d = make_md_dir(str(tmp_path / 'md'), **{md.CONF_SCRATCH: scratch})
+
+	env = fake_env(d, VASPMD_VASP_CMD='{} && false'.format(FAKE_VASP_CMD))
+	p = run_md(d, env=env, check=False)
+	assert p.returncode != 0
+	assert os.listdir(scratch) == []
+	# what vasp wrote before failing made it back
+	assert md.count_completed_steps(join(d, '1-linear', 'OSZICAR')) == 3
+
+	run_md(d)
+	assert is_finished(join(d, 'md.state'))
+	assert leaf_steps(d)['1-linear'] == 3
+	assert os.listdir(scratch) == []
+	assert not exists(join(d, '1-linear', '.OSZICAR.sync-tmp'))
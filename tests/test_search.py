@@ -0,0 +1,197 @@
+# vasp-search end to end, with fake_vasp.
+
+import os
+import sys
+import json
+import signal
+import subprocess
+from time import time, sleep
+from os.path import join
+
+import pytest
+import pytoml
+
+from helpers import md, make_search_dir, run_search, read_lines, read_json, fake_vasp_runs, write_search_toml
+from helpers import fake_env
+from vaspmd import search
+
+@pytest.mark.parametrize('max_parallel', [1, 3])
+def test_grid(tmp_path, max_parallel):
+	d = make_search_dir(str(tmp_path), max_depth=3, max_parallel=max_parallel)
+	run_search(d)
+
+	leaves = ['set-{:03d}/{:03d}'.format(depth, i) for depth in [1, 2, 3] for i in [1, 2, 3, 4]]
+	assert read_lines(join(d, 'search.leaves')) == leaves
+	assert sorted(fake_vasp_runs(d)) == leaves
+	for leaf in leaves:
+		assert md.count_completed_steps(join(d, leaf, 'OSZICAR')) == 3
+
+	result = read_json(join(d, 'search.result'))
+	assert result['reason'] == 'reached max depth 3'
+	assert result['depth'] == 3
+	assert result['trials'] == 12
+	# each depth narrows the range to the middle half:  [0, 1], [0.25, 0.75], [0.375, 0.625], ...
+	assert result['minval'] == pytest.approx(0.4375)
+	assert result['maxval'] == pytest.approx(0.5625)
+
+def test_grid_stop_width(tmp_path):
+	d = make_search_dir(str(tmp_path), stop_width=0.3)
+	run_search(d)
+	result = read_json(join(d, 'search.result'))
+	assert result['depth'] == 2
+	assert result['reason'].startswith('range width')
+
+def test_grid_stop_rel_width(tmp_path):
+	d = make_search_dir(str(tmp_path), start_min=1.0, start_max=3.0, stop_rel_width=0.3)
+	run_search(d)
+	result = read_json(join(d, 'search.result'))
+	assert result['depth'] == 2
+	assert result['reason'] == 'relative range width 0.25 <= 0.3'
+
+def test_grid_stop_rel_width_of_empty_range_is_refused(tmp_path):
+	d = make_search_dir(str(tmp_path), start_min=0.5, start_max=0.5, stop_rel_width=0.1)
+	p = run_search(d, check=False)
+	assert p.returncode != 0
+	assert "'stop-rel-width' cannot be used when 'start-min' equals 'start-max'" in p.stdout
+	assert fake_vasp_runs(d) == []
+
+def test_grid_best_by_value(tmp_path):
+	d = make_search_dir(str(tmp_path), npoints=11, max_depth=1, cmd_value='../value.sh')
+	run_search(d)
+	best = read_json(join(d, 'search.result'))['best']
+	assert best['x'] == pytest.approx(0.3)
+	assert best['value'] == pytest.approx(0.0)
+
+@pytest.mark.parametrize('strategy', ['golden', 'brent'])
+def test_bracket(tmp_path, strategy):
+	d = make_search_dir(str(tmp_path), strategy=strategy, cmd_value='../value.sh', tolerance=1e-3, cmd_next=None, npoints=None)
+	run_search(d)
+	result = read_json(join(d, 'search.result'))
+	assert result['strategy'] == strategy
+	assert result['best']['x'] == pytest.approx(0.3, abs=1e-3)
+	assert result['trials'] == len(read_lines(join(d, 'search.leaves')))
+
+def test_cache(tmp_path):
+	d = make_search_dir(str(tmp_path), npoints=3, max_depth=2, cache=True)
+	run_search(d)
+	# [0, 0.5, 1], then [0.25, 0.5, 0.75]; the middle trial is reused
+	assert len(fake_vasp_runs(d)) == 5
+	assert len(read_lines(join(d, 'search.leaves'))) == 6
+
+#-----------------------------------------------------
+# Killed partway and resumed
+
+# Start vasp-search, and kill it (and every trial it is running) once `nruns` vasp runs
+#  have completed.
+def run_search_until_killed(d, *, nruns, env, timeout=60):
+	p = subprocess.Popen([sys.executable, '-c', 'from vaspmd.search import main; main()'],
+		cwd=d, env=env, start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	try:
+		deadline = time() + timeout
+		while len(fake_vasp_runs(d)) < nruns:
+			assert p.poll() is None, 'vasp-search exited before it could be killed'
+			assert time() < deadline, 'timed out'
+			sleep(0.02)
+	finally:
+		os.killpg(p.pid, signal.SIGKILL)
+		p.wait()
+
+def read_cache(d):
+	with open(join(d, search.VARFILE_CACHE)) as f:
+		return [json.loads(line) for line in f]
+
+@pytest.mark.parametrize('nruns', [2, 4, 5])
+def test_threaded_grid_killed_and_resumed(tmp_path, nruns):
+	d = make_search_dir(str(tmp_path), npoints=3, max_depth=3, max_parallel=3, cache=True)
+	env = fake_env(d, FAKE_VASP_STEP_TIME=0.1)
+	run_search_until_killed(d, nruns=nruns, env=env)
+	before = fake_vasp_runs(d)
+	run_search(d, env=env)
+
+	leaves = ['set-{:03d}/{:03d}'.format(depth, i) for depth in [1, 2, 3] for i in [1, 2, 3]]
+	assert read_lines(join(d, 'search.leaves')) == leaves
+	# the middle trial of each depth after the first is the middle trial of the one before
+	ran = [leaf for leaf in leaves if not leaf.endswith('002') or leaf.startswith('set-001')]
+	after = fake_vasp_runs(d)
+	assert sorted(set(after)) == ran
+	# the only trials run again are ones that were running when it was killed (and perhaps
+	#  finished just before, without being marked complete)
+	rerun = set(before) & set(after[len(before):])
+	assert rerun <= set(before[-3:])
+	assert len(after) - len(ran) <= 3
+	for leaf in leaves:
+		assert md.count_completed_steps(join(d, leaf, 'OSZICAR')) == 3
+
+	cache = read_cache(d)
+	assert sorted(r['dir'] for r in cache) == ran
+
+	result = read_json(join(d, 'search.result'))
+	assert result['reason'] == 'reached max depth 3'
+	assert result['trials'] == 9
+	assert result['minval'] == pytest.approx(0.4375)
+	assert result['maxval'] == pytest.approx(0.5625)
+
+def test_cache_records_a_trial_once(tmp_path):
+	path = str(tmp_path / search.VARFILE_CACHE)
+	os.mkdir(str(tmp_path / 'a'))
+	for _ in range(2):
+		search.record_cached_trial(path, 0.5, str(tmp_path / 'a'), key={'k': 1})
+	search.record_cached_trial(path, 0.5, str(tmp_path / 'a'), key={'k': 2})
+	assert [(r['dir'], r['key']) for r in read_cache(str(tmp_path))] == [('a', {'k': 1}), ('a', {'k': 2})]
+
+#-----------------------------------------------------
+# A directory belongs to one strategy
+
+def set_strategy(d, strategy):
+	with open(join(d, 'search.toml')) as f:
+		settings = pytoml.load(f)
+	settings.update(strategy=strategy, tolerance=1e-3)
+	settings['cmd-value'] = '../value.sh'
+	write_search_toml(d, settings)
+
+@pytest.mark.parametrize('legacy', [False, True])
+def test_grid_then_bracket_is_refused(tmp_path, legacy):
+	d = make_search_dir(str(tmp_path), max_depth=1)
+	run_search(d)
+	if legacy: # a directory from before search.strategy
+		os.remove(join(d, 'search.strategy'))
+
+	set_strategy(d, 'golden')
+	p = run_search(d, check=False)
+	assert p.returncode != 0
+	assert "holds a search with 'strategy' = 'grid', not 'golden'" in p.stdout
+	assert read_json(join(d, 'search.result'))['strategy'] == 'grid'
+
+@pytest.mark.parametrize('legacy', [False, True])
+def test_bracket_then_grid_is_refused(tmp_path, legacy):
+	d = make_search_dir(str(tmp_path), strategy='golden', cmd_value='../value.sh', tolerance=0.1)
+	run_search(d)
+	if legacy:
+		os.remove(join(d, 'search.strategy'))
+
+	set_strategy(d, 'grid')
+	p = run_search(d, check=False)
+	assert p.returncode != 0
+	assert "not 'grid'" in p.stdout
+
+def test_same_strategy_resumes(tmp_path):
+	d = make_search_dir(str(tmp_path), max_depth=2)
+	run_search(d)
+	run_search(d)
+	assert len(fake_vasp_runs(d)) == 8
+
+# The golden-section step from 0.56 toward 0.5 lands within tolerance / 4 of 0.56, though the
+#  bracket [0.5, 0.61] is still wider than the tolerance.
+@pytest.mark.parametrize('method', ['golden', 'brent'])
+def test_bracket_point_when_golden_step_collides(method):
+	xs = [0.0, 1.0, search.GOLDEN_STEP, 0.5, 0.56, 0.61]
+	values = [1.0, 1.0, 0.5, 0.2, 0.1, 0.2]
+	kw = dict(lo=0.0, hi=1.0, method=method, tolerance=0.1, max_evals=100)
+	x = search.next_bracket_point(xs, values, **kw)
+	assert x is not None
+	assert 0.5 < x < 0.56
+	assert min(abs(x - xi) for xi in xs) >= 0.1 / 4
+
+	# converged only once the bracket is no wider than the tolerance
+	assert search.next_bracket_point(xs + [x], values + [0.15], **kw) is None
+	assert search.next_bracket_point(xs + [x], values + [0.05], **kw) is None
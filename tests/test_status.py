@@ -0,0 +1,160 @@
+# Progress monitoring (monitor_progress, write_status), and md.status during a run.
+
+import sys
+import json
+import subprocess
+import threading
+from time import time, sleep
+from os.path import join
+
+import pytest
+
+from helpers import md, make_md_dir, fake_env, read_json
+
+def test_write_status(tmp_path):
+	path = str(tmp_path / 'md.status')
+	md.write_status(path, leaf='1-nve/002', now=0, elapsed=100.0, rate=2.0,
+		progress=[('leaf', 50, 100), ('stage', 150, 300), ('plan', 250, 400)])
+	status = read_json(path)
+	assert status['leaf'] == '1-nve/002'
+	assert status['elapsed'] == 100.0
+	assert status['steps-per-second'] == 2.0
+	assert (status['leaf-step'], status['leaf-steps'], status['leaf-eta']) == (50, 100, 25.0)
+	assert (status['stage-step'], status['stage-steps'], status['stage-eta']) == (150, 300, 75.0)
+	assert (status['plan-step'], status['plan-steps'], status['plan-eta']) == (250, 400, 75.0)
+
+	md.write_status(path, leaf='1-linear', now=0, elapsed=1.0, rate=None, progress=[('leaf', 0, 10)])
+	status = read_json(path)
+	assert status['steps-per-second'] is None and status['leaf-eta'] is None
+
+#-----------------------------------------------------
+
+def step_line(step):
+	return '{:6d} T= {:6.0f}. E= -.1E+03 F= -.1E+03 E0= -.1E+03  EK= .15E+01 SP= .12 SK= .03\n'.format(step, 300)
+
+class Monitor:
+	def __init__(self, d, *, interval, start=None, monkeypatch):
+		self.oszicar = join(d, 'OSZICAR')
+		self.status_path = join(d, 'md.status')
+		self.updates = [] # (time, leaf-step)
+		self.stop = threading.Event()
+
+		real_write_status = md.write_status
+		def write_status(path, **kw):
+			self.updates.append((time(), kw['progress'][0][1]))
+			real_write_status(path, **kw)
+		monkeypatch.setattr(md, 'write_status', write_status)
+
+		self.thread = threading.Thread(target=md.monitor_progress, kwargs=dict(
+			stop=self.stop, oszicar=self.oszicar, interval=interval, status_path=self.status_path,
+			detector=None, leaf='1-nve/002', start=time() if start is None else start,
+			steps=10, stage_done=10, stage_steps=30, plan_done=16, plan_steps=36,
+		))
+
+	def __enter__(self):
+		self.thread.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.stop.set()
+		self.thread.join(timeout=10)
+		assert not self.thread.is_alive()
+
+	def write_steps(self, steps):
+		with open(self.oszicar, 'a') as f:
+			for step in steps:
+				f.write(step_line(step))
+
+def test_monitor_progress(tmp_path, monkeypatch):
+	d = str(tmp_path)
+	with Monitor(d, interval=0.1, monkeypatch=monkeypatch) as m:
+		sleep(0.25)
+		m.write_steps(range(1, 4))
+		sleep(0.25)
+		m.write_steps(range(4, 7))
+		sleep(0.25)
+
+		status = read_json(m.status_path)
+		assert status['leaf'] == '1-nve/002'
+		assert (status['leaf-step'], status['leaf-steps']) == (6, 10)
+		assert (status['stage-step'], status['stage-steps']) == (16, 30)
+		assert (status['plan-step'], status['plan-steps']) == (22, 36)
+		# (measured from the first step seen, so that the startup of vasp does not count)
+		assert status['steps-per-second'] == pytest.approx(3 / 0.25, rel=0.5)
+		assert status['leaf-eta'] == pytest.approx(4 / status['steps-per-second'])
+
+		m.write_steps(range(7, 11))
+
+	# one last update once vasp has exited
+	assert m.updates[-1][1] == 10
+	assert read_json(m.status_path)['leaf-step'] == 10
+
+	# about every `interval` seconds
+	gaps = [b - a for ((a, _), (b, _)) in zip(m.updates, m.updates[1:-1])]
+	assert 6 <= len(m.updates) <= 10
+	assert all(0.08 < gap < 0.3 for gap in gaps), gaps
+
+def test_monitor_ignores_an_old_oszicar(tmp_path, monkeypatch):
+	d = str(tmp_path)
+	with open(join(d, 'OSZICAR'), 'w') as f:
+		f.write(step_line(1) + step_line(2))
+	with Monitor(d, interval=0.05, start=time() + 5, monkeypatch=monkeypatch) as m:
+		sleep(0.2)
+	assert m.updates and all(step == 0 for (_, step) in m.updates)
+	assert read_json(m.status_path)['steps-per-second'] is None
+
+#-----------------------------------------------------
+# During an md-run with fake_vasp
+
+INTERVAL = 0.2
+
+def test_status_during_md_run(tmp_path):
+	d = make_md_dir(str(tmp_path), **{md.CONF_STATUS_INTERVAL: INTERVAL, md.CONF_NVE_STEPS: 9})
+	path = join(d, md.VARFILE_MD_STATUS)
+	p = subprocess.Popen([sys.executable, '-c', 'from vaspmd.md import main; main()'], cwd=d,
+		env=fake_env(d, FAKE_VASP_STEP_TIME=0.1), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+	seen = [] # (time first seen, status)
+	try:
+		deadline = time() + 60
+		while p.poll() is None:
+			assert time() < deadline, 'timed out'
+			try:
+				with open(path) as f:
+					status = json.load(f)
+			except (OSError, ValueError):
+				status = None
+			if status is not None and (not seen or status != seen[-1][1]):
+				seen.append((time(), status))
+			sleep(0.01)
+	finally:
+		if p.poll() is None:
+			p.kill()
+		out = p.communicate()[0]
+	assert p.returncode == 0, out
+
+	statuses = [s for (_, s) in seen]
+	assert {s['leaf'] for s in statuses} >= {'1-linear', '1-nose', '1-nve/001', '1-nve/002', '1-nve/003'}
+	for s in statuses:
+		assert 0 <= s['leaf-step'] <= s['leaf-steps'] <= 3
+		assert s['plan-steps'] == 3 + 3 + 9
+		assert s['stage-step'] <= s['stage-steps']
+		if s['leaf'].startswith('1-nve/'):
+			block = int(s['leaf'][-3:])
+			assert s['stage-step'] == 3 * (block - 1) + s['leaf-step']
+			assert s['plan-step'] == 6 + s['stage-step']
+
+	# progress only goes forwards
+	plan_steps = [s['plan-step'] for s in statuses]
+	assert plan_steps == sorted(plan_steps)
+	final = statuses[-1]
+	assert (final['leaf'], final['plan-step']) == ('1-nve/003', 15)
+
+	# updates during a vasp run come about every INTERVAL seconds  (apart from the last one of
+	#  each run, made as soon as vasp exits)
+	gaps = []
+	for leaf in {s['leaf'] for s in statuses}:
+		elapsed = sorted({s['elapsed'] for s in statuses if s['leaf'] == leaf})[:-1]
+		gaps += [b - a for (a, b) in zip(elapsed, elapsed[1:])]
+	assert gaps
+	assert all(0.8 * INTERVAL <= gap < 5 * INTERVAL for gap in gaps), gaps
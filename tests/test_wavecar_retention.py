@@ -0,0 +1,135 @@
+# WAVECAR retention (retire_block_wavecars, compress_wavecar), and resuming md-run under it.
+
+import os
+import sys
+import gzip
+import subprocess
+from os.path import join, exists
+
+import pytest
+
+from helpers import md, make_md_dir, fake_env, is_finished, leaf_steps
+
+NAMES = ['001', '002', '003', '004']
+
+@pytest.fixture
+def blocks(tmp_path):
+	for i, name in enumerate(NAMES):
+		(tmp_path / name).mkdir()
+		(tmp_path / name / 'WAVECAR').write_bytes(bytes([i]) * 100)
+	return str(tmp_path)
+
+def wavecars(d):
+	return {name: sorted(x for x in os.listdir(join(d, name)) if x.startswith('WAVECAR')) for name in NAMES}
+
+@pytest.mark.parametrize('retention, expected', [
+	(md.WAVECAR_KEEP_ALL, [['WAVECAR']] * 4),
+	(md.WAVECAR_STAGES,   [[], [], ['WAVECAR'], ['WAVECAR']]),
+	(1,                   [[], [], ['WAVECAR'], ['WAVECAR']]),
+	(2,                   [[], ['WAVECAR'], ['WAVECAR'], ['WAVECAR']]),
+	(md.WAVECAR_COMPRESS, [['WAVECAR.gz'], ['WAVECAR.gz'], ['WAVECAR'], ['WAVECAR']]),
+])
+def test_retire_block_wavecars(blocks, retention, expected):
+	# three blocks have been run; the third is still needed to rerun the fourth
+	names = [join(blocks, name) for name in NAMES]
+	md.retire_block_wavecars(names, finished=3, retention=retention)
+	assert list(wavecars(blocks).values()) == expected
+
+	# idempotent
+	md.retire_block_wavecars(names, finished=3, retention=retention)
+	assert list(wavecars(blocks).values()) == expected
+
+def test_retire_nothing_before_the_second_block(blocks):
+	names = [join(blocks, name) for name in NAMES]
+	for retention in [md.WAVECAR_STAGES, md.WAVECAR_COMPRESS, 1]:
+		md.retire_block_wavecars(names, finished=1, retention=retention)
+	assert list(wavecars(blocks).values()) == [['WAVECAR']] * 4
+
+def test_compress_wavecar(blocks):
+	md.compress_wavecar(join(blocks, '002'))
+	with gzip.open(join(blocks, '002', 'WAVECAR.gz')) as f:
+		assert f.read() == bytes([1]) * 100
+	assert not exists(join(blocks, '002', 'WAVECAR.gz.tmp'))
+	md.compress_wavecar(join(blocks, '002')) # nothing left to do
+
+#-----------------------------------------------------
+# In HANDOFF_MOVE mode, a file that could be reflinked is not moved, so it is still there to be
+#  retired, possibly before the loop state that records its handoff is saved.
+
+def fake_reflink(src, dest):
+	md.copy_file(src, dest)
+	return True
+
+def test_retired_source_of_a_reflink_is_accepted_on_rerun(blocks, monkeypatch):
+	monkeypatch.setattr(md, 'try_reflink', fake_reflink)
+	src, dest = join(blocks, '004', 'WAVECAR'), join(blocks, 'WAVECAR')
+	md.handoff_file(src, dest, mode=md.HANDOFF_MOVE, writable=False)
+	assert exists(src) and exists(src + md.HANDOFF_RECORD_SUFFIX)
+
+	os.remove(src)
+	md.handoff_file(src, dest, mode=md.HANDOFF_MOVE, writable=False)
+	assert exists(dest)
+
+#-----------------------------------------------------
+# Killed with fake_vasp, just before md.state records the end of the NVE stage, once the
+#  retention policy has been applied to its last block.  Reflinks are simulated with copies,
+#  as the filesystem of the tests may not support them.
+
+# md-run, with simulated reflinks, and (if `kill`) killed at that point.
+RUN_MD_WITH_REFLINKS = '''
+import os, threading
+from vaspmd import md
+
+def fake_reflink(src, dest):
+	md.copy_file(src, dest)
+	return True
+md.try_reflink = fake_reflink
+
+retired = threading.Event()
+real_retire = md.retire_block_wavecars
+def retire_block_wavecars(names, *, finished, retention):
+	real_retire(names, finished=finished, retention=retention)
+	if finished > len(names):
+		retired.set()
+md.retire_block_wavecars = retire_block_wavecars
+
+real_read_final_temp = md.read_final_temp
+def read_final_temp(path):
+	if {kill!r} and path.startswith('1-nve'):
+		if {retention!r} != md.WAVECAR_KEEP_ALL:
+			assert retired.wait(30)
+		os._exit(137)
+	return real_read_final_temp(path)
+md.read_final_temp = read_final_temp
+
+md.main()
+'''
+
+def run_md_with_reflinks(d, *, retention, kill):
+	return subprocess.run([sys.executable, '-c', RUN_MD_WITH_REFLINKS.format(retention=retention, kill=kill)],
+		cwd=d, env=fake_env(d), timeout=120, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+def block_wavecars(d):
+	return {name: sorted(x for x in os.listdir(join(d, '1-nve', name)) if x in ['WAVECAR', 'WAVECAR.gz'])
+		for name in ['001', '002', '003']}
+
+@pytest.mark.parametrize('retention, expected', [
+	(md.WAVECAR_KEEP_ALL, [['WAVECAR']] * 3),
+	(md.WAVECAR_STAGES,   [[]] * 3),
+	(md.WAVECAR_COMPRESS, [['WAVECAR.gz']] * 3),
+])
+def test_resume_after_retiring_the_last_block(tmp_path, retention, expected):
+	d = make_md_dir(str(tmp_path), **{md.CONF_HANDOFF: md.HANDOFF_MOVE, md.CONF_WAVECAR_RETENTION: retention})
+	p = run_md_with_reflinks(d, retention=retention, kill=True)
+	assert p.returncode == 137, p.stdout
+	assert isinstance(md.load_loop_state(join(d, '1-nve', 'nve.state')), md.EndLoop)
+	assert not is_finished(join(d, 'md.state'))
+	if retention != md.WAVECAR_KEEP_ALL:
+		assert not exists(join(d, '1-nve', '003', 'WAVECAR'))
+
+	p = run_md_with_reflinks(d, retention=retention, kill=False)
+	assert p.returncode == 0, p.stdout
+	assert is_finished(join(d, 'md.state'))
+	assert leaf_steps(d) == {'1-linear': 3, '1-nose': 3, '1-nve/001': 3, '1-nve/002': 3, '1-nve/003': 1}
+	assert list(block_wavecars(d).values()) == expected
+	assert exists(join(d, '1-nve', 'WAVECAR'))
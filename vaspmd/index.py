@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+# Keeps an SQLite database of the progress of many md and search directories, so that
+#  questions like "which runs are done, and what temperature did each reach?" can be answered
+#  without opening every state file and OSZICAR on a network filesystem.
+#
+#     vaspmd-index runs/ searches/      # scan (or rescan) trees, and print a summary
+#     vaspmd-index                      # just print the summary
+#     sqlite3 vaspmd-index.sqlite 'SELECT dir, last_temp FROM runs WHERE finished'
+#
+# A directory with an md.conf is an md run, and one with a search.toml (or search.state) is a
+#  search; neither is searched further for runs.
+#
+# Tables:
+#
+#   runs:    One row per md or search directory.
+#              dir          Absolute path.
+#              kind         'md' or 'search'.
+#              finished     1 if its loop has ended.
+#              num, stage   md: the cycle and stage in progress.  search: the depth of a grid
+#                           search (stage 'grid'), or the number of trials of a bracketing
+#                           search (stage 'bracket').
+#              block        md: the NVE block (or linear/nose segment) in progress, if any.
+#              nleaves      Number of finished leaves.
+#              steps        Total ionic steps over the finished leaves.
+#              last_temp,   T and F of the last ionic step of the last finished leaf.
+#              last_energy
+#              wall         Total elapsed seconds over the finished leaves (from OUTCAR).
+#              files        (internal) JSON of the signatures of the state files last read.
+#              scanned      Unix time of the last time that it was re-read.
+#
+#   leaves:  One row per finished leaf.  (dir, leaf, stage, block, steps, last_temp,
+#            last_energy, wall), where `leaf` is relative to `dir`, as in md.leaves.
+#
+# Rescans are incremental:  A run is only re-read if the size or mtime of one of its state
+#  files (md.state, md.leaves, and the state file of the stage in progress; or the equivalent
+#  for a search) has changed since the last scan, and within it, only the leaves whose OSZICAR
+#  or OUTCAR changed are re-read.  Runs within a scanned tree that are no longer there are
+#  removed from the index.
+
+from os.path import join, exists
+
+from vaspmd.md import finished_leaves, load_loop_state, read_last_oszicar_step
+from vaspmd.md import parse_stage_dir_name, stage_dir_name, stage_state_file, stripped_lines
+from vaspmd.md import START_NUM, STAGE_LINEAR, VARFILE_MD_ALLDIRS
+
+DEFAULT_DB = 'vaspmd-index.sqlite'
+
+KIND_MD     = 'md'
+KIND_SEARCH = 'search'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+	dir TEXT PRIMARY KEY, kind TEXT, finished INTEGER, num INTEGER, stage TEXT, block TEXT,
+	nleaves INTEGER, steps INTEGER, last_temp REAL, last_energy REAL, wall REAL,
+	files TEXT, scanned REAL
+);
+CREATE TABLE IF NOT EXISTS leaves (
+	dir TEXT, leaf TEXT, stage TEXT, block TEXT, steps INTEGER, last_temp REAL, last_energy REAL,
+	wall REAL, files TEXT,
+	PRIMARY KEY (dir, leaf)
+);
+'''
+
+# How much of the end of an OUTCAR is read to find the elapsed time
+OUTCAR_TAIL = 1 << 14
+
+def main():
+	from argparse import ArgumentParser
+	from time import time
+	parser = ArgumentParser(description='index the progress of many md and search directories')
+	parser.add_argument('PATH', nargs='*', help='trees to scan for md and search directories')
+	parser.add_argument('--db', default=DEFAULT_DB, help='database file (default: %(default)s)')
+	parser.add_argument('--quiet', '-q', action='store_true', help='do not print the summary')
+	args = parser.parse_args()
+
+	db = open_db(args.db)
+	if args.PATH:
+		start = time()
+		nruns, nread, nremoved = scan(db, args.PATH)
+		print('vaspmd-index: {} runs, {} re-read, {} removed, in {:.2f}s'.format(nruns, nread, nremoved, time() - start))
+	if not args.quiet:
+		print_summary(db)
+
+def open_db(path):
+	import sqlite3
+	db = sqlite3.connect(path)
+	db.executescript(SCHEMA)
+	return db
+
+# Returns (number of runs found, number re-read, number removed).
+def scan(db, paths):
+	from os.path import abspath
+	nruns = nread = nremoved = 0
+	for path in paths:
+		found = set()
+		for d, kind in find_runs(path):
+			nruns += 1
+			found.add(abspath(d))
+			if index_run(db, abspath(d), kind):
+				nread += 1
+		nremoved += remove_missing_runs(db, abspath(path), found)
+		db.commit()
+	return nruns, nread, nremoved
+
+# Remove the runs indexed under `root` that are not in `found`.  Returns how many there were.
+def remove_missing_runs(db, root, found):
+	from os.path import sep
+	gone = [d for (d,) in db.execute('SELECT dir FROM runs')
+		if (d == root or d.startswith(root.rstrip(sep) + sep)) and d not in found]
+	for d in gone:
+		db.execute('DELETE FROM runs WHERE dir = ?', (d,))
+		db.execute('DELETE FROM leaves WHERE dir = ?', (d,))
+	return len(gone)
+
+def find_runs(root):
+	from os import walk
+	for dirpath, dirnames, filenames in walk(root):
+		if 'md.conf' in filenames:
+			yield dirpath, KIND_MD
+			dirnames[:] = []
+		elif 'search.toml' in filenames or 'search.state' in filenames:
+			yield dirpath, KIND_SEARCH
+			dirnames[:] = []
+		else:
+			dirnames.sort()
+
+#-----------------------------------------------------
+
+# Re-read a run if its state files changed.  Returns whether it did.
+def index_run(db, d, kind):
+	from json import dumps, loads
+	from time import time
+	row = db.execute('SELECT files FROM runs WHERE dir = ?', (d,)).fetchone()
+	if row is not None and loads(row[0]) == file_signatures(d, list(loads(row[0]))):
+		return False
+
+	if kind == KIND_MD:
+		status, leaves, state_files = read_md_run(d)
+	else:
+		status, leaves, state_files = read_search_run(d)
+
+	for leaf in leaves:
+		index_leaf(db, d, leaf)
+	db.execute('DELETE FROM leaves WHERE dir = ? AND leaf NOT IN ({})'.format(','.join('?' * len(leaves))),
+		[d] + list(leaves))
+
+	nleaves, steps, wall = db.execute(
+		'SELECT COUNT(*), SUM(steps), SUM(wall) FROM leaves WHERE dir = ?', (d,)).fetchone()
+	last = db.execute('SELECT last_temp, last_energy FROM leaves WHERE dir = ? AND leaf = ?',
+		(d, leaves[-1] if leaves else None)).fetchone() or (None, None)
+
+	db.execute('INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', (
+		d, kind, status['finished'], status['num'], status['stage'], status['block'],
+		nleaves, steps, last[0], last[1], wall,
+		dumps(file_signatures(d, state_files)), time(),
+	))
+	return True
+
+# Returns (status, finished leaves, names of the state files that were read).
+def read_md_run(d):
+	state_files = ['md.state', VARFILE_MD_ALLDIRS]
+	status = dict(finished=0, num=None, stage=None, block=None)
+
+	state = load_loop_state(join(d, 'md.state')) if exists(join(d, 'md.state')) else ()
+	if type(state).__name__ == 'EndLoop':
+		status['finished'] = 1
+	else:
+		num, stage = state[:2] if state else (START_NUM, STAGE_LINEAR)
+		status.update(num=num, stage=stage)
+		sub = join(stage_dir_name(num=num, stage=stage), stage_state_file(stage))
+		state_files.append(sub)
+		substate = load_loop_state(join(d, sub)) if exists(join(d, sub)) else ()
+		if isinstance(substate, tuple) and substate:
+			i, _sizes, names = substate[:3]
+			if i < len(names):
+				status['block'] = names[i]
+
+	return status, finished_leaves(d), state_files
+
+def read_search_run(d):
+	state_files = ['search.state', 'search.leaves', 'search.result']
+	status = dict(finished=int(exists(join(d, 'search.result'))), num=None, stage=None, block=None)
+
+	state = load_loop_state(join(d, 'search.state')) if exists(join(d, 'search.state')) else ()
+	if type(state).__name__ == 'EndLoop':
+		status['finished'] = 1
+	elif isinstance(state, tuple) and len(state) == 5: # grid
+		status.update(num=state[0], stage='grid', block=state[3])
+		state_files.append(join(state[3], 'subsearch.state'))
+	elif isinstance(state, tuple) and len(state) == 3: # golden/brent
+		status.update(num=len(state[0]), stage='bracket')
+
+	path = join(d, 'search.leaves')
+	leaves = stripped_lines(path) if exists(path) else []
+	return status, leaves, state_files
+
+def index_leaf(db, d, leaf):
+	from json import dumps
+	files = dumps(file_signatures(join(d, leaf), ['OSZICAR', 'OUTCAR']))
+	row = db.execute('SELECT files FROM leaves WHERE dir = ? AND leaf = ?', (d, leaf)).fetchone()
+	if row is not None and row[0] == files:
+		return
+
+	stage = block = None
+	try:
+		first, *rest = leaf.split('/')
+		stage = parse_stage_dir_name(first)[1]
+		block = '/'.join(rest) or None
+	except ValueError:
+		pass # not an md leaf
+
+	steps, temp, energy = read_last_step(join(d, leaf, 'OSZICAR'))
+	wall = read_elapsed_time(join(d, leaf, 'OUTCAR'))
+	db.execute('INSERT OR REPLACE INTO leaves VALUES (?,?,?,?,?,?,?,?,?)',
+		(d, leaf, stage, block, steps, temp, energy, wall, files))
+
+# {fname: [mtime_ns, size] or None}
+def file_signatures(d, fnames):
+	from os import stat
+	out = {}
+	for fname in fnames:
+		try:
+			st = stat(join(d, fname))
+			out[fname] = [st.st_mtime_ns, st.st_size]
+		except FileNotFoundError:
+			out[fname] = None
+	return out
+
+# (steps, T, F) of the last ionic step, with None for anything that is unknown.
+# (T is only present for MD runs; other runs are read in full by the generic parser)
+def read_last_step(oszicar):
+	from math import isnan
+	if not exists(oszicar):
+		return None, None, None
+	last = read_last_oszicar_step(oszicar)
+	if last is not None:
+		return last.step, last.T, (None if isnan(last.F) else last.F)
+
+	from vaspmd.search import parse_oszicar
+	data = parse_oszicar(oszicar)
+	if 'step' not in data or not len(data['step']):
+		return 0, None, None
+	return int(data['step'][-1]), None, (float(data['F'][-1]) if 'F' in data else None)
+
+# The "Elapsed time (sec):" that vasp writes at the end of the OUTCAR, or None.
+def read_elapsed_time(outcar):
+	from os import SEEK_END
+	if not exists(outcar):
+		return None
+	with open(outcar, 'rb') as f:
+		f.seek(max(0, f.seek(0, SEEK_END) - OUTCAR_TAIL))
+		tail = f.read().decode(errors='replace')
+	for line in reversed(tail.splitlines()):
+		if 'Elapsed time (sec):' in line:
+			try: return float(line.split(':')[1])
+			except ValueError: return None
+	return None
+
+#-----------------------------------------------------
+
+def print_summary(db):
+	rows = db.execute('SELECT dir, kind, finished, num, stage, block, nleaves, steps, last_temp, wall '
+		'FROM runs ORDER BY dir').fetchall()
+	if not rows:
+		print('(no runs indexed)')
+		return
+
+	width = max(len(r[0]) for r in rows)
+	print('{:{}}  {:6}  {:20}  {:>6}  {:>8}  {:>8}  {:>8}'.format(
+		'dir', width, 'kind', 'progress', 'leaves', 'steps', 'last T', 'wall'))
+	for d, kind, finished, num, stage, block, nleaves, steps, temp, wall in rows:
+		if finished:
+			progress = 'finished'
+		elif kind == KIND_MD:
+			progress = '{}{}'.format(stage_dir_name(num=num, stage=stage), '/' + block if block else '')
+		else:
+			progress = '{} {}'.format(stage or '?', num if num is not None else '')
+		print('{:{}}  {:6}  {:20}  {:>6}  {:>8}  {:>8}  {:>8}'.format(
+			d, width, kind, progress, nleaves, steps or 0,
+			'-' if temp is None else '{:.1f}'.format(temp),
+			'-' if wall is None else '{:.1f}h'.format(wall / 3600)))
+
+if __name__ == '__main__':
+	main()
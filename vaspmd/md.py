@@ -17,9 +17,17 @@
 # I am not proud.
 
 from os.path import join, exists, isdir, relpath
+from signal import SIGTERM, SIGUSR1
+from threading import Lock
 
 VASP_BIN_NAME = 'vasp.g.slm'
 
+# Slurm commands, looked up on PATH (see chain_successor)
+SBATCH_BIN_NAME  = 'sbatch'
+SQUEUE_BIN_NAME  = 'squeue'
+SCANCEL_BIN_NAME = 'scancel'
+ENV_SLURM_JOB_ID = 'SLURM_JOB_ID'
+
 # constants for the linter's sake
 STAGE_LINEAR = 'linear'
 STAGE_NOSE   = 'nose'
@@ -31,20 +39,118 @@ CONF_BLOCKSIZE   ='steps-block'
 CONF_LINEAR_STEPS='steps-linear'
 CONF_NOSE_STEPS  ='steps-nose'
 CONF_NVE_STEPS   ='steps-nve'
+CONF_HANDOFF     ='handoff'
+CONF_STATUS_INTERVAL='status-interval'
+CONF_STATE_BACKEND  ='state-backend'
+CONF_STATE_FSYNC    ='state-fsync-every'
+CONF_STATE_COMPACT  ='state-compact-every'
+CONF_CYCLES         ='cycles'
+CONF_VASP_CMD       ='vasp-cmd'
+CONF_BLOCK_SIZING   ='block-sizing'
+CONF_WALLTIME_MARGIN='walltime-margin'
+CONF_MIN_BLOCK      ='steps-block-min'
+CONF_NOSE_EARLY_STOP='nose-early-stop'
+CONF_EQUIL_WINDOW   ='equil-window'
+CONF_EQUIL_TEMP_TOL ='equil-temp-tol'
+CONF_EQUIL_DRIFT_TOL='equil-drift-tol'
+CONF_WAVECAR_RETENTION='wavecar-retention'
+CONF_SCRATCH        ='scratch'
+CONF_SCRATCH_SYNC   ='scratch-sync-interval'
+CONF_POST_BLOCK_HOOKS  ='post-block-hooks'
+CONF_POST_BLOCK_WORKERS='post-block-workers'
+CONF_LADDER         ='ladder'
+CONF_ANALYSIS       ='analysis'
+CONF_ANALYSIS_WINDOW='analysis-window'
+CONF_RDF_RMAX       ='rdf-rmax'
+CONF_RDF_BINS       ='rdf-bins'
+CONF_NPAR           ='npar'
+CONF_KPAR           ='kpar'
+CONF_TUNE_NPAR      ='tune-npar'
+CONF_TUNE_KPAR      ='tune-kpar'
+CONF_TUNE_VASP_CMDS ='tune-vasp-cmds'
+CONF_TUNE_STEPS     ='tune-steps'
+
+# Overrides CONF_VASP_CMD (e.g. to give each run its own slice of an allocation; see md-pack)
+ENV_VASP_CMD = 'VASPMD_VASP_CMD'
+
+# How WAVECAR/CONTCAR are passed from one stage or block to the next (see handoff_file)
+HANDOFF_COPY = 'copy'
+HANDOFF_LINK = 'link'
+HANDOFF_MOVE = 'move'
+HANDOFF_MODES = [HANDOFF_COPY, HANDOFF_LINK, HANDOFF_MOVE]
+# Written next to a file that HANDOFF_MOVE renamed away, or reflinked or copied (see handoff_file)
+HANDOFF_RECORD_SUFFIX = '.moved'
+
+# What happens to the WAVECAR of an NVE block once the next block has finished with it
+#  (see retire_block_wavecars).  The setting may also be a number N, to keep the last N blocks'.
+WAVECAR_KEEP_ALL = 'all'
+WAVECAR_STAGES   = 'stages'
+WAVECAR_COMPRESS = 'compress'
+WAVECAR_RETENTIONS = [WAVECAR_KEEP_ALL, WAVECAR_STAGES, WAVECAR_COMPRESS]
+
+# How the NVE stage is split into blocks (see do_nve)
+BLOCK_SIZING_FIXED    = 'fixed'
+BLOCK_SIZING_ADAPTIVE = 'adaptive'
+BLOCK_SIZINGS = [BLOCK_SIZING_FIXED, BLOCK_SIZING_ADAPTIVE]
+
+# Unix time at which the job will be killed; overrides what is learned from slurm
+ENV_END_TIME = 'VASPMD_END_TIME'
+ENV_SLURM_JOB_END_TIME = 'SLURM_JOB_END_TIME'
+
+# Signals that make md-run stop vasp gracefully (see _main)
+STOP_SIGNALS = [SIGTERM, SIGUSR1]
 
 TEBEG_REPL = '無'
 STEPS_REPL = '数'
+# The target temperature.  md-init substitutes this, except in ladder mode. (see _main)
+TEMP_REPL  = '茶'
+# NPAR and KPAR.  md-init substitutes these, unless given PAR_AUTO. (see autotune)
+NPAR_REPL  = '道'
+KPAR_REPL  = '束'
+PAR_AUTO   = 'auto'
 
 START_NUM = 1
 
 VARFILE_MD_ALLDIRS     = 'md.leaves'
 VARFILE_FINAL_TEMP     = 'md.final-temp'
+VARFILE_MD_STATUS      = 'md.status'
+VARFILE_MD_CHAIN       = 'md.chain'
+VARFILE_MD_EVENTS      = 'md.events.jsonl'
+
+# Trial runs of autotune
+TUNE_DIR  = 'tune'
+TUNE_FILE = 'tune.json'
+
+# Streaming analysis of NVE stages (see update_analysis)
+ANALYSIS_MSD  = 'msd'
+ANALYSIS_VACF = 'vacf'
+ANALYSIS_RDF  = 'rdf'
+ANALYSES = [ANALYSIS_MSD, ANALYSIS_VACF, ANALYSIS_RDF]
+ANALYSIS_STATE = 'analysis.state'
+
+# Written to each leaf, listing the post-block hooks that have succeeded there
+POST_BLOCK_DONE = 'post-block.done'
+
+# Written to a nose leaf that was stopped early (see check_equilibrated)
+EQUIL_FILE = 'equilibration.json'
+# Number of blocks the window is divided into for the block averaging test
+EQUIL_BLOCKS = 4
+# How often the OSZICAR is checked for equilibration when progress reports are disabled
+EQUIL_POLL_INTERVAL = 30
 
 def main():
 	from argparse import ArgumentParser
 	from json import load
+	from os import environ
 	parser = ArgumentParser()
-	parser.parse_args()
+	parser.add_argument('--max-units', type=int, metavar='N',
+		help='exit (successfully) after running vasp N times; a later run resumes from there')
+	parser.add_argument('--chain', action='store_true',
+		help='when run as a slurm job, submit a copy of this job that depends on it (see chain_successor)')
+	args = parser.parse_args()
+
+	if args.chain and ENV_SLURM_JOB_ID not in environ:
+		parser.error('--chain must be used inside a slurm job')
 
 	try:
 		with open('md.conf') as f:
@@ -52,17 +158,62 @@ def main():
 	except FileNotFoundError:
 		parser.error('missing md.conf!')
 
-	_main(
-		temperature  = conf.pop(CONF_TEMPERATURE),
-		from_zero    = conf.pop(CONF_FROM_ZERO),
-		blocksize    = conf.pop(CONF_BLOCKSIZE),
-		linear_steps = conf.pop(CONF_LINEAR_STEPS),
-		nose_steps   = conf.pop(CONF_NOSE_STEPS),
-		nve_steps    = conf.pop(CONF_NVE_STEPS),
-		unknown      = conf,
-	)
-
-def write_conf(mddir, *, temperature, from_zero, blocksize, linear_steps, nose_steps, nve_steps):
+	if args.chain:
+		chain_successor(environ[ENV_SLURM_JOB_ID])
+
+	try:
+		_main(
+			temperature  = conf.pop(CONF_TEMPERATURE),
+			from_zero    = conf.pop(CONF_FROM_ZERO),
+			blocksize    = conf.pop(CONF_BLOCKSIZE),
+			linear_steps = conf.pop(CONF_LINEAR_STEPS),
+			nose_steps   = conf.pop(CONF_NOSE_STEPS),
+			nve_steps    = conf.pop(CONF_NVE_STEPS),
+			handoff      = conf.pop(CONF_HANDOFF, HANDOFF_COPY),
+			status_interval = conf.pop(CONF_STATUS_INTERVAL, 30),
+			state_backend = conf.pop(CONF_STATE_BACKEND, STATE_BACKEND_PICKLE),
+			state_fsync_every = conf.pop(CONF_STATE_FSYNC, 1),
+			state_compact_every = conf.pop(CONF_STATE_COMPACT, 100),
+			cycles       = conf.pop(CONF_CYCLES, None),
+			vasp_bin     = environ.get(ENV_VASP_CMD, conf.pop(CONF_VASP_CMD, VASP_BIN_NAME)),
+			block_sizing = conf.pop(CONF_BLOCK_SIZING, BLOCK_SIZING_FIXED),
+			walltime_margin = conf.pop(CONF_WALLTIME_MARGIN, 300),
+			min_block    = conf.pop(CONF_MIN_BLOCK, 1),
+			nose_early_stop = conf.pop(CONF_NOSE_EARLY_STOP, False),
+			equil_window = conf.pop(CONF_EQUIL_WINDOW, 200),
+			equil_temp_tol = conf.pop(CONF_EQUIL_TEMP_TOL, 0.05),
+			equil_drift_tol = conf.pop(CONF_EQUIL_DRIFT_TOL, 1.0),
+			wavecar_retention = conf.pop(CONF_WAVECAR_RETENTION, WAVECAR_KEEP_ALL),
+			scratch      = conf.pop(CONF_SCRATCH, None),
+			scratch_sync_interval = conf.pop(CONF_SCRATCH_SYNC, 300),
+			post_block_hooks = conf.pop(CONF_POST_BLOCK_HOOKS, []),
+			post_block_workers = conf.pop(CONF_POST_BLOCK_WORKERS, 1),
+			ladder       = conf.pop(CONF_LADDER, None),
+			analysis     = conf.pop(CONF_ANALYSIS, []),
+			analysis_window = conf.pop(CONF_ANALYSIS_WINDOW, 500),
+			rdf_rmax     = conf.pop(CONF_RDF_RMAX, None),
+			rdf_bins     = conf.pop(CONF_RDF_BINS, 200),
+			npar         = conf.pop(CONF_NPAR, None),
+			kpar         = conf.pop(CONF_KPAR, None),
+			tune_npar    = conf.pop(CONF_TUNE_NPAR, [1, 2, 4, 8]),
+			tune_kpar    = conf.pop(CONF_TUNE_KPAR, [1]),
+			tune_vasp_cmds = conf.pop(CONF_TUNE_VASP_CMDS, None),
+			tune_steps   = conf.pop(CONF_TUNE_STEPS, 5),
+			vasp_bin_from_env = ENV_VASP_CMD in environ,
+			max_units    = args.max_units,
+			unknown      = conf,
+		)
+	except Suspend as e:
+		print('md-run: suspended: {}'.format(e))
+		return
+
+	# The plan is complete, so a successor would have nothing to do.
+	if args.chain:
+		cancel_successor()
+
+def write_conf(mddir, *, temperature, from_zero, blocksize, linear_steps, nose_steps, nve_steps,
+		handoff=HANDOFF_COPY, cycles=None, block_sizing=BLOCK_SIZING_FIXED, nose_early_stop=False, ladder=None,
+		npar=None, kpar=None):
 	from json import dump
 	conf = {
 		CONF_TEMPERATURE:  temperature,
@@ -71,15 +222,108 @@ def write_conf(mddir, *, temperature, from_zero, blocksize, linear_steps, nose_s
 		CONF_LINEAR_STEPS: linear_steps,
 		CONF_NOSE_STEPS:   nose_steps,
 		CONF_NVE_STEPS:    nve_steps,
+		CONF_HANDOFF:      handoff,
+		CONF_BLOCK_SIZING: block_sizing,
+		CONF_NOSE_EARLY_STOP: nose_early_stop,
 	}
+	if cycles is not None:
+		conf[CONF_CYCLES] = cycles
+	if ladder is not None:
+		conf[CONF_LADDER] = list(ladder)
+	if npar is not None:
+		conf[CONF_NPAR] = npar
+	if kpar is not None:
+		conf[CONF_KPAR] = kpar
 	with open(join(mddir, 'md.conf'), 'w') as f:
 		dump(conf, f, indent=1)
 
-def _main(*, temperature, from_zero, blocksize, linear_steps, nose_steps, nve_steps, unknown):
+# Change some keys of an existing md.conf.
+def update_conf(path, changes):
+	from json import load
+	with open(path) as f:
+		conf = load(f)
+	conf.update(changes)
+	write_json(path, conf)
+
+def _main(*, temperature, from_zero, blocksize, linear_steps, nose_steps, nve_steps, handoff,
+		status_interval, state_backend, state_fsync_every, state_compact_every, cycles, vasp_bin,
+		block_sizing, walltime_margin, min_block, nose_early_stop, equil_window, equil_temp_tol,
+		equil_drift_tol, wavecar_retention, scratch, scratch_sync_interval, post_block_hooks,
+		post_block_workers, ladder, analysis, analysis_window, rdf_rmax, rdf_bins, npar, kpar,
+		tune_npar, tune_kpar, tune_vasp_cmds, tune_steps, vasp_bin_from_env, max_units, unknown):
+	from os.path import abspath, expandvars
+	from functools import partial
+	from signal import signal, Signals
 	from warnings import warn
 	for arg in unknown:
 		warn('Unknown key in config: {!r}'.format(arg))
 
+	if handoff not in HANDOFF_MODES:
+		raise ValueError('{!r} must be one of {!r}, not {!r}'.format(CONF_HANDOFF, HANDOFF_MODES, handoff))
+	if state_backend not in STATE_BACKENDS:
+		raise ValueError('{!r} must be one of {!r}, not {!r}'.format(CONF_STATE_BACKEND, STATE_BACKENDS, state_backend))
+	if block_sizing not in BLOCK_SIZINGS:
+		raise ValueError('{!r} must be one of {!r}, not {!r}'.format(CONF_BLOCK_SIZING, BLOCK_SIZINGS, block_sizing))
+	if wavecar_retention not in WAVECAR_RETENTIONS and not (type(wavecar_retention) is int and wavecar_retention >= 1):
+		raise ValueError('{!r} must be one of {!r} or a positive integer, not {!r}'.format(
+			CONF_WAVECAR_RETENTION, WAVECAR_RETENTIONS, wavecar_retention))
+	if scratch is not None:
+		scratch = expandvars(scratch)
+		if not isdir(scratch):
+			raise ValueError('{!r} must be an existing directory, not {!r}'.format(CONF_SCRATCH, scratch))
+	if ladder is not None:
+		if not ladder:
+			raise ValueError('{!r} must not be empty'.format(CONF_LADDER))
+		if cycles is not None and cycles != len(ladder):
+			raise ValueError('{!r} must be the length of {!r} ({}), not {!r}'.format(CONF_CYCLES, CONF_LADDER, len(ladder), cycles))
+		# (the heating rate is that of the first rung heating from 0K; without that, the first
+		#  linear stage would get a single step)
+		if not from_zero:
+			raise ValueError('{!r} requires {!r} to be true'.format(CONF_LADDER, CONF_FROM_ZERO))
+		cycles = len(ladder)
+	for kind in analysis:
+		if kind not in ANALYSES:
+			raise ValueError('{!r} must be a list of {!r}, not {!r}'.format(CONF_ANALYSIS, ANALYSES, analysis))
+	if isinstance(post_block_hooks, str) or not all(isinstance(x, str) for x in post_block_hooks):
+		raise ValueError('{!r} must be a list of commands, not {!r}'.format(CONF_POST_BLOCK_HOOKS, post_block_hooks))
+	for key, value in [(CONF_NPAR, npar), (CONF_KPAR, kpar)]:
+		if value not in (None, PAR_AUTO) and not (type(value) is int and value >= 1):
+			raise ValueError('{!r} must be {!r} or a positive integer, not {!r}'.format(key, PAR_AUTO, value))
+	for key, value in [(CONF_TUNE_NPAR, tune_npar), (CONF_TUNE_KPAR, tune_kpar)]:
+		if not value or not all(type(x) is int and x >= 1 for x in value):
+			raise ValueError('{!r} must be a list of positive integers, not {!r}'.format(key, value))
+	if type(tune_steps) is not int or tune_steps < 1:
+		raise ValueError('{!r} must be a positive integer, not {!r}'.format(CONF_TUNE_STEPS, tune_steps))
+	if tune_vasp_cmds is not None:
+		if isinstance(tune_vasp_cmds, str) or not tune_vasp_cmds or not all(isinstance(x, str) for x in tune_vasp_cmds):
+			raise ValueError('{!r} must be a list of commands, not {!r}'.format(CONF_TUNE_VASP_CMDS, tune_vasp_cmds))
+		if vasp_bin_from_env:
+			warn('{!r} is ignored because {} is set'.format(CONF_TUNE_VASP_CMDS, ENV_VASP_CMD))
+			tune_vasp_cmds = None
+
+	loop = partial(persistent_loop, backend=state_backend,
+		fsync_every=state_fsync_every, compact_every=state_compact_every)
+
+	open_event_log(VARFILE_MD_EVENTS)
+
+	# Pick NPAR/KPAR (and the launcher) before anything else runs, and record the choice in
+	#  md.conf so that later runs skip this.  (see autotune)
+	if PAR_AUTO in (npar, kpar):
+		best = autotune(
+			vasp_cmds = tune_vasp_cmds or [vasp_bin],
+			npars = tune_npar if npar == PAR_AUTO else [npar],
+			kpars = tune_kpar if kpar == PAR_AUTO else [kpar],
+			steps = tune_steps,
+			temperature = temperature if ladder is None else ladder[0],
+			stage = first_stage_to_run(),
+		)
+		npar, kpar = best['npar'], best['kpar']
+		changes = {CONF_NPAR: npar, CONF_KPAR: kpar}
+		if tune_vasp_cmds:
+			vasp_bin = changes[CONF_VASP_CMD] = best['vasp-cmd']
+		update_conf('md.conf', {k: v for (k, v) in changes.items() if v is not None})
+	substitute_parallelization(npar=npar, kpar=kpar)
+
 	# state tuple contents:
 	#   num:      Current iteration of the main loop (which does each stage in order)
 	#   stage:    Which stage are we currently on
@@ -91,31 +335,133 @@ def _main(*, temperature, from_zero, blocksize, linear_steps, nose_steps, nve_st
 	#              directories where vasp was run directly, and where you will find e.g.
 	#              vasprun.xml and OSZICAR files
 
+	# The loop runs through `cycles` cycles of (linear, nose, nve) stages, or indefinitely if
+	#  `cycles` is None.  For progress reports, the "plan" is all cycles, or else the current one.
+	#
+	# In ladder mode, cycle `num` is run at the temperature ladder[num-1], which is substituted
+	#  for TEMP_REPL in the INCARs of its stages, and there is one cycle per rung.  Each linear
+	#  stage heats (or cools) from the final temperature of the rung before it, and it is given
+	#  only as many steps as that takes at the heating rate of the first rung heating from 0K.
+	#  (i.e. `linear_steps` per ladder[0] kelvin.  The plan does not account for this, so
+	#  progress reports in ladder mode overestimate the total number of steps)
+	#  A ladder therefore always starts from 0K. (see CONF_FROM_ZERO)
+	stage_steps = {STAGE_LINEAR: linear_steps, STAGE_NOSE: nose_steps, STAGE_NVE: nve_steps}
+	stage_offset = {STAGE_LINEAR: 0, STAGE_NOSE: linear_steps, STAGE_NVE: linear_steps + nose_steps}
+	cycle_steps = linear_steps + nose_steps + nve_steps
+	plan_steps = cycle_steps * (cycles or 1)
+	status_path = abspath(VARFILE_MD_STATUS)
+
+	# Each vasp run is a "unit" of work.  Once max_units have been run, the next unit raises
+	#  Suspend instead, which leaves all state files as though the job had been killed there.
+	# (this counts per process, so it is deliberately NOT part of any loop state)
+	#
+	# Upon STOP_SIGNALS, a STOPCAR is written to the directory where vasp is running, so that
+	#  it stops cleanly after the current ionic step.  The stage or block records the steps that
+	#  were completed (see do_nve and do_segments), and the next unit raises Suspend.
+	#  (e.g. use `#SBATCH --signal=B:USR1@300` to get a signal 5 minutes before the time limit)
+	units_left = max_units
+	active_dir = None
+	stop_signal = None
+	def run_unit(**kw):
+		nonlocal units_left, active_dir
+		remove_if_exists('STOPCAR') # e.g. if killed right after one was written
+		active_dir = abspath('.')
+		try:
+			if stop_signal is not None:
+				raise Suspend('received {}'.format(Signals(stop_signal).name))
+			if units_left is not None:
+				if units_left <= 0:
+					raise Suspend('ran {} units of work'.format(max_units))
+				units_left -= 1
+
+			done = do_vasp(**kw)
+			if stop_signal is not None and not done:
+				raise Suspend('received {} before vasp completed a step'.format(Signals(stop_signal).name))
+			return done
+		finally:
+			active_dir = None
+			remove_if_exists('STOPCAR')
+
+	def on_stop_signal(signum, frame):
+		nonlocal stop_signal
+		stop_signal = signum
+		if active_dir is not None:
+			write_stopcar(active_dir)
+	for signum in STOP_SIGNALS:
+		signal(signum, on_stop_signal)
+
+	post_block = PostBlockWork(post_block_hooks, workers=post_block_workers, root=abspath('.'))
+
+	analyzer = None
+	if analysis:
+		analyzer = partial(update_analysis, kinds=analysis, window=analysis_window,
+			rdf_rmax=rdf_rmax, rdf_bins=rdf_bins)
+
 	initial_temp = 0 if from_zero else temperature
 	def do_iter(num=1, stage=STAGE_LINEAR, prevtemp=initial_temp, prevdir=None, leaves=()):
+		post_block.catch_up()
+
+		# The stage before `prevdir` was consumed by a stage that has since finished.
+		if wavecar_retention == WAVECAR_COMPRESS and prevdir is not None:
+			done = previous_stage(*parse_stage_dir_name(prevdir))
+			if done is not None:
+				post_block.submit(compress_wavecar, abspath(stage_dir_name(num=done[0], stage=done[1])))
+
+		if cycles is not None and num > cycles:
+			return EndLoop(leaves)
 
 		curdir = stage_dir_name(num=num, stage=stage)
-		make_trial_subdir(curdir, prevdir)
+		make_trial_subdir(curdir, prevdir, handoff=handoff)
 
+		target = temperature if ladder is None else ladder[num-1]
 		cat_files('INCAR.part', 'INCAR.%s'%stage, dest=join(curdir,'INCAR'))
+		file_subst(join(curdir,'INCAR'), TEMP_REPL, target)
+
+		cur_linear_steps = linear_steps
+		if ladder is not None:
+			cur_linear_steps = ladder_linear_steps(linear_steps, rate_temp=ladder[0], from_temp=prevtemp, to_temp=target)
+
+		detector = None
+		if nose_early_stop:
+			detector = partial(check_equilibrated, target=target, window=equil_window,
+				temp_tol=equil_temp_tol, drift_tol=equil_drift_tol)
+
+		plan_done = stage_offset[stage] + (cycle_steps * (num-1) if cycles else 0)
+		vasp_cmd = partial(run_unit, vasp_bin=vasp_bin,
+			status_path=status_path, status_interval=status_interval,
+			scratch=scratch, sync_interval=scratch_sync_interval,
+			stage_steps=dict(stage_steps, **{STAGE_LINEAR: cur_linear_steps})[stage],
+			plan_done=plan_done, plan_steps=plan_steps,
+		)
 
 		with pushd(curdir):
-			newleaves = do_stage(do_vasp, stage=stage, prevtemp=prevtemp, blocksize=blocksize,
-					linear_steps=linear_steps, nose_steps=nose_steps, nve_steps=nve_steps,
+			newleaves = do_stage(vasp_cmd, stage=stage, prevtemp=prevtemp, blocksize=blocksize,
+					linear_steps=cur_linear_steps, nose_steps=nose_steps, nve_steps=nve_steps,
+					handoff=handoff, loop=loop, block_sizing=block_sizing,
+					walltime_margin=walltime_margin, min_block=min_block, detector=detector,
+					wavecar_retention=wavecar_retention, post_block=post_block, analyzer=analyzer,
 			)
 
 			# we ultimately want these saved as paths relative to the md root dir
 			newleaves = tuple([relpath(x, '..') for x in newleaves])
 
 		endtemp  = read_final_temp(join(newleaves[-1], 'OSZICAR'))
+		extend_lines(VARFILE_MD_ALLDIRS, known=leaves, new=newleaves)
 		leaves += tuple(newleaves)
 		newnum, newstage = next_stage(num=num, stage=stage)
 
-		write_lines(leaves, VARFILE_MD_ALLDIRS)
-
 		return (newnum, newstage, endtemp, curdir, leaves)
 
-	persistent_loop(do_iter, path='md.state')
+	try:
+		post_block.catch_up() # (e.g. hooks that failed in an earlier md-run)
+		loop(do_iter, path='md.state')
+		post_block.catch_up()
+	finally:
+		post_block.close()
+
+	if post_block.failed:
+		raise RuntimeError('{} post-block task(s) failed (see above); they will be retried by the next md-run'.format(
+			len(post_block.failed)))
 
 def next_stage(num, stage):
 	if stage == STAGE_LINEAR:  return (num,   STAGE_NOSE)
@@ -123,29 +469,87 @@ def next_stage(num, stage):
 	elif stage == STAGE_NVE:   return (num+1, STAGE_LINEAR)
 	else: assert False, 'complete switch'
 
+# Steps for a linear stage in ladder mode.  (see _main)
+def ladder_linear_steps(linear_steps, *, rate_temp, from_temp, to_temp):
+	from math import ceil
+	if not rate_temp:
+		return linear_steps
+	return max(1, int(ceil(linear_steps * abs(to_temp - from_temp) / abs(rate_temp))))
+
+# Inverse of next_stage.  (None before the first stage)
+def previous_stage(num, stage):
+	if stage == STAGE_LINEAR:  return (num-1, STAGE_NVE) if num > START_NUM else None
+	elif stage == STAGE_NOSE:  return (num,   STAGE_LINEAR)
+	elif stage == STAGE_NVE:   return (num,   STAGE_NOSE)
+	else: assert False, 'complete switch'
+
 # Expects to be in a stage directory, with POSCAR/KPOINTS/POTCAR, and an INCAR
 #   that still requires substitution for NSW and/or possibly TEBEG
-def do_stage(vasp_cmd, *, stage, prevtemp, blocksize, linear_steps, nose_steps, nve_steps):
+def do_stage(vasp_cmd, *, stage, prevtemp, blocksize, linear_steps, nose_steps, nve_steps, handoff, loop,
+		block_sizing, walltime_margin, min_block, detector, wavecar_retention, post_block, analyzer):
 	if stage == STAGE_LINEAR:
-		return do_linear(vasp_cmd, steps=linear_steps, from_temp=prevtemp)
+		return do_linear(vasp_cmd, steps=linear_steps, from_temp=prevtemp, handoff=handoff, loop=loop)
 	elif stage == STAGE_NOSE:
-		return do_nose(vasp_cmd, steps=nose_steps)
+		return do_nose(vasp_cmd, steps=nose_steps, handoff=handoff, loop=loop, detector=detector)
 	elif stage == STAGE_NVE:
-		return do_nve(vasp_cmd, steps=nve_steps, blocksize=blocksize)
+		return do_nve(vasp_cmd, steps=nve_steps, blocksize=blocksize, handoff=handoff, loop=loop,
+				block_sizing=block_sizing, walltime_margin=walltime_margin, min_block=min_block,
+				wavecar_retention=wavecar_retention, post_block=post_block, analyzer=analyzer)
 	else: assert False, 'complete switch'
 
 def stage_dir_name(*, num, stage):
 	return '{}-{}'.format(num,stage)
 
+# Inverse of stage_dir_name.
+def parse_stage_dir_name(name):
+	num, stage = name.split('-', 1)
+	return int(num), stage
+
+# List the leaf directories (relative to mddir) whose vasp runs have finished, in order.
+# This is the content of VARFILE_MD_ALLDIRS, plus the finished blocks of an NVE stage
+#  that is still in progress.
+def finished_leaves(mddir='.'):
+	from os.path import normpath
+	path = join(mddir, VARFILE_MD_ALLDIRS)
+	leaves = stripped_lines(path) if exists(path) else []
+
+	path = join(mddir, 'md.state')
+	state = load_loop_state(path) if exists(path) else ()
+	if isinstance(state, EndLoop):
+		return leaves
+
+	num, stage = state[:2] if state else (START_NUM, STAGE_LINEAR)
+	curdir = stage_dir_name(num=num, stage=stage)
+	path = join(mddir, curdir, stage_state_file(stage))
+	if exists(path):
+		state = load_loop_state(path)
+		if isinstance(state, EndLoop):
+			names = state.value
+		elif state:
+			i, _sizes, names = state[:3]
+			names = names[:i]
+		else:
+			names = []
+		leaves += [normpath(join(curdir, name)) for name in names]
+	return leaves
+
+# Name of the file with the loop state for the runs within a stage directory.
+def stage_state_file(stage):
+	return 'nve.state' if stage == STAGE_NVE else 'segments.state'
+
 
 #-----------------------------------------------------
 
 # Handles creation of non-INCAR input files for a 'sub-trial'
-def make_trial_subdir(name, continue_from_name=None):
+def make_trial_subdir(name, continue_from_name=None, *, handoff):
 	from os.path import sep
 	if sep in name:
 		raise ValueError('name must be a single path component, not {!r}'.format(name))
 
+	with timed_event('setup', where=name):
+		_make_trial_subdir(name, continue_from_name, handoff=handoff)
+
+def _make_trial_subdir(name, continue_from_name, *, handoff):
 	mkdir(name)
 	with pushd(name):
 		symlink('../POTCAR', 'POTCAR')
@@ -153,12 +557,96 @@ def make_trial_subdir(name, continue_from_name=None):
 
 	if continue_from_name is None:
 		symlink('../POSCAR', join(name, 'POSCAR'))
-		copy_if_exists('WAVECAR', join(name, 'WAVECAR'))
+		handoff_file('WAVECAR', join(name, 'WAVECAR'), mode=handoff, writable=True, optional=True)
 	else:
 		prev = continue_from_name
-		copy_file(join(prev, 'WAVECAR'), join(name, 'WAVECAR'))
-		copy_file(join(prev, 'CONTCAR'), join(name, 'POSCAR'))
+		handoff_file(join(prev, 'WAVECAR'), join(name, 'WAVECAR'), mode=handoff, writable=True)
+		handoff_file(join(prev, 'CONTCAR'), join(name, 'POSCAR'), mode=handoff, writable=False, keep_src=True)
 
+# Pass a file on from a finished stage or block to the next one, avoiding a full copy
+#  where the handoff mode and filesystem permit it.
+#
+#  mode:      HANDOFF_COPY:  Always copy.
+#             HANDOFF_LINK:  Reflink (copy-on-write clone) if the filesystem supports it.
+#                            Otherwise hardlink, unless `writable`. Otherwise copy.
+#                            It is always safe to rerun an interrupted iteration in this mode.
+#             HANDOFF_MOVE:  Like HANDOFF_LINK, but if reflinking is not possible then `src`
+#                            is moved rather than copied (unless `keep_src`).
+#  writable:  Whether vasp will be run on `dest`, overwriting it in place. (so that it must
+#             not share storage with `src`)
+#  keep_src:  Never remove `src`, even in HANDOFF_MOVE mode.
+#  optional:  Do nothing if `src` does not exist.
+#
+# Rerunning an interrupted iteration in HANDOFF_MOVE mode:  Before `src` is renamed (or after
+#  it is reflinked or copied, since it may then be removed under CONF_WAVECAR_RETENTION), its
+#  size is recorded in `src` + HANDOFF_RECORD_SUFFIX.  If `src` is then found missing, the record
+#  says where it went:
+#
+#   * If `dest` exists with the recorded size, it is used as is.  Since vasp normally writes
+#     WAVECAR only at the end of a run, this is what was originally moved unless the
+#     interrupted run got that far (in which case it is a later wavefunction, which is still
+#     a fine starting guess).
+#   * If `dest` has since been moved on in turn (e.g. from a stage directory to its first
+#     block), there is nothing to do.
+#   * Otherwise (no record, or `dest` missing or of a different size, e.g. because vasp was
+#     killed while writing it), an error is raised, rather than starting the next run from
+#     a missing or truncated file.
+#
+# In the other modes, a missing `src` is accepted only if `dest` exists, which is the case when
+#  `src` was removed under CONF_WAVECAR_RETENTION after `dest` was made.
+def handoff_file(src, dest, *, mode, writable, keep_src=False, optional=False):
+	from os.path import getsize, dirname
+	if mode == HANDOFF_MOVE and keep_src:
+		mode = HANDOFF_LINK
+
+	if not exists(src):
+		if optional:
+			return
+		if mode == HANDOFF_MOVE:
+			check_moved_file(src, dest)
+			return # moved by an earlier, interrupted attempt
+		if exists(dest):
+			return # handed off by an earlier, interrupted attempt, and since retired
+		raise RuntimeError('cannot hand off {}: neither it nor {} exists'.format(src, dest))
+
+	with timed_event('copy', where=dirname(dest) or '.', src=src, dest=dest, mode=mode, bytes=getsize(src)) as ev:
+		if mode == HANDOFF_COPY:
+			copy_file(src, dest)
+			ev['method'] = 'copy'
+		elif try_reflink(src, dest):
+			ev['method'] = 'reflink'
+		elif mode == HANDOFF_LINK and not writable and try_hardlink(src, dest):
+			ev['method'] = 'hardlink'
+		elif mode == HANDOFF_MOVE and try_rename(src, dest, record=src + HANDOFF_RECORD_SUFFIX):
+			ev['method'] = 'rename'
+		else:
+			copy_file(src, dest)
+			ev['method'] = 'copy'
+
+	# `src` outlived a reflink or copy, but may still be retired before the state that records
+	#  this handoff is saved. (e.g. the last block's WAVECAR under WAVECAR_STAGES)
+	if mode == HANDOFF_MOVE and ev['method'] != 'rename':
+		write_json(src + HANDOFF_RECORD_SUFFIX, {'dest': relpath(dest, dirname(src)), 'bytes': getsize(src)})
+
+# For a `src` that is missing on a rerun in HANDOFF_MOVE mode.  (see handoff_file)
+def check_moved_file(src, dest):
+	from json import load
+	from os.path import getsize
+	record_path = src + HANDOFF_RECORD_SUFFIX
+	if not exists(record_path):
+		if exists(dest):
+			raise RuntimeError('cannot hand off {}: it is missing, and there is no record of it being moved to {} '
+				'(remove {} to continue from it anyway)'.format(src, dest, dest))
+		raise RuntimeError('cannot hand off {}: neither it nor {} exists'.format(src, dest))
+	with open(record_path) as f:
+		expected = load(f)['bytes']
+
+	if exists(dest):
+		if getsize(dest) != expected:
+			raise RuntimeError('{} was moved to {}, which is now {} bytes rather than {} (perhaps vasp was killed while '
+				'writing it); remove it to start that run without it'.format(src, dest, getsize(dest), expected))
+	elif not exists(dest + HANDOFF_RECORD_SUFFIX):
+		raise RuntimeError('{} was moved to {}, which is now missing'.format(src, dest))
 
 #-------------------------------------
 # 'do_x' functions
@@ -168,15 +656,28 @@ def make_trial_subdir(name, continue_from_name=None):
 #  into INCAR), and they may or may not further divide their work up into multiple VASP runs.
 #  They return a list of "leaf" directories (as paths relative to '.') where VASP was run directly.
 
-def do_linear(vasp_cmd, *, steps, from_temp):
-	file_subst('INCAR', STEPS_REPL, steps)
-	file_subst('INCAR', TEBEG_REPL, from_temp)
-
-	vasp_cmd()
-
-	return ['.']
+def do_linear(vasp_cmd, *, steps, from_temp, handoff, loop):
+	return do_segments(vasp_cmd, steps=steps, from_temp=from_temp, handoff=handoff, loop=loop, detector=None)
 
-def do_nve(vasp_cmd, *, steps, blocksize):
+# Run the NVE stage as a series of blocks, each in its own directory.
+#
+# With BLOCK_SIZING_FIXED, the stage is split up front into blocks of `blocksize` steps.
+# With BLOCK_SIZING_ADAPTIVE, each block is sized just before it runs, so that it can finish
+#  `walltime_margin` seconds before the job is killed (see remaining_walltime), based on the
+#  seconds per step measured in earlier blocks.  It is never larger than `blocksize`.
+#  If less than `min_block` steps would fit, Suspend is raised instead.
+#
+# A block that stops early (because of a STOPCAR) is cut short, and the rest of its steps are
+#  done by the next block.
+#
+# WAVECARs of earlier blocks are removed or compressed according to `wavecar_retention`, and
+#  finished blocks are fed to `analyzer` (see update_analysis), if not None.
+# This, and the hooks of finished blocks, is left to `post_block` (a PostBlockWork), so that
+#  only the setup of the next block comes between one vasp run and the next.
+def do_nve(vasp_cmd, *, steps, blocksize, handoff, loop, block_sizing, walltime_margin, min_block,
+		wavecar_retention, post_block, analyzer):
+	from os.path import abspath
+	from time import time
 
 	# set up a series run
 	fullblocks, remainder = divmod(steps, blocksize)
@@ -186,71 +687,1243 @@ def do_nve(vasp_cmd, *, steps, blocksize):
 	# When resuming an interrupted run, we use the names/sizes originally chosen for that run.
 	# (thus, it is safe to e.g. modify this script and change the format of the names, and this
 	#  will not impact any existing, incomplete runs)
-	names_if_new = ['{:03d}'.format(i+1) for i in range(fullblocks + extrablock)]
-	sizes_if_new = [blocksize]*fullblocks + [remainder]*extrablock
-	assert len(names_if_new) == len(sizes_if_new)
-	assert sum(sizes_if_new) == steps
+	if block_sizing == BLOCK_SIZING_FIXED:
+		names_if_new = ['{:03d}'.format(i+1) for i in range(fullblocks + extrablock)]
+		sizes_if_new = [blocksize]*fullblocks + [remainder]*extrablock
+		assert len(names_if_new) == len(sizes_if_new)
+		assert sum(sizes_if_new) == steps
+	else:
+		# chosen one at a time
+		names_if_new = []
+		sizes_if_new = []
+
+	# state tuple contents:
+	#   i:      Index of the current block.
+	#   sizes:  Number of steps in each block.  (under BLOCK_SIZING_ADAPTIVE, a block is added
+	#            to this only once it starts, and is resized if it is rerun after an interruption)
+	#   names:  Directory name of each block.
+	#   prev:   Directory of the previous block, or None.
+	#   secs:   Wall time taken by each block that has been run. (None if unknown, e.g. for
+	#            blocks run by an older version that did not record it)
+	def do_iter(i=0, sizes=sizes_if_new, names=names_if_new, prev=None, secs=None):
+		if secs is None:
+			secs = [None] * i
+
+		post_block.catch_up()
+		post_block.submit(retire_block_wavecars, [abspath(x) for x in names], finished=i, retention=wavecar_retention)
+		if analyzer is not None and i:
+			post_block.submit(analyzer, abspath('.'), names[:i])
 
-	def do_iter(i=0, sizes=sizes_if_new, names=names_if_new, prev=None):
 		if i == len(sizes):
-			# let code after the loop know the names that were actually used,
-			# since they may differ from `names_if_new`
-			return EndLoop(names)
+			if block_sizing == BLOCK_SIZING_FIXED or sum(sizes) >= steps:
+				# let code after the loop know the names that were actually used,
+				# since they may differ from `names_if_new`
+				return EndLoop(names)
+
+			size = adaptive_block_size(
+				remaining_steps=steps - sum(sizes), blocksize=blocksize,
+				sec_per_step=measured_sec_per_step(sizes[:i], secs),
+				walltime_margin=walltime_margin, min_block=min_block,
+			)
+			sizes = list(sizes) + [size]
+			names = list(names) + ['{:03d}'.format(i+1)]
 
 		cur, size = names[i], sizes[i]
 
-		make_trial_subdir(cur, prev)
+		make_trial_subdir(cur, prev, handoff=handoff)
 		with pushd(cur):
 			copy_file('../INCAR', 'INCAR')
 			file_subst('INCAR', STEPS_REPL, size)
 
-			vasp_cmd()
+			start = time()
+			done = vasp_cmd(steps=size, done_before=sum(sizes[:i]))
+			secs = list(secs) + [time() - start]
 
-		return i+1, sizes, names, cur
+		# Stopped early (by STOPCAR); this block ends here, and the rest of it becomes a new block.
+		if done < size:
+			if not done:
+				raise RuntimeError('{}: vasp completed no ionic steps'.format(cur))
+			sizes = list(sizes)
+			sizes[i] = done
+			if block_sizing == BLOCK_SIZING_FIXED:
+				sizes.insert(i+1, size - done)
+				names = list(names[:i+1]) + ['{:03d}'.format(j+1) for j in range(i+1, len(sizes))]
+
+		return i+1, sizes, names, cur, secs
 
-	true_names = persistent_loop(do_iter, path='nve.state')
+	true_names = loop(do_iter, path='nve.state')
 
 	# finalize
-	copy_file(join(true_names[-1], 'WAVECAR'), 'WAVECAR')
-	copy_file(join(true_names[-1], 'CONTCAR'), 'CONTCAR')
+	handoff_file(join(true_names[-1], 'WAVECAR'), 'WAVECAR', mode=handoff, writable=False)
+	handoff_file(join(true_names[-1], 'CONTCAR'), 'CONTCAR', mode=handoff, writable=False, keep_src=True)
+
+	if analyzer is not None:
+		post_block.submit(analyzer, abspath('.'), true_names)
+
+	# the stage directory now has the last block's WAVECAR
+	if wavecar_retention in (WAVECAR_STAGES, WAVECAR_COMPRESS):
+		post_block.submit(retire_block_wavecars, [abspath(x) for x in true_names],
+			finished=len(true_names) + 1, retention=wavecar_retention)
 
 	return true_names
 
-def do_nose(vasp_cmd, *, steps):
-	file_subst('INCAR', STEPS_REPL, steps)
+# Apply a WAVECAR retention policy to the NVE blocks `names`, of which the first `finished`
+#  have been run.  The WAVECAR of a block is needed until the next block has been run (since a
+#  rerun of that block must be able to start from it again), so only blocks before that are
+#  touched:
+#
+#    WAVECAR_KEEP_ALL:  Nothing is done.
+#    N:                 The WAVECAR is removed from all but the last N blocks that have been run.
+#    WAVECAR_STAGES:    The WAVECAR is removed from every block, leaving only those of the stage
+#                        directories.  (do_nve hands the one of the final block to its stage
+#                        directory before removing it)
+#    WAVECAR_COMPRESS:  The WAVECAR is gzipped.  (as are those of stage directories, in _main)
+#
+# This is idempotent, so it can simply be redone whenever an iteration is rerun.
+def retire_block_wavecars(names, *, finished, retention):
+	if retention == WAVECAR_KEEP_ALL:
+		return
+	if retention == WAVECAR_COMPRESS:
+		for name in names[:max(0, finished - 1)]:
+			compress_wavecar(name)
+		return
+
+	keep = 1 if retention == WAVECAR_STAGES else retention
+	for name in names[:max(0, finished - keep)]:
+		remove_if_exists(join(name, 'WAVECAR'))
+
+# Replace WAVECAR in a directory by WAVECAR.gz (if it has one).
+# (one at a time, since PostBlockWork may run this for the same directory twice at once)
+COMPRESS_LOCK = Lock()
+def compress_wavecar(directory):
+	import gzip
+	from os import rename
+	from os.path import getsize
+	from shutil import copyfileobj
+	path = join(directory, 'WAVECAR')
+	with COMPRESS_LOCK:
+		if not exists(path):
+			return # nothing to do, or already done
+		with timed_event('compress', where=directory, bytes=getsize(path)):
+			with open(path, 'rb') as src, gzip.open(path + '.gz.tmp', 'wb', compresslevel=1) as dest:
+				copyfileobj(src, dest, 1 << 20)
+			rename(path + '.gz.tmp', path + '.gz')
+			remove_if_exists(path)
+
+#-------------------------------------
+# Post-block work
+#
+# Work on the outputs of a finished leaf (a stage or NVE block) that the next vasp run does
+#  not depend on is done in a pool of CONF_POST_BLOCK_WORKERS threads, while that run goes on.
+#
+# This includes the CONF_POST_BLOCK_HOOKS: shell commands (e.g. to archive or parse outputs, or
+#  to append to a trajectory) that are run in order for each finished leaf, with that leaf as
+#  the working directory, and with these environment variables:
+#
+#    VASPMD_MDDIR   Absolute path of the md directory.
+#    VASPMD_LEAF    The leaf, relative to the md directory. (as in md.leaves)
+#    VASPMD_STAGE   The stage it belongs to. (linear, nose or nve)
+#
+# e.g.  "post-block-hooks": ["gzip -f vasprun.xml", "cat XDATCAR >> $VASPMD_MDDIR/traj.xdatcar"]
+#
+# Each hook that succeeds is recorded in POST_BLOCK_DONE in the leaf.  Hooks for every finished
+#  leaf that are not recorded there are (re)submitted whenever the next leaf starts, or md-run
+#  is started again, so a hook that was killed or failed is retried; hooks should therefore be
+#  safe to rerun.  With more than one worker, hooks for different leaves may run out of order.
+#  Note that in the 'move' handoff mode, the WAVECAR of a leaf is gone by the time its hooks run.
+#
+# Failures are reported when they happen, and md-run fails at the end if there were any.
+#  (an md-run that is suspended does not, so that e.g. the next job of a chain can retry them)
+
+class PostBlockWork:
+	def __init__(self, hooks, *, workers, root):
+		self.hooks = [x.strip() for x in hooks]
+		self.workers = workers
+		self.root = root
+		self.executor = None
+		self.seen = set() # leaves whose hooks are done, or have been submitted by this process
+		self.failed = []
+
+	def submit(self, func, *args, **kw):
+		from concurrent.futures import ThreadPoolExecutor
+		if self.executor is None:
+			self.executor = ThreadPoolExecutor(max_workers=self.workers)
+		self.executor.submit(self.run_task, func, args, kw)
+
+	# Submit the hooks for the leaves that have finished since the last call.
+	def catch_up(self):
+		if not self.hooks:
+			return
+		for leaf in finished_leaves(self.root):
+			if leaf not in self.seen:
+				self.seen.add(leaf)
+				self.submit(self.run_hooks, leaf)
+
+	# Wait for everything that was submitted.
+	def close(self):
+		if self.executor is not None:
+			self.executor.shutdown(wait=True)
+			self.executor = None
+
+	def run_task(self, func, args, kw):
+		try:
+			func(*args, **kw)
+		except Exception as e:
+			print('md-run: post-block task failed: {}'.format(e), flush=True)
+			self.failed.append(e)
+
+	def run_hooks(self, leaf):
+		from os import environ
+		from subprocess import check_call
+		directory = join(self.root, leaf)
+		path = join(directory, POST_BLOCK_DONE)
+		done = stripped_lines(path) if exists(path) else []
+
+		env = dict(environ, VASPMD_MDDIR=self.root, VASPMD_LEAF=leaf,
+			VASPMD_STAGE=parse_stage_dir_name(leaf.split('/')[0])[1])
+		for cmd in self.hooks:
+			if cmd in done:
+				continue
+			with timed_event('hook', where=directory, cmd=cmd):
+				check_call(cmd, shell=True, cwd=directory, env=env)
+			with open(path, 'a') as f:
+				f.write(cmd + '\n')
+
+# Seconds per ionic step over the blocks with a recorded time, or None if there are none.
+def measured_sec_per_step(sizes, secs):
+	timed = [(n, t) for (n, t) in zip(sizes, secs) if t is not None]
+	if not timed or not sum(n for (n, _) in timed):
+		return None
+	return sum(t for (_, t) in timed) / sum(n for (n, _) in timed)
+
+# Size of the next block under BLOCK_SIZING_ADAPTIVE.
+def adaptive_block_size(*, remaining_steps, blocksize, sec_per_step, walltime_margin, min_block):
+	size = min(blocksize, remaining_steps)
+
+	left = remaining_walltime()
+	if left is None or sec_per_step is None:
+		return size # nothing to go on
+
+	fits = int((left - walltime_margin) / sec_per_step)
+	if fits < min(min_block, size):
+		raise Suspend('only {:.1f}s of walltime remain; the next block needs at least {:.1f}s'.format(
+			left, min(min_block, size) * sec_per_step + walltime_margin))
+	return min(size, fits)
+
+# If a `detector` is given (see check_equilibrated), the stage ends as soon as the system
+#  is found to be equilibrated.
+def do_nose(vasp_cmd, *, steps, handoff, loop, detector):
+	return do_segments(vasp_cmd, steps=steps, from_temp=None, handoff=handoff, loop=loop, detector=detector)
+
+# Run a stage that is normally done in a single vasp run, in the stage directory itself.
+#
+# If vasp stops early (i.e. because of a STOPCAR), the remaining steps are run as a
+#  continuation in a subdirectory 'cont-001' (then 'cont-002', ...), starting from where it
+#  stopped.  When continuations are used, the final CONTCAR and WAVECAR are placed in the
+#  stage directory, as if it had all been done in one run.
+#
+#  from_temp:  Value for TEBEG in the first run, or None if INCAR does not need one.
+#              Continuations start from the final temperature of the previous run.
+#  detector:   Passed on to do_vasp.  A run that it stops ends the stage (no continuation).
+def do_segments(vasp_cmd, *, steps, from_temp, handoff, loop, detector):
+	# The INCAR is fresh from the template each time a stage is entered,
+	#  and every segment substitutes into its own copy.
+	with open('INCAR') as f:
+		template = f.read()
+
+	# state tuple contents are as in do_nve, except that the first name is always '.'.
+	def do_iter(i=0, sizes=(steps,), names=('.',), prev=None):
+		if i == len(sizes):
+			return EndLoop(names)
+
+		cur, size = names[i], sizes[i]
+		if cur != '.':
+			make_trial_subdir(cur, prev, handoff=handoff)
+
+		temp = from_temp
+		if from_temp is not None and prev is not None:
+			temp = read_final_temp(join(prev, 'OSZICAR'))
+
+		with pushd(cur):
+			with open('INCAR', 'w') as f:
+				f.write(template)
+			file_subst('INCAR', STEPS_REPL, size)
+			if temp is not None:
+				file_subst('INCAR', TEBEG_REPL, temp)
+
+			remove_if_exists(EQUIL_FILE) # from an earlier attempt
+			done = vasp_cmd(steps=size, done_before=sum(sizes[:i]), detector=detector)
+			equilibrated = exists(EQUIL_FILE)
 
-	vasp_cmd()
+		if done < size:
+			if not done:
+				raise RuntimeError('{}: vasp completed no ionic steps'.format(relpath(cur, '..')))
+			sizes = tuple(sizes[:i]) + (done,)
+			if not equilibrated:
+				sizes += (size - done,)
+				names = tuple(names) + ('cont-{:03d}'.format(len(names)),)
 
-	return ['.']
+		return i+1, sizes, names, cur
+
+	true_names = loop(do_iter, path='segments.state')
+
+	# finalize
+	if len(true_names) > 1:
+		handoff_file(join(true_names[-1], 'WAVECAR'), 'WAVECAR', mode=handoff, writable=False)
+		handoff_file(join(true_names[-1], 'CONTCAR'), 'CONTCAR', mode=handoff, writable=False, keep_src=True)
+
+	return list(true_names)
 
-def do_vasp():
+# Runs vasp in the current directory.
+#
+#  vasp_bin:     Shell command that runs vasp.
+#  steps:        NSW for this run.
+#  done_before:  Steps of the current stage completed by earlier runs (i.e. NVE blocks).
+#  stage_steps:  Total steps in the current stage.
+#  plan_done:    Steps of the current plan (cycle of stages) completed before this stage.
+#  plan_steps:   Total steps in the plan.
+#  detector:     Optional function to decide when to stop vasp early. (see check_equilibrated)
+#
+# Returns the number of ionic steps that were completed, which is less than `steps` if vasp
+#  was stopped early by a STOPCAR.
+#
+# While vasp runs, a background thread follows the OSZICAR and periodically writes progress
+#  and throughput to `status_path` (see write_status). A `status_interval` of 0 disables this.
+#
+# If `scratch` is not None, vasp actually runs in a new directory under it, and the outputs
+#  are synced back every `sync_interval` seconds and once more at the end. (see ScratchRun)
+def do_vasp(*, vasp_bin, steps, done_before, stage_steps, plan_done, plan_steps, status_path, status_interval,
+		detector=None, scratch=None, sync_interval=None):
+	from os.path import abspath, dirname
 	from subprocess import check_call
-	check_call(VASP_BIN_NAME, shell=True)
+	from threading import Thread, Event
+	from time import time
+
+	with ScratchRun(scratch, sync_interval=sync_interval) as rundir:
+		if not status_interval and detector is None:
+			with timed_event('vasp', where='.', steps=steps) as ev:
+				check_call(vasp_bin, shell=True, cwd=rundir)
+				ev['done'] = count_completed_steps(join(rundir, 'OSZICAR'))
+			return ev['done']
+
+		stop = Event()
+		monitor = Thread(target=monitor_progress, daemon=True, kwargs=dict(
+			stop=stop, oszicar=join(abspath(rundir), 'OSZICAR'), interval=status_interval or EQUIL_POLL_INTERVAL,
+			status_path=status_path if status_interval else None, detector=detector,
+			leaf=relpath('.', dirname(status_path)),
+			start=time(), steps=steps, stage_done=done_before, stage_steps=stage_steps,
+			plan_done=plan_done + done_before, plan_steps=plan_steps,
+		))
+		monitor.start()
+		try:
+			with timed_event('vasp', where='.', steps=steps) as ev:
+				check_call(vasp_bin, shell=True, cwd=rundir)
+				ev['done'] = count_completed_steps(join(rundir, 'OSZICAR'))
+		finally:
+			stop.set()
+			monitor.join()
+		return ev['done']
+
+def count_completed_steps(oszicar='OSZICAR'):
+	last = read_last_oszicar_step(oszicar) if exists(oszicar) else None
+	return 0 if last is None else last.step
+
+# Ask a running vasp to stop after the current ionic step.
+def write_stopcar(directory):
+	with open(join(directory, 'STOPCAR'), 'w') as f:
+		f.write('LSTOP = .TRUE.\n')
 
 #------------------------------------------------
+# Scratch staging
+#
+# With CONF_SCRATCH (e.g. "$TMPDIR"), vasp does not run in the leaf directory on the shared
+#  filesystem, but in a fresh directory on that (presumably node-local) path:
+#
+#  * On entry, every file in the leaf directory is copied there.  (following symlinks)
+#  * A STOPCAR there is a symlink back to the leaf directory, so that STOPCARs written to
+#    the leaf directory (see _main and monitor_progress) reach vasp.
+#  * While vasp runs, a background thread copies new or changed files back to the leaf
+#    directory every `sync_interval` seconds.  (so that e.g. md-status and a look at the
+#    OSZICAR still work)
+#  * On exit (whether or not vasp succeeded), all files are copied back once more, and
+#    compared byte for byte with the originals.  (a copy that differs is discarded, rather than
+#    replacing the file in the leaf directory)  Only then is the scratch directory removed,
+#    and only then does do_vasp return, so that the loop state never records a run whose
+#    outputs are not safely on the shared filesystem.  If this final sync fails, the scratch
+#    directory is left behind, and the error names it.
+#
+# Each copy is written to a temporary name and renamed into place, so that the leaf directory
+#  never holds a partial file.
 
-def read_final_temp(oszicar):
-	# lazy hacky un-robust way
-	with open(oszicar, 'rt') as f:
-		temperature = None
+class ScratchRun:
+	def __init__(self, scratch, *, sync_interval):
+		self.scratch = scratch
+		self.sync_interval = sync_interval
+		self.synced = {} # fname -> (mtime_ns, size) of the scratch copy as of the last sync
+
+	# Yields the directory that vasp should run in.
+	def __enter__(self):
+		from os import listdir
+		from os.path import abspath, isfile, getsize
+		from tempfile import mkdtemp
+		from threading import Thread, Event
+		if self.scratch is None:
+			return '.'
+
+		self.leaf = abspath('.')
+		self.rundir = mkdtemp(prefix='vaspmd-', dir=self.scratch)
+		with timed_event('sync', where='.', direction='in', rundir=self.rundir) as ev:
+			ev['bytes'] = 0
+			for fname in listdir('.'):
+				if isfile(fname) and fname != 'STOPCAR':
+					copy_file(fname, join(self.rundir, fname))
+					ev['bytes'] += getsize(fname)
+		self.synced = {fname: file_version(join(self.rundir, fname)) for fname in listdir(self.rundir)}
+		symlink(join(self.leaf, 'STOPCAR'), join(self.rundir, 'STOPCAR'))
+
+		self.stop = Event()
+		self.thread = Thread(target=self.sync_periodically, daemon=True)
+		self.thread.start()
+		return self.rundir
+
+	def __exit__(self, exc_type, exc_val, traceback):
+		from shutil import rmtree
+		if self.scratch is None:
+			return
+		self.stop.set()
+		self.thread.join()
+		try:
+			with timed_event('sync', where='.', direction='final', rundir=self.rundir) as ev:
+				ev['bytes'] = self.sync(verify=True)
+				self.verify()
+		except Exception as e:
+			if exc_val is None:
+				raise RuntimeError('{}: could not sync the outputs of vasp back from {}, which is left as is'.format(
+					self.leaf, self.rundir)) from e
+			print('md-run: could not sync the outputs of vasp back from {}: {}'.format(self.rundir, e))
+			return # report the original error
+		rmtree(self.rundir)
+
+	def sync_periodically(self):
+		while not self.stop.wait(self.sync_interval):
+			try:
+				with timed_event('sync', where=self.leaf, direction='out', rundir=self.rundir) as ev:
+					ev['bytes'] = self.sync()
+			except OSError as e:
+				print('md-run: warning: periodic sync from {} failed: {}'.format(self.rundir, e))
+
+	# Copy back the files that changed since the last sync.  Returns the number of bytes copied.
+	# With `verify`, each copy is compared with the original before it replaces the file in the
+	#  leaf directory, so that a bad copy never overwrites a good one.  (not for periodic syncs,
+	#  where vasp may still be writing the original)
+	def sync(self, verify=False):
+		from filecmp import cmp
+		from os import listdir, rename
+		from os.path import isfile, islink
+		nbytes = 0
+		for fname in sorted(listdir(self.rundir)):
+			src = join(self.rundir, fname)
+			if islink(src) or not isfile(src):
+				continue
+			version = file_version(src)
+			if self.synced.get(fname) == version:
+				continue
+			tmp = join(self.leaf, '.{}.sync-tmp'.format(fname))
+			copy_file(src, tmp)
+			if verify and not cmp(src, tmp, shallow=False):
+				remove_if_exists(tmp)
+				raise RuntimeError('the copy of {} differs from the original'.format(src))
+			rename(tmp, join(self.leaf, fname))
+			self.synced[fname] = version
+			nbytes += version[1]
+		return nbytes
+
+	def verify(self):
+		from filecmp import cmp
+		from os import listdir
+		from os.path import isfile, islink
+		for fname in listdir(self.rundir):
+			src = join(self.rundir, fname)
+			if islink(src) or not isfile(src):
+				continue
+			if not cmp(src, join(self.leaf, fname), shallow=False):
+				raise RuntimeError('{} differs from {}'.format(join(self.leaf, fname), src))
+
+# (mtime_ns, size), for telling whether a file changed
+def file_version(path):
+	from os import stat
+	st = stat(path)
+	return (st.st_mtime_ns, st.st_size)
+
+#------------------------------------------------
+# Parallelization tuning
+#
+# With 'npar' (and/or 'kpar') set to PAR_AUTO in md.conf (see md-init --npar), md-run begins by
+#  running vasp for 'tune-steps' ionic steps on a copy of the inputs of the first stage it will
+#  run (usually the first linear stage, but e.g. NVE for a run made by md-fork), at the target
+#  temperature and without a WAVECAR, once for each combination of:
+#
+#   * an NPAR from 'tune-npar'  (default [1, 2, 4, 8])
+#   * a KPAR from 'tune-kpar'   (default [1]), if 'kpar' is PAR_AUTO
+#   * a command from 'tune-vasp-cmds', to also compare launchers and rank layouts, e.g.
+#     ["srun -n 32 vasp_std", "srun -n 16 -c 2 vasp_std"].  (default: just the usual command)
+#
+# The fastest combination is written to md.conf as 'npar', 'kpar' and 'vasp-cmd', and substituted
+#  for NPAR_REPL and KPAR_REPL in the INCAR templates of the md directory.
+#
+# Speed is the median of the "real time" of the LOOP+ lines in the OUTCAR, skipping the first
+#  ionic step (which also sets up the wavefunctions); or failing that, the wall time over the
+#  number of steps completed.  A trial in which vasp fails (e.g. because NPAR does not suit the
+#  number of ranks) is out of the running.
+#
+# Each trial runs in TUNE_DIR/NNN and records its result there in TUNE_FILE, so that interrupted
+#  tuning resumes at the first unfinished trial.  The full table is written to TUNE_DIR/results.json.
+
+# Returns the result of the fastest trial.
+def autotune(*, vasp_cmds, npars, kpars, steps, temperature, stage):
+	from itertools import product
+	mkdir(TUNE_DIR)
+	trials = []
+	for i, (vasp_cmd, npar, kpar) in enumerate(product(vasp_cmds, npars, kpars)):
+		params = {'vasp-cmd': vasp_cmd, 'npar': npar, 'kpar': kpar}
+		trial = run_tuning_trial(join(TUNE_DIR, '{:03d}'.format(i + 1)), params, steps=steps,
+			temperature=temperature, stage=stage)
+		print('md-run: tuning: NPAR = {}, KPAR = {}, {!r}: {}'.format(npar, kpar, vasp_cmd,
+			'failed' if trial['sec-per-step'] is None else '{:.3f} s/step'.format(trial['sec-per-step'])), flush=True)
+		trials.append(trial)
+
+	ok = [t for t in trials if t['sec-per-step'] is not None]
+	if not ok:
+		raise RuntimeError('every tuning trial failed (see {})'.format(TUNE_DIR))
+	best = min(ok, key=lambda t: t['sec-per-step'])
+	write_json(join(TUNE_DIR, 'results.json'), {'best': best, 'trials': trials})
+	print('md-run: tuning: chose NPAR = {}, KPAR = {}, {!r}'.format(best['npar'], best['kpar'], best['vasp-cmd']))
+	return best
+
+def run_tuning_trial(name, params, *, steps, temperature, stage):
+	from json import load
+	from shutil import rmtree
+	from subprocess import check_call, CalledProcessError
+	from time import time
+	path = join(name, TUNE_FILE)
+	if exists(path):
+		with open(path) as f:
+			result = load(f)
+		if (result['steps'] == steps and result.get('stage', STAGE_LINEAR) == stage
+				and all(result[k] == v for (k, v) in params.items())):
+			return result
+	if exists(name):
+		rmtree(name) # interrupted, or for different settings
+
+	mkdir(name)
+	for fname in ['POSCAR', 'KPOINTS', 'POTCAR']:
+		symlink(join('..', '..', fname), join(name, fname))
+	incar = join(name, 'INCAR')
+	cat_files('INCAR.part', 'INCAR.%s' % stage, dest=incar)
+	for repl, value in [(STEPS_REPL, steps), (TEBEG_REPL, temperature), (TEMP_REPL, temperature),
+			(NPAR_REPL, params['npar']), (KPAR_REPL, params['kpar'])]:
+		if value is not None:
+			file_subst(incar, repl, value)
+
+	result = dict(params, steps=steps, stage=stage, done=0, wall=None, exit=None)
+	result['sec-per-step'] = None
+	with timed_event('tune', where=name, **params) as ev:
+		start = time()
+		try:
+			check_call(params['vasp-cmd'], shell=True, cwd=name)
+		except CalledProcessError as e:
+			result['exit'] = ev['exit'] = e.returncode
+		result['wall'] = time() - start
+		result['done'] = count_completed_steps(join(name, 'OSZICAR'))
+		if result['exit'] is None and result['done']:
+			result['sec-per-step'] = tuning_sec_per_step(join(name, 'OUTCAR'), wall=result['wall'], done=result['done'])
+		ev['sec-per-step'] = result['sec-per-step']
+
+	write_json(path, result)
+	return result
+
+# The stage that the main loop of _main begins (or resumes) at.
+def first_stage_to_run():
+	state = load_loop_state('md.state') if exists('md.state') else ()
+	if isinstance(state, EndLoop) or not state:
+		return STAGE_LINEAR
+	return state[1]
+
+def tuning_sec_per_step(outcar, *, wall, done):
+	from statistics import median
+	times = read_loop_times(outcar)
+	if times:
+		return median(times[1:] or times)
+	return wall / done
+
+# "real time" of each LOOP+ line (one per ionic step) of an OUTCAR
+def read_loop_times(outcar):
+	from re import search
+	out = []
+	if not exists(outcar):
+		return out
+	with open(outcar, errors='replace') as f:
 		for line in f:
-			if 'T=' in line:
-				# third word
-				word = line.strip().split()[2]
+			if 'LOOP+' in line:
+				m = search(r'real time\s*([0-9.]+)', line)
+				if m:
+					out.append(float(m.group(1)))
+	return out
+
+# Write the NPAR and KPAR into the INCAR templates of the md directory.  (a no-op once done)
+def substitute_parallelization(*, npar, kpar):
+	from glob import glob
+	for fname in sorted(glob('INCAR.*')):
+		with open(fname) as f:
+			text = f.read()
+		for key, repl, value in [(CONF_NPAR, NPAR_REPL, npar), (CONF_KPAR, KPAR_REPL, kpar)]:
+			if repl not in text:
+				continue
+			if value is None:
+				raise ValueError('{} has a placeholder for {}, but md.conf has no {!r}'.format(fname, key.upper(), key))
+			file_subst(fname, repl, value)
 
-				assert word[-1] == '.'
-				word = word[:-1]
+#------------------------------------------------
+# Job chains
+#
+# Rather than one job with a walltime long enough for the whole plan, md-run can be run as a
+#  chain of short jobs, each of which does a few units of work (--max-units) and then exits
+#  successfully, leaving the state files for the next job to resume from:
+#
+#      sbatch md-run --chain --max-units 4
+#
+# With --chain, a job begins by submitting its own successor:
+#
+#      sbatch --parsable --kill-on-invalid-dep=yes --dependency=afterok:$SLURM_JOB_ID md-run ...
+#
+# with the same script and arguments, so the successor waits in the queue while this job runs,
+#  and starts only if this job succeeds.  (options given to the original sbatch on the command
+#  line are not carried over; put them in #SBATCH lines in the script)
+# The ID of the most recent successor is recorded in VARFILE_MD_CHAIN.  A job that finds that
+#  successor still queued (e.g. because the job was requeued) does not submit another.
+# The job that finishes the plan cancels its successor.
+
+# Raised to stop md-run between units of work.  The state files are left as they would be if
+#  it were killed at that point, so that a later run can resume.
+class Suspend(Exception):
+	pass
+
+def chain_successor(jobid):
+	import sys
+	from os.path import abspath
+	from subprocess import check_output
+
+	if exists(VARFILE_MD_CHAIN):
+		with open(VARFILE_MD_CHAIN) as f:
+			prev = f.read().strip()
+		if prev and prev != jobid and job_is_queued(prev):
+			print('md-run: successor {} is already queued'.format(prev))
+			return prev
+
+	with timed_event('subprocess', where='.', cmd=SBATCH_BIN_NAME):
+		out = check_output([
+			SBATCH_BIN_NAME, '--parsable', '--kill-on-invalid-dep=yes',
+			'--dependency=afterok:{}'.format(jobid),
+			abspath(sys.argv[0]),
+		] + sys.argv[1:], universal_newlines=True)
+	successor = out.strip().split(';')[0] # --parsable prints "jobid[;cluster]"
+
+	write_lines([successor], VARFILE_MD_CHAIN)
+	print('md-run: submitted successor {}'.format(successor))
+	return successor
+
+def cancel_successor():
+	from subprocess import call
+	if not exists(VARFILE_MD_CHAIN):
+		return
+	with open(VARFILE_MD_CHAIN) as f:
+		successor = f.read().strip()
+	if successor and job_is_queued(successor):
+		with timed_event('subprocess', where='.', cmd=SCANCEL_BIN_NAME):
+			call([SCANCEL_BIN_NAME, successor])
+		print('md-run: cancelled successor {}'.format(successor))
+
+# Seconds until this job is killed, or None if there is no known limit.
+# Taken from ENV_END_TIME, or else slurm (SLURM_JOB_END_TIME, or else squeue).
+def remaining_walltime():
+	from os import environ
+	from time import time
+	from subprocess import check_output, CalledProcessError, DEVNULL
+
+	for var in (ENV_END_TIME, ENV_SLURM_JOB_END_TIME):
+		if environ.get(var):
+			return float(environ[var]) - time()
+
+	if ENV_SLURM_JOB_ID not in environ:
+		return None
+	try:
+		out = check_output([SQUEUE_BIN_NAME, '-h', '-j', environ[ENV_SLURM_JOB_ID], '-o', '%L'],
+			universal_newlines=True, stderr=DEVNULL)
+	except (OSError, CalledProcessError):
+		return None
+	return parse_slurm_duration(out.strip())
+
+# Parse a duration printed by slurm, like "1-02:03:04", "02:03:04", or "03:04".
+# Returns seconds, or None for e.g. "UNLIMITED" or "NOT_SET".
+def parse_slurm_duration(s):
+	days, _, hms = s.rpartition('-')
+	try:
+		parts = [int(x) for x in hms.split(':')]
+		days = int(days) if days else 0
+	except ValueError:
+		return None
+	if not 1 <= len(parts) <= 3:
+		return None
+	parts = [0] * (3 - len(parts)) + parts
+	h, m, sec = parts
+	return ((days * 24 + h) * 60 + m) * 60 + sec
+
+def job_is_queued(jobid):
+	from subprocess import check_output, CalledProcessError, DEVNULL
+	try:
+		out = check_output([SQUEUE_BIN_NAME, '-h', '-j', jobid, '-o', '%T'],
+			universal_newlines=True, stderr=DEVNULL)
+	except CalledProcessError: # e.g. "Invalid job id" once the job has left the queue
+		return False
+	return out.strip() in ('PENDING', 'CONFIGURING', 'RUNNING', 'REQUEUED', 'RESIZING', 'SUSPENDED')
 
-				try: temperature = int(word)
-				except ValueError: pass
+#------------------------------------------------
+# Event log
+#
+# Once open_event_log has been called, each vasp run, file handoff, state save, trial directory
+#  setup and subprocess call appends one JSON line to the log, e.g.
+#
+#     {"event": "copy", "where": "1-nve/003", "time": 1462381272.1, "wall": 0.84, "ok": true,
+#      "src": "../002/WAVECAR", "dest": "WAVECAR", "mode": "copy", "method": "copy", "bytes": 1073741824}
+#
+#   where:  The directory it concerns, relative to the directory of the log.
+#   time:   Unix time at the start.
+#   wall:   Seconds taken.
+#   ok:     false if it raised an exception.  ('error' then holds the type of exception, and
+#            'exit' the exit status of a failed subprocess)
+#
+# plus fields specific to each event.  md-profile summarizes the log.
+#
+# The log is process-wide (like the working directory), and may be written from any thread.
+
+EVENT_LOG = {'path': None, 'root': None}
+EVENT_LOG_LOCK = Lock()
+
+def open_event_log(path):
+	from os.path import abspath, dirname
+	EVENT_LOG['path'] = abspath(path)
+	EVENT_LOG['root'] = dirname(abspath(path))
+
+def log_event(event, *, where, **fields):
+	from json import dumps
+	from os.path import abspath
+	if EVENT_LOG['path'] is None:
+		return
+	line = dumps(dict(event=event, where=relpath(abspath(where), EVENT_LOG['root']), **fields)) + '\n'
+	with EVENT_LOG_LOCK:
+		with open(EVENT_LOG['path'], 'a') as f:
+			f.write(line)
+
+# Times the body of a 'with' block and logs it as an event.
+# Fields can be added to the dict that it yields.
+class timed_event:
+	def __init__(self, event, *, where, **fields):
+		self.event = event
+		self.where = where
+		self.fields = fields
 
-		if temperature is None:
-			raise RuntimeError('read_final_temp failed to match pattern')
-		return temperature
+	def __enter__(self):
+		from time import time
+		self.start = time()
+		return self.fields
+
+	def __exit__(self, exc_type, exc, tb):
+		from time import time
+		fields = dict(time=self.start, wall=time() - self.start, ok=exc is None, **self.fields)
+		if exc is not None:
+			fields['error'] = exc_type.__name__
+			if hasattr(exc, 'returncode'):
+				fields['exit'] = exc.returncode
+		try:
+			log_event(self.event, where=self.where, **fields)
+		except OSError:
+			pass # never let the log take down the run
+		return False
 
+#------------------------------------------------
+# Progress monitoring
+
+# Body of the thread started by do_vasp.  Polls the OSZICAR every `interval` seconds until
+#  `stop` is set.  Step counts named *_done are those completed before this vasp run started.
+# If `status_path` is None, no status file is written.
+# If `detector` is given, it is called on the OSZICAR data each time; when it reports that the
+#  system is equilibrated, its statistics are written to EQUIL_FILE and vasp is stopped.
+def monitor_progress(*, stop, oszicar, interval, status_path, detector, leaf, start,
+		steps, stage_done, stage_steps, plan_done, plan_steps):
+	from os.path import getmtime, dirname
+	from time import time
+	from warnings import warn
 
+	first = None # (time, step) when a step was first seen, so that vasp's startup is not counted
+	finished = False
+	detected = False
+	while True:
+		try:
+			now = time()
+
+			# (ignore output left over from an earlier, interrupted attempt)
+			step = None
+			if exists(oszicar) and getmtime(oszicar) >= start:
+				step = read_last_oszicar_step(oszicar)
+			step = 0 if step is None else step.step
+
+			if step and first is None:
+				first = (now, step)
+			rate = None
+			if first is not None and step > first[1]:
+				rate = (step - first[1]) / (now - first[0])
+
+			if detector is not None and step and not detected and not finished:
+				stats = detector(read_oszicar_arrays(oszicar))
+				if stats['equilibrated']:
+					write_json(join(dirname(oszicar), EQUIL_FILE), stats)
+					write_stopcar(dirname(oszicar))
+					detected = True
+
+			if status_path is not None:
+				write_status(status_path, leaf=leaf, now=now, elapsed=now - start, rate=rate,
+					progress=[
+						('leaf',  step, steps),
+						('stage', stage_done + step, stage_steps),
+						('plan',  plan_done + step, plan_steps),
+					],
+				)
+		except Exception as e: # pylint: disable=broad-except
+			# never let a hiccup in monitoring take down the run
+			warn('progress monitor: {}'.format(e))
+
+		if finished:
+			return
+		finished = stop.wait(interval) # (one last update after vasp exits)
+
+# Write a small JSON file describing progress, e.g.
+#
+#     {"leaf": "1-nve/003", "updated": "2016-05-04 13:01:12", "elapsed": 1234.5,
+#      "steps-per-second": 0.21,
+#      "leaf-step": 250, "leaf-steps": 1000, "leaf-eta": 3571.4,
+#      "stage-step": 2250, "stage-steps": 5000, "stage-eta": 13095.2,
+#      "plan-step": 4250, "plan-steps": 7000, "plan-eta": 13095.2}
+#
+#  progress:  A list of (name, step, total).  ETAs (in seconds) are null until a rate is known.
+def write_status(path, *, leaf, now, elapsed, rate, progress):
+	from time import strftime, localtime
+
+	status = {
+		'leaf': leaf,
+		'updated': strftime('%Y-%m-%d %H:%M:%S', localtime(now)),
+		'elapsed': elapsed,
+		'steps-per-second': rate,
+	}
+	for name, step, total in progress:
+		status[name + '-step'] = step
+		status[name + '-steps'] = total
+		status[name + '-eta'] = (total - step) / rate if rate else None
 
+	write_json(path, status)
 
+#------------------------------------------------
+# Equilibration detection
+
+# Decide whether a thermostatted run has equilibrated, from the OSZICAR data of the run so far
+#  (as returned by read_oszicar_arrays).  Only the last `window` steps are considered, and all of
+#  these tests must pass:
+#
+#   * mean:    The mean temperature is within a relative tolerance `temp_tol` of `target`.
+#   * blocks:  So is the mean temperature of each of EQUIL_BLOCKS consecutive blocks of the window.
+#   * drift:   Neither the temperature nor the free energy F drifts across the window (as measured
+#              by a least squares line) by more than `drift_tol` standard deviations.
+#
+# Returns a dict of the statistics, for the record, with 'equilibrated' set to the verdict.
+def check_equilibrated(data, *, target, window, temp_tol, drift_tol):
+	import numpy as np
+
+	steps, temps, energies = data['step'], data['T'], data['F']
+	stats = {
+		'step': int(steps[-1]) if len(steps) else 0,
+		'target-temperature': target,
+		'window': window,
+		'temp-tol': temp_tol,
+		'drift-tol': drift_tol,
+		'equilibrated': False,
+	}
+	if len(steps) < window or window < EQUIL_BLOCKS:
+		return stats
+
+	steps, temps, energies = steps[-window:], temps[-window:], energies[-window:]
+	if np.isnan(temps).any() or np.isnan(energies).any():
+		return stats
+
+	def drift(y):
+		slope = np.polyfit(steps, y, 1)[0]
+		return float(abs(slope) * (steps[-1] - steps[0]))
+
+	block_means = [float(x.mean()) for x in np.array_split(temps, EQUIL_BLOCKS)]
+	stats.update({
+		'first-step': int(steps[0]),
+		'temperature-mean': float(temps.mean()),
+		'temperature-std': float(temps.std()),
+		'temperature-block-means': block_means,
+		'temperature-drift': drift(temps),
+		'energy-mean': float(energies.mean()),
+		'energy-std': float(energies.std()),
+		'energy-drift': drift(energies),
+	})
+	tol = temp_tol * target
+	stats['tests'] = {
+		'mean': abs(stats['temperature-mean'] - target) <= tol,
+		'blocks': all(abs(x - target) <= tol for x in block_means),
+		'temperature-drift': stats['temperature-drift'] <= drift_tol * stats['temperature-std'],
+		'energy-drift': stats['energy-drift'] <= drift_tol * stats['energy-std'],
+	}
+	stats['equilibrated'] = all(stats['tests'].values())
+	return stats
+
+#------------------------------------------------
+# Streaming analysis
+#
+# With CONF_ANALYSIS, each NVE block is analyzed as soon as it finishes (as post-block work),
+#  rather than after the whole run.  The stage directory gets:
+#
+#    msd.dat    Mean squared displacement (angstrom^2) against the lag between frames, for all
+#               atoms, and for each species.
+#    vacf.dat   Velocity autocorrelation (angstrom^2/fs^2, and normalized), with velocities
+#               taken from the difference between consecutive frames.
+#    rdf.dat    Radial distribution function g(r) over all pairs of atoms, averaged over frames.
+#
+# Each begins with a '#' line naming the columns, and has the lag in frames and in fs (from
+#  POTIM and NBLOCK in the INCAR of the first block) for the first two.
+#
+# MSD and VACF use every frame as a time origin, but only up to CONF_ANALYSIS_WINDOW frames
+#  apart.  The last `window` frames (unwrapped positions and velocities) are kept in a ring
+#  buffer, so that memory is O(window * natoms) however long the run is.  Positions are
+#  unwrapped across the periodic boundaries from one frame to the next, so an atom must not
+#  travel more than half a cell between frames.
+# The RDF goes out to CONF_RDF_RMAX (by default, half of the narrowest width of the cell, the
+#  largest distance for which the minimum image is unique) in CONF_RDF_BINS bins.
+#
+# All of this state, and the blocks that were consumed, is kept in ANALYSIS_STATE next to
+#  nve.state, and saved after each block; so it carries on across restarts, and a block that
+#  was being consumed when md-run was killed is simply consumed again.  The settings used to
+#  create it are kept too, and take priority over md.conf.
+
+ANALYSIS_LOCK = Lock()
+RDF_CHUNK_PAIRS = 1 << 18
+
+# Consume the blocks `names` of the NVE stage in `stagedir` that have not been already,
+#  in order.  (safe to call from many threads at once)
+def update_analysis(stagedir, names, *, kinds, window, rdf_rmax, rdf_bins):
+	from pickle import load
+	statepath = join(stagedir, ANALYSIS_STATE)
+	with ANALYSIS_LOCK:
+		state = None
+		if exists(statepath):
+			with open(statepath, 'rb') as f:
+				state = load(f)
+
+		new = [name for name in names if state is None or name not in state['blocks']]
+		if not new:
+			return
+
+		for name in new:
+			with timed_event('analysis', where=join(stagedir, name)) as ev:
+				xdatcar = join(stagedir, name, 'XDATCAR')
+				if state is None:
+					state = new_analysis_state(join(stagedir, name), kinds=kinds, window=window,
+						rdf_rmax=rdf_rmax, rdf_bins=rdf_bins)
+				nframes = 0
+				if exists(xdatcar): # (a block that stopped before writing a frame has none)
+					for cell, _species, _counts, frac in iter_xdatcar(xdatcar):
+						consume_analysis_frame(state, cell, frac)
+						nframes += 1
+				state['blocks'].append(name)
+				write_loop_snapshot(statepath, state)
+				ev['frames'] = nframes
+
+		write_analysis_output(stagedir, state)
+
+def new_analysis_state(blockdir, *, kinds, window, rdf_rmax, rdf_bins):
+	import numpy as np
+	incar = read_incar_values(join(blockdir, 'INCAR'))
+	try: dt = float(incar.get('POTIM')) * int(incar.get('NBLOCK', 1))
+	except (TypeError, ValueError): dt = float('nan')
+
+	_, species, counts, _ = next(iter_xdatcar(join(blockdir, 'XDATCAR')), (None, None, None, None))
+	if counts is None:
+		raise RuntimeError('{}: cannot start the analysis from a block with no frames'.format(blockdir))
+	natoms = sum(counts)
+	return {
+		'kinds': list(kinds), 'window': window, 'dt': dt,
+		'species': species, 'counts': counts,
+		'blocks': [], 'nframes': 0,
+		# unwrapping
+		'last-frac': None, 'image': np.zeros((natoms, 3)),
+		# ring buffers; frame t is at t % window
+		'positions': np.zeros((window, natoms, 3)), 'velocities': np.zeros((window, natoms, 3)),
+		'msd-sum': np.zeros((window, 1 + len(counts))), 'msd-count': np.zeros(window),
+		'vacf-sum': np.zeros(window), 'vacf-count': np.zeros(window),
+		'rdf-rmax': rdf_rmax, 'rdf-bins': rdf_bins, 'rdf-hist': np.zeros(rdf_bins),
+		'rdf-frames': 0, 'rdf-volume': 0.0,
+	}
+
+def consume_analysis_frame(state, cell, frac):
+	import numpy as np
+	window, t = state['window'], state['nframes']
+	counts = state['counts']
+
+	if state['last-frac'] is not None:
+		state['image'] -= np.rint(frac - state['last-frac'])
+	state['last-frac'] = frac
+	pos = (frac + state['image']).dot(cell)
+
+	# lags 1 .. min(t, window-1), against frames still in the buffer
+	lags = np.arange(1, min(t, window - 1) + 1)
+	earlier = (t - lags) % window
+	if ANALYSIS_MSD in state['kinds'] and len(lags):
+		sq = ((state['positions'][earlier] - pos) ** 2).sum(axis=-1) # (lag, atom)
+		by_species = np.add.reduceat(sq, np.cumsum([0] + list(counts[:-1])), axis=1) / counts
+		state['msd-sum'][lags] += np.column_stack([sq.mean(axis=1), by_species])
+		state['msd-count'][lags] += 1
+
+	if ANALYSIS_VACF in state['kinds'] and t >= 1:
+		vel = (pos - state['positions'][(t - 1) % window]) / state['dt']
+		# velocities exist from frame 1 on, so lags 0 .. min(t-1, window-1)
+		vlags = np.arange(0, min(t - 1, window - 1) + 1)
+		vearlier = (t - vlags) % window
+		state['velocities'][t % window] = vel
+		state['vacf-sum'][vlags] += (state['velocities'][vearlier] * vel).sum(axis=-1).mean(axis=1)
+		state['vacf-count'][vlags] += 1
+
+	if ANALYSIS_RDF in state['kinds']:
+		if state['rdf-rmax'] is None:
+			state['rdf-rmax'] = 0.5 * min_cell_width(cell)
+		state['rdf-hist'] += rdf_histogram(frac, cell, bins=state['rdf-bins'], rmax=state['rdf-rmax'])
+		state['rdf-frames'] += 1
+		state['rdf-volume'] += abs(np.linalg.det(cell))
+
+	state['positions'][t % window] = pos
+	state['nframes'] = t + 1
+
+# Histogram of the minimum image distances between all pairs of atoms in a frame.
+# The pairs (i, j > i) are done a few rows of i at a time, so that memory stays at about
+#  RDF_CHUNK_PAIRS pairs, rather than growing as natoms^2.
+def rdf_histogram(frac, cell, *, bins, rmax):
+	import numpy as np
+	natoms = len(frac)
+	rows = max(1, RDF_CHUNK_PAIRS // max(natoms, 1))
+	hist = np.zeros(bins)
+	for start in range(0, natoms - 1, rows):
+		stop = min(start + rows, natoms - 1)
+		d = frac[start:stop, None, :] - frac[None, :, :] # (row, j, 3)
+		d -= np.rint(d)
+		upper = np.arange(natoms)[None, :] > np.arange(start, stop)[:, None]
+		r = np.sqrt((d[upper].dot(cell) ** 2).sum(axis=-1))
+		hist += np.histogram(r, bins=bins, range=(0, rmax))[0]
+	return hist
+
+def write_analysis_output(stagedir, state):
+	import numpy as np
+	from os import rename
+	window, dt = state['window'], state['dt']
+	species = state['species'] or ['species{}'.format(k+1) for k in range(len(state['counts']))]
+
+	def save(fname, columns, data):
+		tmp = join(stagedir, fname + '.tmp')
+		np.savetxt(tmp, data, header=' '.join(columns), fmt='%.8g')
+		rename(tmp, join(stagedir, fname))
+
+	lags = np.arange(window)
+	if ANALYSIS_MSD in state['kinds']:
+		ok = state['msd-count'] > 0
+		ok[0] = True # (zero)
+		msd = state['msd-sum'] / np.maximum(state['msd-count'], 1)[:, None]
+		save('msd.dat', ['lag', 'time', 'all'] + species, np.column_stack([lags, lags * dt, msd])[ok])
+
+	if ANALYSIS_VACF in state['kinds']:
+		ok = state['vacf-count'] > 0
+		vacf = state['vacf-sum'] / np.maximum(state['vacf-count'], 1)
+		norm = vacf / vacf[0] if ok[0] and vacf[0] else np.full(window, np.nan)
+		save('vacf.dat', ['lag', 'time', 'vacf', 'normalized'], np.column_stack([lags, lags * dt, vacf, norm])[ok])
+
+	if ANALYSIS_RDF in state['kinds'] and state['rdf-frames']:
+		natoms = sum(state['counts'])
+		edges = np.linspace(0, state['rdf-rmax'], state['rdf-bins'] + 1)
+		shells = 4/3 * np.pi * (edges[1:] ** 3 - edges[:-1] ** 3)
+		density = natoms * (natoms - 1) / 2 / (state['rdf-volume'] / state['rdf-frames'])
+		g = state['rdf-hist'] / state['rdf-frames'] / (density * shells)
+		save('rdf.dat', ['r', 'g'], np.column_stack([(edges[1:] + edges[:-1]) / 2, g]))
+
+# The distance between opposite faces of the cell, for the closest pair of faces.
+def min_cell_width(cell):
+	import numpy as np
+	volume = abs(np.linalg.det(cell))
+	return min(volume / np.linalg.norm(np.cross(cell[(k+1) % 3], cell[(k+2) % 3])) for k in range(3))
+
+# A few INCAR tags, as strings.  (only the first value of each tag)
+def read_incar_values(path):
+	out = {}
+	with open(path) as f:
+		for line in f:
+			line = line.split('#')[0].split('!')[0]
+			for part in line.split(';'):
+				if '=' in part:
+					key, value = part.split('=', 1)
+					if value.split():
+						out[key.strip().upper()] = value.split()[0]
+	return out
+
+#------------------------------------------------
+
+def read_final_temp(oszicar):
+	step = read_last_oszicar_step(oszicar)
+	if step is None:
+		raise RuntimeError('read_final_temp found no ionic steps in {!r}'.format(oszicar))
+	return step.T
+
+#------------------------------------------------
+# OSZICAR reading
+#
+# In an MD run, each ionic step produces one line of the form
+#
+#      42 T=   301. E= -.12345678E+03 F= -.12312345E+03 E0= -.12312345E+03  EK= 0.12345E+01 SP= 0.11E+00 SK= 0.23E-01
+#
+# in between the lines for electronic steps.  Fields that are missing from a line
+#  (e.g. SP and SK without a thermostat) are read as NaN.
+
+from collections import namedtuple
+from re import compile as _re_compile
+
+OSZICAR_FIELDS = ['T', 'E', 'F', 'E0', 'EK', 'SP', 'SK']
+OszicarStep = namedtuple('OszicarStep', ['step'] + OSZICAR_FIELDS)
+
+_OSZICAR_STEP_RE = _re_compile(r'^\s*(\d+)\s+T=')
+_OSZICAR_FIELD_RE = _re_compile(r'(\w+)=\s*(\S+)')
+
+# Parse one line of an OSZICAR, returning an OszicarStep, or None for lines that are not ionic steps.
+def parse_oszicar_step(line):
+	m = _OSZICAR_STEP_RE.match(line)
+	if not m:
+		return None
+
+	fields = dict(_OSZICAR_FIELD_RE.findall(line))
+	values = []
+	for name in OSZICAR_FIELDS:
+		try: values.append(float(fields[name]))
+		except (KeyError, ValueError): values.append(float('nan'))
+	return OszicarStep(int(m.group(1)), *values)
+
+# Get the last ionic step in an OSZICAR (or None if there are none yet) by reading backwards
+#  from the end of the file, so that the cost does not grow with the length of the run.
+# A partially-written line at the end of the file (from a running vasp) is ignored.
+def read_last_oszicar_step(path, chunksize=1<<14):
+	from os import SEEK_END
+	with open(path, 'rb') as f:
+		pos = f.seek(0, SEEK_END)
+		buf = b''
+		trimmed = False # whether the unterminated last line has been dropped from buf
+		while pos > 0:
+			start = max(0, pos - chunksize)
+			f.seek(start)
+			buf = f.read(pos - start) + buf
+			pos = start
+
+			if not trimmed:
+				if b'\n' not in buf:
+					continue
+				buf = buf[:buf.rindex(b'\n')]
+				trimmed = True
+
+			# Every line in buf is now complete, except possibly the first
+			#  (unless we've reached the start of the file)
+			lines = buf.split(b'\n')
+			complete = lines if pos == 0 else lines[1:]
+			for line in reversed(complete):
+				step = parse_oszicar_step(line.decode('utf-8', 'replace'))
+				if step is not None:
+					return step
+
+			buf = lines[0]
+	return None
+
+# Read every ionic step of an OSZICAR into a dict of numpy arrays, with keys 'step' and OSZICAR_FIELDS.
+# The file is streamed line by line, so the only memory that grows with its length is the output.
+# As in read_last_oszicar_step, a partially-written line at the end of the file is ignored.
+def read_oszicar_arrays(path):
+	import numpy as np
+	steps = []
+	columns = [[] for _ in OSZICAR_FIELDS]
+	with open(path, 'rt') as f:
+		for line in f:
+			if not line.endswith('\n'):
+				break
+			step = parse_oszicar_step(line)
+			if step is None:
+				continue
+			steps.append(step.step)
+			for column, value in zip(columns, step[1:]):
+				column.append(value)
+
+	out = {'step': np.array(steps, dtype=int)}
+	for name, column in zip(OSZICAR_FIELDS, columns):
+		out[name] = np.array(column, dtype=float)
+	return out
+
+#------------------------------------------------
+# XDATCAR reading
+
+# Iterate over the frames of an XDATCAR, yielding tuples (cell, species, counts, frac) where
+#  cell is a 3x3 array of lattice vectors (rows, in angstrom), and frac has shape (natoms, 3)
+#  and holds fractional coordinates.  species is None for files without a species line.
+#
+# Handles both the fixed-cell format (header once) and the variable-cell format (header before
+#  every frame).  A truncated final frame (e.g. from a vasp that is still running) is ignored.
+def iter_xdatcar(path):
+	import numpy as np
+	cell = species = counts = None
+	with open(path, 'rt') as f:
+		while True:
+			line = f.readline()
+			if not line:
+				return
+			if not line.strip():
+				continue
+
+			words = line.split()
+			if 'configuration' in line and words[0].lower() in ('direct', 'cartesian'):
+				if counts is None:
+					raise RuntimeError('{}: frame before header'.format(path))
+				rows = [f.readline().split()[:3] for _ in range(sum(counts))]
+				try: frac = np.array(rows, dtype=float).reshape(-1, 3)
+				except ValueError: return # truncated
+
+				if words[0].lower() == 'cartesian':
+					frac = frac.dot(np.linalg.inv(cell))
+				yield cell, species, counts, frac
+
+			else:
+				# header (`line` was the comment)
+				scale = float(f.readline().split()[0])
+				lattice = np.array([f.readline().split()[:3] for _ in range(3)], dtype=float)
+				words = f.readline().split()
+				if all(w.isdigit() for w in words):
+					species = None
+				else:
+					species = words
+					words = f.readline().split()
+				counts = [int(w) for w in words]
+
+				if scale < 0: # negative scale is a volume
+					scale = (-scale / abs(np.linalg.det(lattice))) ** (1/3)
+				cell = lattice * scale
 
 #-------------------------------------------
 
@@ -305,6 +1978,20 @@ def write_lines(lines, path):
 	with open(path, 'wt') as f:
 		f.writelines('%s\n' % x for x in lines)
 
+# Append `new` to a file written by write_lines whose lines are known to begin with `known`,
+#  without rewriting the known lines.  Anything after them (e.g. written by an earlier,
+#  interrupted attempt) is discarded first.
+def extend_lines(path, *, known, new):
+	from os.path import getsize
+	size = sum(len(('%s\n' % x).encode()) for x in known)
+	if not exists(path) or getsize(path) < size:
+		write_lines(list(known) + list(new), path)
+		return
+	with open(path, 'r+b') as f:
+		f.truncate(size)
+		f.seek(size)
+		f.write(''.join('%s\n' % x for x in new).encode())
+
 # like ln -sf
 def symlink(src, dest):
 	from os import symlink as _symlink, unlink
@@ -329,11 +2016,74 @@ def copy_if_exists(src, dest):
 	if exists(src):
 		copy_file(src, dest)
 
+# Write JSON atomically, so that readers never see a partial file
+def write_json(path, obj):
+	from json import dump
+	from os import rename
+	with open(path + '.tmp', 'w') as f:
+		dump(obj, f, indent=1)
+	rename(path + '.tmp', path)
+
 # touch. might not update timestamps
 def touch(path):
 	with open(path, 'a'):
 		pass
 
+# cp --reflink=always; returns False (leaving dest untouched) if the filesystem can't do it
+def try_reflink(src, dest):
+	from fcntl import ioctl
+	from os import rename
+	FICLONE = 0x40049409 # from linux/fs.h
+	tmp = dest + '.tmp'
+	try:
+		with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdest:
+			ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+	except OSError:
+		remove_if_exists(tmp)
+		return False
+	rename(tmp, dest)
+	return True
+
+# ln -f; returns False (leaving dest untouched) if the filesystem can't do it
+def try_hardlink(src, dest):
+	from os import link, rename
+	tmp = dest + '.tmp'
+	remove_if_exists(tmp)
+	try:
+		link(src, tmp)
+	except OSError:
+		return False
+	rename(tmp, dest)
+	return True
+
+# mv -T; returns False if src is on a different filesystem.
+# Refuses to move a file with other hardlinks, since the destination may be written to.
+# `record` (if given) is a JSON file written beforehand with the size of `src`, so that the
+#  move can be recognized later. (see handoff_file)
+def try_rename(src, dest, *, record=None):
+	from os import rename, stat
+	from os.path import dirname
+	st = stat(src)
+	if st.st_nlink != 1:
+		return False
+	if record is not None:
+		write_json(record, {'dest': relpath(dest, dirname(src)), 'bytes': st.st_size})
+	try:
+		rename(src, dest)
+	except OSError:
+		if record is not None:
+			remove_if_exists(record)
+		return False
+	return True
+
+# rm -f
+def remove_if_exists(path):
+	from os import unlink
+	try:
+		unlink(path)
+	except FileNotFoundError:
+		pass
+
 #----------------------------------------------------
 # Some very un-Pythonic syntax hacks in an attempt to make the code
 #  easier to read and verify
@@ -342,6 +2092,14 @@ class EndLoop():
 	def __init__(self, value):
 		self.value = value
 
+STATE_BACKEND_PICKLE  = 'pickle'
+STATE_BACKEND_JOURNAL = 'journal'
+STATE_BACKENDS = [STATE_BACKEND_PICKLE, STATE_BACKEND_JOURNAL]
+
+JOURNAL_TAG      = 'vaspmd-journal'
+JOURNAL_SNAPSHOT = 'snapshot'
+JOURNAL_DELTA    = 'delta'
+
 # Make a sort of iterator that records its current state in a file.
 #
 #  f(*args) -> nextargs  A function performed each iteration, which either returns:
@@ -350,6 +2108,9 @@ class EndLoop():
 #                         c) EndLoop (equivalent to EndLoop(None))
 #                        Arguments must be pickleable.
 #  path                  Where to save the state.
+#  backend               STATE_BACKEND_PICKLE rewrites the whole state each iteration.
+#                        STATE_BACKEND_JOURNAL appends only what changed; see _journal_loop.
+#                        Either backend can resume from a file written by the other.
 #
 # Use like this:
 #
@@ -391,19 +2152,17 @@ class EndLoop():
 #  more like an iterator.  In truth, several iterator-like designs were tried out prior to this
 #  design, but each were found to encourage making a variety of logic errors with regards to
 #  modification of local variables not preserved in the state tuple.
-def persistent_loop(f, path, initialstate=()):
+def persistent_loop(f, path, initialstate=(), *, backend=STATE_BACKEND_PICKLE, fsync_every=1, compact_every=100):
+	if backend == STATE_BACKEND_JOURNAL:
+		return _journal_loop(f, path, initialstate, fsync_every=fsync_every, compact_every=compact_every)
+	elif backend != STATE_BACKEND_PICKLE:
+		raise ValueError('unknown state backend: {!r}'.format(backend))
+
 	def load():
-		from pickle import load as _load
-		with open(path, 'rb') as f:
-			return _load(f)
+		return load_loop_state(path)
 
 	def save(st):
-		from pickle import dump
-		from os import rename
-		tmppath = path + '.tmp'
-		with open(tmppath, 'wb') as f:
-			dump(st, f)
-		rename(tmppath, path)
+		write_loop_snapshot(path, st)
 
 	if not exists(path):
 		save(initialstate)
@@ -421,6 +2180,159 @@ def persistent_loop(f, path, initialstate=()):
 
 		save(state)
 
+# persistent_loop with STATE_BACKEND_JOURNAL.
+#
+# The file is a sequence of pickled records (JOURNAL_TAG, seq, kind, payload), where `kind` is
+#  JOURNAL_SNAPSHOT (payload is the state) or JOURNAL_DELTA (payload is the difference from the
+#  previous state; see diff_loop_state).  Only a delta is appended after each iteration, so
+#  state that grows over time (like 'leaves') costs O(1) I/O per iteration rather than O(n).
+#
+#  fsync_every:    fsync the journal after this many records. (0 to leave it to the OS)
+#  compact_every:  Once the journal holds this many records, replace it with a single snapshot.
+#
+# A partially written final record (or anything after a gap in `seq`) is discarded on load.
+# Unlike the pickle backend, state is not reloaded from disk between iterations.
+def _journal_loop(f, path, initialstate, *, fsync_every, compact_every):
+	from os import fsync, truncate
+	from os.path import getsize, dirname
+	from pickle import dump
+
+	if exists(path):
+		state, seq, nrecords, end = read_loop_journal(path)
+		if end < getsize(path):
+			truncate(path, end)
+	else:
+		state, seq, nrecords = initialstate, 0, 0
+
+	fh = None
+	unsynced = 0
+	try:
+		while True:
+			if nrecords == 0 or nrecords >= compact_every:
+				if fh is not None:
+					fh.close()
+					fh = None
+				write_loop_snapshot(path, (JOURNAL_TAG, seq, JOURNAL_SNAPSHOT, state), fsync=True)
+				nrecords, unsynced = 1, 0
+
+			if isinstance(state, EndLoop):
+				return state.value
+
+			newstate = f(*state)
+			# Support returning just EndLoop (without instantiation)
+			if newstate is EndLoop:
+				newstate = EndLoop(None)
+
+			delta = diff_loop_state(state, newstate)
+			if delta is None:
+				record = (JOURNAL_TAG, seq+1, JOURNAL_SNAPSHOT, newstate)
+			else:
+				record = (JOURNAL_TAG, seq+1, JOURNAL_DELTA, delta)
+
+			with timed_event('state-save', where=dirname(path) or '.', path=path, kind='journal') as ev:
+				if fh is None:
+					fh = open(path, 'ab')
+				start = fh.tell()
+				dump(record, fh)
+				fh.flush()
+				ev['bytes'] = fh.tell() - start
+				nrecords += 1
+				unsynced += 1
+				if fsync_every and unsynced >= fsync_every:
+					fsync(fh.fileno())
+					unsynced = 0
+
+			state, seq = newstate, seq+1
+	finally:
+		if fh is not None:
+			fh.close()
+
+# Describe `new` as a list with one entry per element of the state tuple:
+#   ('=',)         the element is unchanged
+#   ('+', items)   the element is a tuple or list that was extended by `items`
+#   ('!', value)   the element was replaced by `value`
+# Returns None if the states don't have the same shape (e.g. `new` is an EndLoop).
+def diff_loop_state(old, new):
+	if not (isinstance(old, tuple) and isinstance(new, tuple) and len(old) == len(new)):
+		return None
+
+	def same(a, b):
+		try: return bool(a == b)
+		except Exception: return False # pylint: disable=broad-except
+
+	out = []
+	for a, b in zip(old, new):
+		if a is b:
+			out.append(('=',))
+		elif type(a) is type(b) and isinstance(a, (tuple, list)) and same(b[:len(a)], a):
+			out.append(('+', b[len(a):]))
+		else:
+			out.append(('!', b))
+	return out
+
+def apply_loop_delta(state, delta):
+	out = []
+	for x, d in zip(state, delta):
+		if   d[0] == '=': out.append(x)
+		elif d[0] == '+': out.append(x + d[1])
+		elif d[0] == '!': out.append(d[1])
+		else: assert False, 'complete switch'
+	return tuple(out)
+
+# Read the state recorded by persistent_loop at `path`.  Either a tuple of arguments for the
+#  next iteration, or an EndLoop.
+def load_loop_state(path):
+	return read_loop_journal(path)[0]
+
+# Read a state file written by either backend.  (a plain pickle is treated as a journal that
+#  consists of a single snapshot)
+# Returns (state, seq, nrecords, end), where `end` is the offset just past the last valid record.
+def read_loop_journal(path):
+	from pickle import load as _load
+	state = seq = None
+	nrecords = end = 0
+	with open(path, 'rb') as f:
+		while True:
+			try:
+				record = _load(f)
+			except Exception: # pylint: disable=broad-except
+				break # EOF, or a record that was only partially written
+
+			if isinstance(record, tuple) and len(record) == 4 and record[0] == JOURNAL_TAG:
+				_, rseq, kind, payload = record
+				if kind == JOURNAL_SNAPSHOT:
+					state = payload
+				elif kind == JOURNAL_DELTA and seq is not None and rseq == seq + 1:
+					state = apply_loop_delta(state, payload)
+				else:
+					break
+				seq = rseq
+			elif nrecords == 0:
+				state, seq = record, 0 # plain pickle
+			else:
+				break
+
+			nrecords += 1
+			end = f.tell()
+
+	if nrecords == 0:
+		raise RuntimeError('{}: no valid loop state'.format(path))
+	return state, seq, nrecords, end
+
+def write_loop_snapshot(path, state, fsync=False):
+	from pickle import dump
+	from os import rename, fsync as _fsync
+	from os.path import dirname
+	tmppath = path + '.tmp'
+	with timed_event('state-save', where=dirname(path) or '.', path=path, kind='snapshot') as ev:
+		with open(tmppath, 'wb') as f:
+			dump(state, f)
+			if fsync:
+				f.flush()
+				_fsync(f.fileno())
+			ev['bytes'] = f.tell()
+		rename(tmppath, path)
+
 # Like a shell pushd/popd pair
 # Use via 'with' syntax, like this:
 #
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# Gathers the trajectory of an md run (which is split across every leaf in md.leaves) into
+#  a single set of flat binary arrays on disk, which analysis code can np.memmap.
+#
+# Layout of the output directory (md.traj by default):
+#
+#    positions.bin   float64 (nframes, natoms, 3)   fractional coordinates
+#    cell.bin        float64 (nframes, 3, 3)        lattice vectors as rows, in angstrom
+#    energies.bin    float64 (nframes, nfields)     OSZICAR fields of the step of each frame
+#                                                   (see 'fields' in the index)
+#    steps.bin       float64 (nsteps, nfields)      OSZICAR fields of every ionic step
+#    index.json      Shapes, species, and a table of leaves.  Each leaf records its stage,
+#                    the range of frames [start, start+count) that it contributed, and the
+#                    range of steps [step-start, step-start+step-count).  Step n of the leaf
+#                    (counting from 1) is row step-start+n-1 of steps.bin.  vasp writes a frame
+#                    every NBLOCK steps ('nblock'), so frames are sparser than steps, and the
+#                    last steps of a leaf may come after its last frame.  (see frame_steps)
+#
+# All arrays are little-endian and C-ordered, so frame k of positions.bin begins at byte
+#  k * natoms * 3 * 8.  Use `open_trajectory` to get memmaps.
+#
+# Collection is incremental; rerunning md-collect only appends leaves that finished since
+#  the last time.  index.json is the source of truth:  data past the frame and step counts it
+#  records (e.g. from an interrupted md-collect) is discarded before appending.
+
+from os.path import join, exists
+
+from vaspmd.md import finished_leaves, iter_xdatcar, read_oszicar_arrays, read_incar_values
+from vaspmd.md import parse_stage_dir_name, mkdir, OSZICAR_FIELDS
+
+DEFAULT_OUTPUT = 'md.traj'
+
+INDEX_FILE     = 'index.json'
+POSITIONS_FILE = 'positions.bin'
+CELL_FILE      = 'cell.bin'
+ENERGIES_FILE  = 'energies.bin'
+STEPS_FILE     = 'steps.bin'
+
+DTYPE = '<f8'
+
+def main():
+	from argparse import ArgumentParser
+	parser = ArgumentParser(description='collect the trajectory of an md run into memmappable arrays')
+	parser.add_argument('MDDIR', nargs='?', default='.')
+	parser.add_argument('-o', '--output', help='output directory (default: MDDIR/{})'.format(DEFAULT_OUTPUT))
+	parser.add_argument('--rebuild', action='store_true', help='discard previously collected frames')
+	args = parser.parse_args()
+
+	output = args.output or join(args.MDDIR, DEFAULT_OUTPUT)
+	nnew = collect(args.MDDIR, output, rebuild=args.rebuild)
+	print('collected {} new leaves into {}'.format(nnew, output))
+
+# Append every finished leaf of the md run in mddir that is not yet in `output`.
+# Returns the number of leaves appended.
+def collect(mddir, output, *, rebuild=False):
+	mkdir(output)
+	index = None if rebuild else read_index(output)
+
+	leaves = finished_leaves(mddir)
+	if index is not None:
+		if 'nsteps' not in index:
+			raise RuntimeError('{}: collected by an older md-collect, without per-step data. Use --rebuild.'.format(output))
+		done = [x['leaf'] for x in index['leaves']]
+		if done != leaves[:len(done)]:
+			raise RuntimeError(
+				'{}: collected leaves are not a prefix of the run\'s leaves. Use --rebuild.'.format(output))
+		leaves = leaves[len(done):]
+
+	truncate_data(output, index)
+
+	nnew = 0
+	for leaf in leaves:
+		index = append_leaf(output, index, mddir=mddir, leaf=leaf)
+		write_index(output, index)
+		nnew += 1
+	return nnew
+
+def append_leaf(output, index, *, mddir, leaf):
+	import numpy as np
+	from warnings import warn
+
+	frames = list(iter_xdatcar(join(mddir, leaf, 'XDATCAR')))
+	if not frames:
+		if index is None:
+			raise RuntimeError('{}: no frames in XDATCAR'.format(leaf))
+		warn('{}: no frames in XDATCAR'.format(leaf))
+
+	if index is None:
+		_, species, counts, _ = frames[0]
+		index = {
+			'natoms': sum(counts),
+			'species': species,
+			'counts': counts,
+			'fields': OSZICAR_FIELDS,
+			'dtype': DTYPE,
+			'nframes': 0,
+			'nsteps': 0,
+			'leaves': [],
+		}
+
+	for _, _, counts, _ in frames:
+		if sum(counts) != index['natoms']:
+			raise RuntimeError('{}: number of atoms changed'.format(leaf))
+
+	nblock = read_nblock(join(mddir, leaf, 'INCAR'))
+	steps = step_energies(join(mddir, leaf, 'OSZICAR'))
+	energies = frame_energies(steps, len(frames), leaf=leaf, nblock=nblock)
+
+	with open(join(output, POSITIONS_FILE), 'ab') as f:
+		for (_, _, _, frac) in frames:
+			f.write(np.ascontiguousarray(frac, dtype=DTYPE).tobytes())
+	with open(join(output, CELL_FILE), 'ab') as f:
+		for (cell, _, _, _) in frames:
+			f.write(np.ascontiguousarray(cell, dtype=DTYPE).tobytes())
+	with open(join(output, ENERGIES_FILE), 'ab') as f:
+		f.write(np.ascontiguousarray(energies, dtype=DTYPE).tobytes())
+	with open(join(output, STEPS_FILE), 'ab') as f:
+		f.write(np.ascontiguousarray(steps, dtype=DTYPE).tobytes())
+
+	num, stage = parse_stage_dir_name(leaf.split('/')[0])
+	index['leaves'].append({
+		'leaf': leaf,
+		'num': num,
+		'stage': stage,
+		'start': index['nframes'],
+		'count': len(frames),
+		'step-start': index['nsteps'],
+		'step-count': len(steps),
+		'nblock': nblock,
+	})
+	index['nframes'] += len(frames)
+	index['nsteps'] += len(steps)
+	return index
+
+# OSZICAR data for every ionic step, as an array (nsteps, nfields) in which row n-1 is step n.
+# Steps missing from the OSZICAR (if any) get NaN.
+def step_energies(oszicar):
+	import numpy as np
+	if not exists(oszicar):
+		return np.zeros((0, len(OSZICAR_FIELDS)))
+
+	data = read_oszicar_arrays(oszicar)
+	nsteps = int(data['step'].max()) if len(data['step']) else 0
+	out = np.full((nsteps, len(OSZICAR_FIELDS)), np.nan)
+	for col, name in enumerate(OSZICAR_FIELDS):
+		out[data['step'] - 1, col] = data[name]
+	return out
+
+# OSZICAR data for each frame of the XDATCAR, from the data of every step (see step_energies).
+# vasp writes a frame after every NBLOCK-th step, so frame k is step (k+1) * NBLOCK.  If NBLOCK
+#  is not known (None), it is taken to be the number of steps per frame, rounded down.
+# Frames with no matching step (e.g. an OSZICAR cut short) get NaN.
+def frame_energies(steps, nframes, *, leaf, nblock=None):
+	import numpy as np
+	from warnings import warn
+
+	out = np.full((nframes, len(OSZICAR_FIELDS)), np.nan)
+	if not len(steps) or not nframes:
+		return out
+
+	stride = nblock or max(1, len(steps) // nframes)
+	n = min(nframes, len(steps) // stride)
+	if n < nframes:
+		warn('{}: only {} OSZICAR steps for {} frames every {} steps'.format(leaf, len(steps), nframes, stride))
+
+	out[:n] = steps[stride-1:stride*n:stride]
+	return out
+
+# NBLOCK of a leaf, or None if its INCAR does not say.  (vasp's default is 1)
+def read_nblock(incar):
+	if not exists(incar):
+		return None
+	return int(read_incar_values(incar).get('NBLOCK', 1))
+
+#-----------------------------------------------------
+
+def read_index(output):
+	from json import load
+	path = join(output, INDEX_FILE)
+	if not exists(path):
+		return None
+	with open(path) as f:
+		return load(f)
+
+def write_index(output, index):
+	from json import dump
+	from os import rename
+	path = join(output, INDEX_FILE)
+	with open(path + '.tmp', 'w') as f:
+		dump(index, f, indent=1)
+	rename(path + '.tmp', path)
+
+# Cut the data files back to the size recorded in the index.
+def truncate_data(output, index):
+	from os import truncate
+	nframes = 0 if index is None else index['nframes']
+	nsteps = 0 if index is None else index['nsteps']
+	natoms = 0 if index is None else index['natoms']
+	sizes = {
+		POSITIONS_FILE: nframes * natoms * 3 * 8,
+		CELL_FILE: nframes * 3 * 3 * 8,
+		ENERGIES_FILE: nframes * len(OSZICAR_FIELDS) * 8,
+		STEPS_FILE: nsteps * len(OSZICAR_FIELDS) * 8,
+	}
+	for fname, size in sizes.items():
+		path = join(output, fname)
+		if exists(path):
+			truncate(path, size)
+
+#-----------------------------------------------------
+# Reading
+
+# Open collected data as read-only memmaps.  Returns (index, positions, cell, energies),
+#  where e.g. positions[k] reads only the data for frame k from disk.
+def open_trajectory(output=DEFAULT_OUTPUT):
+	import numpy as np
+	index = read_index(output)
+	if index is None:
+		raise FileNotFoundError(join(output, INDEX_FILE))
+
+	n = index['nframes']
+	def memmap(fname, shape):
+		if n == 0:
+			return np.zeros(shape, dtype=index['dtype'])
+		return np.memmap(join(output, fname), dtype=index['dtype'], mode='r', shape=shape)
+
+	positions = memmap(POSITIONS_FILE, (n, index['natoms'], 3))
+	cell = memmap(CELL_FILE, (n, 3, 3))
+	energies = memmap(ENERGIES_FILE, (n, len(index['fields'])))
+	return index, positions, cell, energies
+
+# Open the OSZICAR data of every step (steps.bin) as a read-only memmap, (nsteps, nfields).
+def open_steps(output=DEFAULT_OUTPUT):
+	import numpy as np
+	index = read_index(output)
+	if index is None:
+		raise FileNotFoundError(join(output, INDEX_FILE))
+
+	shape = (index['nsteps'], len(index['fields']))
+	if not index['nsteps']:
+		return np.zeros(shape, dtype=index['dtype'])
+	return np.memmap(join(output, STEPS_FILE), dtype=index['dtype'], mode='r', shape=shape)
+
+# The slice of frames contributed by a leaf (e.g. '1-nve/003')
+def leaf_frames(index, leaf):
+	for x in index['leaves']:
+		if x['leaf'] == leaf:
+			return slice(x['start'], x['start'] + x['count'])
+	raise KeyError(leaf)
+
+# The rows of steps.bin for the steps contributed by a leaf.
+def leaf_steps(index, leaf):
+	for x in index['leaves']:
+		if x['leaf'] == leaf:
+			return slice(x['step-start'], x['step-start'] + x['step-count'])
+	raise KeyError(leaf)
+
+# The row of steps.bin for the step of each frame of a leaf. (as in frame_energies)
+def frame_steps(index, leaf):
+	import numpy as np
+	for x in index['leaves']:
+		if x['leaf'] == leaf:
+			stride = x['nblock'] or max(1, x['step-count'] // max(1, x['count']))
+			return x['step-start'] + stride * np.arange(1, x['count'] + 1) - 1
+	raise KeyError(leaf)
+
+if __name__ == '__main__':
+	main()
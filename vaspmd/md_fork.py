@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Creates a new md directory that starts from a leaf of an existing run, rather than from
+#  scratch.  e.g. for ten NVE trajectories from one equilibrated structure:
+#
+#     for i in $(seq 10); do
+#         md-fork equil 1-nose prod-$i --temp 300 --steps 0 0 5000 --npar 4 --blocksize 500 --cycles 1
+#     done
+#
+# The new directory is built by md-init (from the input files in the current directory, and
+#  with the same options), except that:
+#
+#   * POSCAR is the CONTCAR of the leaf (which includes the velocities, if it came from vasp),
+#     and the leaf's WAVECAR (if it still has one) is passed on to the first run.
+#   * md.state says to begin at the stage given by --stage (by default, NVE), in cycle 1.
+#     A linear stage starts from the final temperature of the leaf.  (of its last cont-NNN
+#     segment, if it is a stage that was continued; see final_temp)
+#   * FORK_FILE records where it came from.
+#
+# With --cycles 1, a fork that begins at NVE runs just the one NVE stage.
+
+from os.path import join, exists
+
+from vaspmd import md
+from vaspmd import md_init
+
+# JSON file with the source of a forked run
+FORK_FILE = 'md.fork'
+
+STAGES = [md.STAGE_LINEAR, md.STAGE_NOSE, md.STAGE_NVE]
+
+def main():
+	from argparse import ArgumentParser
+	parser = ArgumentParser(description='start a new md run from a leaf of an existing one')
+	parser.add_argument('MDDIR', help='the existing md directory')
+	parser.add_argument('LEAF', help='a finished leaf of MDDIR, as listed in its md.leaves (e.g. 1-nose, or 1-nve/004)')
+	parser.add_argument('OUTDIR', type=str)
+	parser.add_argument('--stage', choices=STAGES, default=md.STAGE_NVE, help='the stage the new run begins at')
+	md_init.add_run_arguments(parser)
+	args = parser.parse_args()
+
+	leaf = args.LEAF.rstrip('/')
+	if leaf not in md.finished_leaves(args.MDDIR):
+		parser.error('{!r} is not a finished leaf of {}'.format(leaf, args.MDDIR))
+	if not exists(join(args.MDDIR, leaf, 'CONTCAR')):
+		parser.error('{}: missing CONTCAR!'.format(join(args.MDDIR, leaf)))
+
+	_main(
+		mddir  = args.MDDIR,
+		leaf   = leaf,
+		outdir = args.OUTDIR,
+		stage  = args.stage,
+		run_arguments = md_init.run_arguments(args),
+	)
+
+def _main(*, mddir, leaf, outdir, stage, run_arguments):
+	from os.path import abspath
+	from json import dump
+	src = join(mddir, leaf)
+	prevtemp = final_temp(src)
+
+	md_init._main(outdir=outdir, poscar_path=join(src, 'CONTCAR'), **run_arguments)
+
+	if not copy_wavecar(src, join(outdir, 'WAVECAR')):
+		print('md-fork: {} has no WAVECAR (it may have been removed or moved on); '
+			'the first run will start without one'.format(src))
+
+	# As though the previous stage had just finished.  (see do_iter in md._main)
+	md.write_loop_snapshot(join(outdir, 'md.state'), (md.START_NUM, stage, prevtemp, None, ()))
+
+	with open(join(outdir, FORK_FILE), 'w') as f:
+		dump({'mddir': abspath(mddir), 'leaf': leaf, 'stage': stage}, f, indent=1)
+
+# The final temperature of the vasp run that the CONTCAR (and WAVECAR) of a leaf came from.
+# For a stage that was continued in cont-NNN segments (see md.do_segments), that is the last
+#  segment, whose outputs were handed off to the stage directory; the OSZICAR there is only
+#  that of the first segment.
+def final_temp(src):
+	from filecmp import cmp
+	from os.path import normpath
+	path = join(src, md.stage_state_file(md.STAGE_NOSE)) # (the same for a linear stage)
+	state = md.load_loop_state(path) if exists(path) else None
+	if not isinstance(state, md.EndLoop) or state.value[-1] == '.':
+		return md.read_final_temp(join(src, 'OSZICAR'))
+
+	run = normpath(join(src, state.value[-1]))
+	if not exists(join(run, 'OSZICAR')):
+		raise RuntimeError('{}: missing OSZICAR, which has the final temperature of the CONTCAR in {}'.format(run, src))
+	if not exists(join(run, 'CONTCAR')) or not cmp(join(run, 'CONTCAR'), join(src, 'CONTCAR'), shallow=False):
+		raise RuntimeError('{}/CONTCAR is not that of {}, its last segment; '
+			'let md-run finish the stage first'.format(src, run))
+	return md.read_final_temp(join(run, 'OSZICAR'))
+
+# Copy the WAVECAR of a directory, which may have been compressed under the
+#  'wavecar-retention' setting.  Returns False if there is none.
+def copy_wavecar(directory, dest):
+	import gzip
+	from shutil import copyfile, copyfileobj
+	path = join(directory, 'WAVECAR')
+	if exists(path):
+		copyfile(path, dest)
+		return True
+	if exists(path + '.gz'):
+		with gzip.open(path + '.gz', 'rb') as fsrc, open(dest, 'wb') as fdest:
+			copyfileobj(fsrc, fdest, 1 << 20)
+		return True
+	return False
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import argparse
+import shutil
+from glob import glob
+import os
+from vaspmd import md
+
+
+TEMP_REPL = md.TEMP_REPL
+NPAR_REPL = md.NPAR_REPL
+KPAR_REPL = md.KPAR_REPL
+
+# constants for the linter's sake
+STAGE_LINEAR = 'linear'
+STAGE_NOSE   = 'nose'
+STAGE_NVE    = 'nve'
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('OUTDIR', type=str)
+	parser.add_argument('--poscar', required=True, type=str)
+	add_run_arguments(parser)
+
+	args = parser.parse_args()
+
+	_main(outdir=args.OUTDIR, poscar_path=args.poscar, **run_arguments(args))
+
+# Options describing the run (also used by md-fork)
+def add_run_arguments(parser):
+	parser.add_argument('--temp', type=int, help='(required, unless --ladder is given)')
+	parser.add_argument('--ladder', type=int, nargs='+', metavar='TEMP', help='run one cycle at each of these temperatures in turn, each starting from the end of the last (instead of --temp; implies --cycles)')
+	parser.add_argument('--steps', required=True, type=int, nargs=3, metavar=['LIN_STEPS','NOSE_STEPS','NVE_STEPS'])
+	parser.add_argument('--npar', required=True, type=par_value, help="NPAR, or 'auto' to have md-run time short trial runs of each candidate first (see 'tune-npar' in md.conf)")
+	parser.add_argument('--kpar', type=par_value, help="KPAR, for INCARs with a placeholder for it; or 'auto' to tune it along with NPAR")
+	parser.add_argument('--blocksize', required=True, type=int, help='applicable stages are split up into computations of this many steps')
+	parser.add_argument('--no-zero', action='store_true', help="start with an nvt stage rather than scaling up from absolute zero")
+	parser.add_argument('--cycles', type=int, help='stop after this many cycles of (linear, nose, nve) stages. (default: run until killed)')
+	parser.add_argument('--block-sizing', choices=md.BLOCK_SIZINGS, default=md.BLOCK_SIZING_FIXED, help="'adaptive' shrinks NVE blocks to fit in the remaining walltime of the job")
+	parser.add_argument('--nose-early-stop', action='store_true', help='end the nose stage early once the system is found to be equilibrated')
+	parser.add_argument('--handoff', choices=md.HANDOFF_MODES, default=md.HANDOFF_COPY, help="how to pass WAVECAR/CONTCAR between stages and blocks. 'link' and 'move' avoid copying where the filesystem allows")
+
+# give the linter an easier time by tearing args apart into local vars
+def run_arguments(args):
+	if (args.temp is None) == (args.ladder is None):
+		raise SystemExit('exactly one of --temp and --ladder is required')
+	if args.ladder is not None and args.no_zero:
+		raise SystemExit('--ladder cannot be used with --no-zero')
+	return dict(
+		temperature=args.temp if args.ladder is None else args.ladder[0],
+		ladder=args.ladder,
+		linear_steps=args.steps[0],
+		nose_steps=args.steps[1],
+		nve_steps=args.steps[2],
+		blocksize=args.blocksize,
+		npar=args.npar,
+		kpar=args.kpar,
+		no_zero=args.no_zero,
+		handoff=args.handoff,
+		cycles=args.cycles,
+		block_sizing=args.block_sizing,
+		nose_early_stop=args.nose_early_stop,
+	)
+
+# an int, or 'auto'
+def par_value(s):
+	return s if s == md.PAR_AUTO else int(s)
+
+def _main(outdir, temperature, poscar_path, linear_steps, nose_steps, nve_steps, blocksize, npar, kpar, no_zero, handoff, cycles, block_sizing, nose_early_stop, ladder):
+	os.mkdir(outdir)
+	def out(fname):
+		return os.path.join(outdir, fname)
+
+	# same-name copies
+	for fname in ['INCAR.linear', 'INCAR.nose', 'INCAR.nve', 'POTCAR', 'KPOINTS']:
+		shutil.copyfile(fname, out(fname))
+	# renamed copies
+	shutil.copyfile(poscar_path,     out('POSCAR'))
+	shutil.copyfile('INCAR.general', out('INCAR.part'))
+
+	# write variables into INCARs
+	# (in ladder mode, md-run substitutes the temperature of each rung, and it also
+	#  substitutes whatever is 'auto' once it has been tuned)
+	for fname in glob(outdir + '/INCAR*'):
+		if ladder is None:
+			file_subst(fname, TEMP_REPL,  temperature)
+		if npar != md.PAR_AUTO:
+			file_subst(fname, NPAR_REPL,  npar)
+		if kpar not in (None, md.PAR_AUTO):
+			file_subst(fname, KPAR_REPL,  kpar)
+
+	md.write_conf(mddir=outdir,
+		temperature=temperature,
+		from_zero=not no_zero,
+		blocksize=blocksize,
+		linear_steps=linear_steps,
+		nose_steps=nose_steps,
+		nve_steps=nve_steps,
+		handoff=handoff,
+		cycles=cycles,
+		block_sizing=block_sizing,
+		nose_early_stop=nose_early_stop,
+		ladder=ladder,
+		npar=npar,
+		kpar=kpar,
+	)
+
+# sed s/old/new/g (inplace)
+def file_subst(path, old, new):
+	new = str(new)
+
+	with open(path) as f:
+		s = f.read()
+
+	s = s.replace(old, new)
+	with open(path, 'w') as f:
+		f.write(s)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Runs many md directories (as made by md-init) inside a single allocation.
+#
+# Each directory gets its own md-run process, started in that directory, so all of the usual
+#  files (md.state, md.leaves, ...) remain the only record of progress.  An md-pack job that is
+#  killed can simply be resubmitted; directories that already finished (up to the number of
+#  `cycles` in their md.conf) are skipped, and the rest resume where they left off.
+#
+# At most  budget // per-run  directories run at a time.  Whenever one finishes, the next
+#  directory in the queue is started in its place.
+#
+# The budget is divided into  budget // per-run  disjoint slices of --per-run slots each:
+#  slots [first, last] = [k * per-run, (k+1) * per-run - 1] for slice k.  Each running directory
+#  holds one slice, which passes to the next directory when it finishes, so no two runs are ever
+#  given the same slots.  Each run is told its slice through the environment:
+#
+#    VASPMD_SLOTS       the value of --per-run
+#    VASPMD_FIRST_SLOT  the first slot of its slice
+#    VASPMD_VASP_CMD    the --launcher template with '{slots}', '{first}' and '{last}' filled in
+#                       (if --launcher is given); this takes priority over 'vasp-cmd' in md.conf.
+#
+# It is up to the launcher to keep each run within its slice.  Either place it explicitly, e.g.
+#
+#     md-pack --budget 64 --per-run 16 --launcher 'mpirun -np {slots} --cpu-set {first}-{last} vasp_std' run-*
+#
+#  or leave the placement to slurm, which only keeps concurrent job steps apart with --exclusive:
+#
+#     md-pack --budget 64 --per-run 16 --launcher 'srun --exclusive -n {slots} vasp_std' run-*
+#
+#  (a plain `srun -n {slots}` would start every run on the same cores)
+
+from os.path import join, exists
+
+from vaspmd.md import load_loop_state, EndLoop, ENV_VASP_CMD, STOP_SIGNALS
+
+ENV_SLOTS = 'VASPMD_SLOTS'
+ENV_FIRST_SLOT = 'VASPMD_FIRST_SLOT'
+
+LOG_FILE = 'md-pack.log'
+
+# Seconds between checks on the running children
+POLL_INTERVAL = 5
+
+def main():
+	from argparse import ArgumentParser
+	parser = ArgumentParser(description='run many md directories concurrently within one allocation',
+		epilog="Each run gets its own slice of --per-run slots, numbered from 0, which the launcher must keep it to: "
+			"either with '{first}' and '{last}' (e.g. in a cpu set), or with 'srun --exclusive'.")
+	parser.add_argument('MDDIR', nargs='+')
+	parser.add_argument('--budget', type=int, required=True, help='total number of cores (or nodes, or whatever --per-run counts)')
+	parser.add_argument('--per-run', type=int, required=True, help='cores given to each directory')
+	parser.add_argument('--launcher', help="command to run vasp, where '{slots}' is replaced by --per-run, and '{first}' "
+		"and '{last}' by the first and last slot of the run's slice. (default: each run's own vasp-cmd)")
+	args = parser.parse_args()
+
+	for d in args.MDDIR:
+		if not exists(join(d, 'md.conf')):
+			parser.error('{}: missing md.conf!'.format(d))
+	if not 0 < args.per_run <= args.budget:
+		parser.error('--per-run must be between 1 and --budget')
+	if args.launcher is not None:
+		try: launcher_cmd(args.launcher, slots=args.per_run, share=0)
+		except (KeyError, IndexError, ValueError) as e:
+			parser.error('--launcher: bad template: {!r}'.format(e))
+
+	failed = _main(
+		mddirs   = args.MDDIR,
+		nparallel = args.budget // args.per_run,
+		slots    = args.per_run,
+		launcher = args.launcher,
+	)
+	if failed:
+		raise SystemExit('md-pack: {} run(s) failed: {}'.format(len(failed), ' '.join(failed)))
+
+def _main(*, mddirs, nparallel, slots, launcher):
+	import signal
+	from time import sleep
+
+	queue = [d for d in mddirs if not is_finished(d)]
+	for d in mddirs:
+		if d not in queue:
+			print('md-pack: {}: already finished'.format(d), flush=True)
+
+	free = list(range(nparallel)) # slices of the budget not held by a run
+	shares = {} # mddir -> its slice
+	running = {} # mddir -> Popen
+	failed = []
+
+	# Pass termination signals along to every run, then wait for them to exit.
+	# md-run stops vasp gracefully on STOP_SIGNALS, so those go to md-run alone.
+	#  Anything else also goes to the vasp processes, to stop them immediately.
+	def forward(signum, frame):
+		queue.clear()
+		for p in running.values():
+			if signum in STOP_SIGNALS:
+				p.send_signal(signum)
+			else:
+				send_signal_to_group(p, signum)
+	for signum in STOP_SIGNALS + [signal.SIGINT]:
+		signal.signal(signum, forward)
+
+	while queue or running:
+		while queue and free:
+			d = queue.pop(0)
+			share = shares[d] = free.pop(0)
+			env = {ENV_SLOTS: str(slots), ENV_FIRST_SLOT: str(share * slots)}
+			if launcher is not None:
+				env[ENV_VASP_CMD] = launcher_cmd(launcher, slots=slots, share=share)
+			print('md-pack: {}: starting on slots {}-{}'.format(d, share * slots, (share + 1) * slots - 1), flush=True)
+			running[d] = start_run(d, env=env)
+
+		sleep(POLL_INTERVAL)
+
+		for d, p in list(running.items()):
+			code = p.poll()
+			if code is None:
+				continue
+			del running[d]
+			free.append(shares.pop(d))
+			free.sort()
+			if code == 0:
+				print('md-pack: {}: exited'.format(d), flush=True)
+			else:
+				print('md-pack: {}: failed with exit code {} (see {})'.format(d, code, join(d, LOG_FILE)), flush=True)
+				failed.append(d)
+	return failed
+
+# The vasp command for the run holding slice `share` of the budget.
+def launcher_cmd(launcher, *, slots, share):
+	return launcher.format(slots=slots, first=share * slots, last=(share + 1) * slots - 1)
+
+# Start md-run in a directory, in its own process group.
+def start_run(mddir, *, env):
+	import sys
+	from os import environ
+	from subprocess import Popen, STDOUT
+
+	with open(join(mddir, LOG_FILE), 'a') as log:
+		# (not `-m vaspmd.md`, which would pickle EndLoop as __main__.EndLoop)
+		return Popen(
+			[sys.executable, '-c', 'from vaspmd.md import main; main()'],
+			cwd=mddir, stdout=log, stderr=STDOUT,
+			env=dict(environ, **env),
+			start_new_session=True,
+		)
+
+def send_signal_to_group(p, signum):
+	from os import killpg
+	try:
+		killpg(p.pid, signum)
+	except ProcessLookupError:
+		pass
+
+# Has md-run already reached the end of its loop in this directory?
+def is_finished(mddir):
+	path = join(mddir, 'md.state')
+	return exists(path) and isinstance(load_loop_state(path), EndLoop)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Summarizes the event log written by md-run (md.events.jsonl) or vasp-search (search.events.jsonl),
+#  to show where the time went: vasp itself, file copies, state saves, directory setup, or
+#  other subprocesses.
+#
+# Events are grouped by stage (the first component of their directory, e.g. '1-nve') and by
+#  block (the first two components, e.g. '1-nve/003').  Events in the top directory (the md.state
+#  saves, sbatch, ...) are listed under '.'.
+
+from os.path import join, isdir, exists
+
+from vaspmd.md import VARFILE_MD_EVENTS
+from vaspmd.search import VARFILE_EVENTS as VARFILE_SEARCH_EVENTS
+
+# Columns of the tables, in order.  Any other kind of event is counted under 'other'.
+EVENT_KINDS = ['vasp', 'copy', 'sync', 'state-save', 'setup', 'subprocess', 'compress', 'hook', 'analysis', 'tune']
+
+def main():
+	from argparse import ArgumentParser
+	parser = ArgumentParser(description='summarize where an md run (or search) spent its time')
+	parser.add_argument('PATH', nargs='?', default='.', help='an md or search directory, or an event log')
+	parser.add_argument('--no-blocks', action='store_true', help='only show the totals per stage')
+	parser.add_argument('--failed', action='store_true', help='also list each event that failed')
+	args = parser.parse_args()
+
+	events = read_events(event_log_path(args.PATH))
+	if not events:
+		raise SystemExit('{}: the event log is empty'.format(args.PATH))
+
+	print_table('stage', summarize(events, key=lambda ev: path_prefix(ev['where'], 1)))
+	if not args.no_blocks:
+		print()
+		print_table('block', summarize(events, key=lambda ev: path_prefix(ev['where'], 2)))
+	if args.failed:
+		print()
+		for ev in events:
+			if not ev.get('ok', True):
+				print('failed: {} in {} after {:.1f}s ({}{})'.format(ev['event'], ev['where'], ev.get('wall', 0),
+					ev.get('error', '?'), '' if ev.get('exit') is None else ', exit {}'.format(ev['exit'])))
+
+def event_log_path(path):
+	if not isdir(path):
+		return path
+	for fname in [VARFILE_MD_EVENTS, VARFILE_SEARCH_EVENTS]:
+		if exists(join(path, fname)):
+			return join(path, fname)
+	raise SystemExit('{}: no event log found'.format(path))
+
+# (a line cut short by an interrupted run is skipped)
+def read_events(path):
+	from json import loads
+	out = []
+	with open(path) as f:
+		for line in f:
+			try: out.append(loads(line))
+			except ValueError: pass
+	return out
+
+def path_prefix(where, n):
+	parts = [x for x in where.split('/') if x not in ('', '.')]
+	return '/'.join(parts[:n]) or '.'
+
+# Returns an ordered list of (group, totals), where totals maps each column to
+#  (count, wall, bytes).
+def summarize(events, *, key):
+	from collections import OrderedDict
+	groups = OrderedDict()
+	for ev in events:
+		column = ev['event'] if ev['event'] in EVENT_KINDS else 'other'
+		totals = groups.setdefault(key(ev), {})
+		count, wall, nbytes = totals.get(column, (0, 0.0, 0))
+		totals[column] = (count + 1, wall + ev.get('wall', 0.0), nbytes + (ev.get('bytes') or 0))
+	return list(groups.items())
+
+def print_table(title, rows):
+	columns = [c for c in EVENT_KINDS + ['other'] if any(c in totals for (_, totals) in rows)]
+	width = max([len(title)] + [len(group) for (group, _) in rows])
+
+	print('  '.join(['{:{}}'.format(title, width), '{:>9}'.format('total')] + ['{:>18}'.format(c) for c in columns]))
+	for group, totals in rows:
+		cells = []
+		for c in columns:
+			count, wall, nbytes = totals.get(c, (0, 0.0, 0))
+			cells.append('{:>18}'.format(format_cell(count, wall, nbytes) if count else '-'))
+		total = sum(wall for (_, wall, _) in totals.values())
+		print('  '.join(['{:{}}'.format(group, width), '{:>9}'.format(format_seconds(total))] + cells))
+
+# e.g. "12x 3.1s 1.2G"
+def format_cell(count, wall, nbytes):
+	s = '{}x {}'.format(count, format_seconds(wall))
+	if nbytes:
+		s += ' ' + format_bytes(nbytes)
+	return s
+
+def format_seconds(x):
+	if x < 100:
+		return '{:.2f}s'.format(x)
+	if x < 6000:
+		return '{:.1f}m'.format(x / 60)
+	return '{:.1f}h'.format(x / 3600)
+
+def format_bytes(n):
+	for unit in ['B', 'K', 'M', 'G']:
+		if n < 1024:
+			return '{:.0f}{}'.format(n, unit) if unit == 'B' else '{:.1f}{}'.format(n, unit)
+		n /= 1024
+	return '{:.1f}T'.format(n)
+
+if __name__ == '__main__':
+	main()
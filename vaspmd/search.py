@@ -11,13 +11,20 @@
 #   * config reading done directly in main
 #     (this COULD be done via a Config class with properties, but it'd be pointless because
 #      I still wouldn't want to pass around a config *object*; see the next point)
-#   * everything in one module (pylint's argument checker can't cross module boundaries)
+#   * everything in one module (pylint's argument checker can't cross module boundaries),
+#     except for the plumbing shared with md-run (event log, file utils, persistent_loop)
 #   * long argument lists (to allow linting against unused arguments)
 #
 # I am not proud.
 
 from os.path import join, exists, isdir, relpath
 
+# Shared with md-run:  the event log (written here from the worker threads of do_subsearch),
+#  file utils, persistent_loop and pushd.
+from vaspmd.md import open_event_log, timed_event, stripped_lines, write_json, extend_lines
+from vaspmd.md import symlink, mkdir, touch, pushd
+from vaspmd.md import EndLoop, persistent_loop, load_loop_state, STATE_BACKEND_PICKLE, STATE_BACKENDS
+
 # This script is componentized to interface with 3 other scripts:
 #
 # cmd-init:
@@ -39,6 +46,10 @@ from os.path import join, exists, isdir, relpath
 #    A command to run a calculation in the current directory (which was constructed by cmd-init),
 #    and produce output files of some form.
 #
+#    When 'max-parallel' is greater than 1, up to that many trials are initialized and run at
+#    once, so cmd-init and cmd-run must not assume they have the search directory to themselves.
+#    (on a multi-node allocation, cmd-run will generally want something like 'srun -N1 --exclusive')
+#
 # cmd-next:
 #    Reviews output from a collection of trials and determines the next range to search.
 #    It is invoked in the parent directory of the individual trial dirs, as
@@ -48,6 +59,60 @@ from os.path import join, exists, isdir, relpath
 #    And is expected to write two floating point values (freely formatted) to stdout
 #    in the form MINVAL MAXVAL .
 #
+#    If 'converged-exit-code' is set and cmd-next exits with that code, the search ends, with
+#    the range that it wrote as the final range.
+#
+# next-function:
+#    An alternative to cmd-next that runs inside vasp-search, written as "module:function".
+#    The module is imported with the search directory at the front of sys.path.  It is called as
+#
+#        function(trials)
+#
+#    in the same directory as cmd-next, where `trials` is a list of Trial objects (see class Trial)
+#    for the current depth.  Their parsed output (OSZICAR energies and the final structure) is
+#    read only when first used, and cached in search.parsed, so that no file is parsed twice over
+#    the whole search.  It must return (MINVAL, MAXVAL), or (MINVAL, MAXVAL, CONVERGED) where
+#    CONVERGED is a bool with the same effect as 'converged-exit-code'.
+#
+# cmd-value:
+#    (required for the 'golden' and 'brent' strategies; optional for 'grid')  Reports the value of the function to be
+#    minimized for a single trial.  It is invoked in the parent directory of the trial dir, as
+#
+#        cmd-value  TRIALNAME
+#
+#    and is expected to write a single floating point value to stdout.
+#
+# Search strategies (the 'strategy' option):
+#
+# grid:  (the default)  Each depth runs 'npoints' trials evenly spaced over [MINVAL, MAXVAL]
+#    (in set-001, set-002, ...), after which cmd-next chooses the range for the next depth.
+#
+#    The search ends once any of the following stop criteria are met.  (each is optional;
+#    without any of them, the search continues until it is killed)
+#
+#      stop-width       MAXVAL - MINVAL is at most this.
+#      stop-rel-width   MAXVAL - MINVAL is at most this fraction of (start-max - start-min).
+#                       (so start-max and start-min must differ)
+#      max-depth        This many depths have been run.
+#      max-trials       At least this many trials have been run in total.
+#
+# golden, brent:  Minimizes the value reported by cmd-value over [start-min, start-max], placing
+#    one trial at a time by golden-section steps ('golden') or parabolic interpolation with
+#    golden-section steps as a fallback ('brent').  Each step brackets the minimum using every
+#    trial evaluated so far.  The search ends once the bracket is narrower than 'tolerance'
+#    (or after 'max-evals' trials).  Trials are found in bracket/001, bracket/002, ...
+#    This assumes that the function is unimodal on the initial range.
+#
+# When a search ends, a summary is written to search.result (JSON), containing the final range
+#  and the best trial.  For 'grid', the best trial is the one with the lowest cmd-value if
+#  cmd-value is given, and otherwise the one nearest to the middle of the final range.
+#
+# Trial cache (the 'cache' option):
+#    When enabled, every completed trial is recorded in search.cache, keyed on cmd-init, cmd-run,
+#    the contents of 'files', and its parameter value.  A later trial with the same key and a
+#    value within 'cache-tolerance' of a recorded one is not run; instead, its directory is made
+#    a symlink to the recorded trial.  (it still appears in search.leaves)
+#
 # In all cases, the command string will be tokenized according to shell syntax, so a setting such
 #  as ``cmd-init = "./init.sh 'hello world' -v"`` is perfectly acceptable (assuming ./init.sh takes
 #  3 positional arguments)
@@ -58,11 +123,43 @@ CONF_NPOINTS   = 'npoints'
 CONF_CMD_RUN   = 'cmd-run'
 CONF_CMD_INIT  = 'cmd-init'
 CONF_CMD_NEXT  = 'cmd-next'
+CONF_NEXT_FUNCTION = 'next-function'
+CONF_CMD_VALUE = 'cmd-value'
+CONF_STRATEGY  = 'strategy'
+CONF_TOLERANCE = 'tolerance'
+CONF_MAX_EVALS = 'max-evals'
+CONF_CACHE     = 'cache'
+CONF_CACHE_TOL = 'cache-tolerance'
 CONF_FILES     = 'files'
+CONF_MAX_PARALLEL = 'max-parallel'
+CONF_STATE_BACKEND = 'state-backend'
+CONF_STATE_FSYNC   = 'state-fsync-every'
+CONF_STATE_COMPACT = 'state-compact-every'
+CONF_STOP_WIDTH     = 'stop-width'
+CONF_STOP_REL_WIDTH = 'stop-rel-width'
+CONF_MAX_DEPTH      = 'max-depth'
+CONF_MAX_TRIALS     = 'max-trials'
+CONF_CONVERGED_CODE = 'converged-exit-code'
 
 START_NUM = 1
 
 VARFILE_ALLDIRS = 'search.leaves'
+VARFILE_CACHE   = 'search.cache'
+VARFILE_RESULT  = 'search.result'
+VARFILE_PARSED  = 'search.parsed'
+VARFILE_EVENTS  = 'search.events.jsonl'
+# The strategy that search.state belongs to (see check_strategy)
+VARFILE_STRATEGY = 'search.strategy'
+
+STRATEGY_GRID   = 'grid'
+STRATEGY_GOLDEN = 'golden'
+STRATEGY_BRENT  = 'brent'
+STRATEGIES = [STRATEGY_GRID, STRATEGY_GOLDEN, STRATEGY_BRENT]
+
+BRACKET_DIR = 'bracket'
+
+# 2 - golden ratio; the fraction of an interval taken by a golden-section step
+GOLDEN_STEP = 0.3819660112501051
 
 def main():
 	from argparse import ArgumentParser
@@ -79,19 +176,93 @@ def main():
 	_main(
 		start_min = conf.pop(CONF_START_MIN),
 		start_max = conf.pop(CONF_START_MAX),
-		npoints   = conf.pop(CONF_NPOINTS),
+		npoints   = conf.pop(CONF_NPOINTS, None),
 		cmd_init  = conf.pop(CONF_CMD_INIT),
-		cmd_next  = conf.pop(CONF_CMD_NEXT),
+		cmd_next  = conf.pop(CONF_CMD_NEXT, None),
+		next_function = conf.pop(CONF_NEXT_FUNCTION, None),
 		cmd_run   = conf.pop(CONF_CMD_RUN),
+		cmd_value = conf.pop(CONF_CMD_VALUE, None),
 		files     = conf.pop(CONF_FILES),
+		strategy  = conf.pop(CONF_STRATEGY, STRATEGY_GRID),
+		tolerance = conf.pop(CONF_TOLERANCE, None),
+		max_evals = conf.pop(CONF_MAX_EVALS, 50),
+		cache     = conf.pop(CONF_CACHE, False),
+		cache_tolerance = conf.pop(CONF_CACHE_TOL, 1e-10),
+		max_parallel = conf.pop(CONF_MAX_PARALLEL, 1),
+		state_backend = conf.pop(CONF_STATE_BACKEND, STATE_BACKEND_PICKLE),
+		state_fsync_every = conf.pop(CONF_STATE_FSYNC, 1),
+		state_compact_every = conf.pop(CONF_STATE_COMPACT, 100),
+		stop_width     = conf.pop(CONF_STOP_WIDTH, None),
+		stop_rel_width = conf.pop(CONF_STOP_REL_WIDTH, None),
+		max_depth      = conf.pop(CONF_MAX_DEPTH, None),
+		max_trials     = conf.pop(CONF_MAX_TRIALS, None),
+		converged_code = conf.pop(CONF_CONVERGED_CODE, None),
 		unknown   = conf,
 	)
 
-def _main(*, start_min, start_max, npoints, cmd_init, cmd_next, cmd_run, files, unknown):
+def _main(*, start_min, start_max, npoints, cmd_init, cmd_next, next_function, cmd_run, cmd_value, files,
+		strategy, tolerance, max_evals, cache, cache_tolerance, max_parallel,
+		state_backend, state_fsync_every, state_compact_every,
+		stop_width, stop_rel_width, max_depth, max_trials, converged_code, unknown):
+	from os.path import abspath
+	from functools import partial
 	from warnings import warn
 	for arg in unknown:
 		warn('Unknown key in config: {!r}'.format(arg))
 
+	if state_backend not in STATE_BACKENDS:
+		raise ValueError('{!r} must be one of {!r}, not {!r}'.format(CONF_STATE_BACKEND, STATE_BACKENDS, state_backend))
+
+	loop = partial(persistent_loop, backend=state_backend,
+		fsync_every=state_fsync_every, compact_every=state_compact_every)
+
+	open_event_log(VARFILE_EVENTS)
+
+	if cache:
+		key = trial_cache_key(cmd_init=cmd_init, cmd_run=cmd_run, files=files)
+		cache_lookup = partial(lookup_cached_trial, abspath(VARFILE_CACHE), key=key, tolerance=cache_tolerance)
+		cache_record = partial(record_cached_trial, abspath(VARFILE_CACHE), key=key)
+	else:
+		cache_lookup = lambda value: None
+		cache_record = lambda value, trialdir: None
+
+	def require(key, value):
+		if value is None:
+			raise ValueError('strategy {!r} requires {!r}'.format(strategy, key))
+
+	if strategy not in STRATEGIES:
+		raise ValueError('{!r} must be one of {!r}, not {!r}'.format(CONF_STRATEGY, STRATEGIES, strategy))
+	check_strategy(strategy)
+
+	if strategy != STRATEGY_GRID:
+		require(CONF_CMD_VALUE, cmd_value)
+		require(CONF_TOLERANCE, tolerance)
+		x, fx, name = do_bracket_search(cmd_run, minval=start_min, maxval=start_max,
+			cmd_init=cmd_init, cmd_value=cmd_value, files=files,
+			method=strategy, tolerance=tolerance, max_evals=max_evals, loop=loop,
+			cache_lookup=cache_lookup, cache_record=cache_record)
+		write_json(VARFILE_RESULT, {
+			'strategy': strategy,
+			'best': {'trial': name, 'x': x, 'value': fx},
+			'trials': len(stripped_lines(VARFILE_ALLDIRS)),
+		})
+		print('minimum: {} = {} ({})'.format(x, fx, name))
+		return
+
+	require(CONF_NPOINTS, npoints)
+	# (it is relative to the width of the starting range)
+	if stop_rel_width is not None and start_max == start_min:
+		raise ValueError('{!r} cannot be used when {!r} equals {!r}'.format(
+			CONF_STOP_REL_WIDTH, CONF_START_MIN, CONF_START_MAX))
+	parsed_cache = None
+	if next_function is None:
+		require(CONF_CMD_NEXT, cmd_next)
+	else:
+		if cmd_next is not None:
+			raise ValueError('{!r} and {!r} cannot both be given'.format(CONF_CMD_NEXT, CONF_NEXT_FUNCTION))
+		next_function = load_next_function(next_function)
+		parsed_cache = ParsedCache(abspath(VARFILE_PARSED))
+
 	def dirname(depth):
 		return 'set-{:03d}'.format(depth)
 
@@ -105,29 +276,120 @@ def _main(*, start_min, start_max, npoints, cmd_init, cmd_next, cmd_run, files,
 	#            vasprun.xml and OSZICAR files
 	def do_iter(depth=1, minval=start_min, maxval=start_max, curdir=dirname(1), leaves=()):
 
-		mkdir(curdir)
-		with pushd(curdir):
-			for name in files:
-				symlink(join('..', name), name)
+		make_search_dir(curdir, files)
 
 		with pushd(curdir):
 			newleaves = do_subsearch(cmd_run, minval=minval, maxval=maxval, npoints=npoints,
-				cmd_init=cmd_init)
+				cmd_init=cmd_init, max_parallel=max_parallel, loop=loop,
+				cache_lookup=cache_lookup, cache_record=cache_record)
 
-			newmin,newmax = invoke_cmd_next(cmd_next, newleaves)
+			if next_function is None:
+				newmin,newmax,converged = invoke_cmd_next(cmd_next, newleaves, converged_code=converged_code)
+			else:
+				newmin,newmax,converged = invoke_next_function(next_function, newleaves,
+					minval=minval, maxval=maxval, parsed_cache=parsed_cache)
 
-			# we ultimately want these saved as paths relative to the md root dir
-			newleaves = tuple([relpath(x, '..') for x in newleaves])
+		# we ultimately want these saved as paths relative to the md root dir
+		names, newleaves = newleaves, tuple([join(curdir, x) for x in newleaves])
 
+		extend_lines(VARFILE_ALLDIRS, known=leaves, new=newleaves)
 		leaves += tuple(newleaves)
-		write_lines(leaves, VARFILE_ALLDIRS)
+
+		reason = grid_stop_reason(newmin, newmax, depth=depth, ntrials=len(leaves), converged=converged,
+			stop_width=stop_width, stop_rel_width=stop_rel_width, start_width=start_max - start_min,
+			max_depth=max_depth, max_trials=max_trials)
+		if reason is not None:
+			with pushd(curdir):
+				best = best_grid_trial(names, minval=minval, maxval=maxval,
+					target=0.5 * (newmin + newmax), cmd_value=cmd_value)
+			best['trial'] = join(curdir, best['trial'])
+			return EndLoop({
+				'strategy': strategy,
+				'reason': reason,
+				'minval': newmin,
+				'maxval': newmax,
+				'depth': depth,
+				'trials': len(leaves),
+				'best': best,
+			})
 
 		return (depth+1, newmin, newmax, dirname(depth+1), leaves)
 
-	persistent_loop(do_iter, path='search.state')
+	result = loop(do_iter, path='search.state')
+	write_json(VARFILE_RESULT, result)
+	print('finished ({}): range [{}, {}], best trial {}'.format(
+		result['reason'], result['minval'], result['maxval'], result['best']['trial']))
+
+# The grid and bracketing strategies keep different state in search.state, so a directory
+#  can only ever be used for one strategy.  It is recorded in VARFILE_STRATEGY on the first run,
+#  and every later run must use the same one.
+def check_strategy(strategy):
+	recorded = recorded_strategy()
+	if recorded is None:
+		with open(VARFILE_STRATEGY, 'w') as f:
+			f.write(strategy + '\n')
+	elif recorded != strategy and not (recorded == BRACKET_DIR and strategy != STRATEGY_GRID):
+		raise ValueError('this directory holds a search with {!r} = {!r}, not {!r}; '
+			'start a new search in another directory'.format(CONF_STRATEGY, recorded, strategy))
+
+# The strategy of the search already begun in this directory, or None.
+# (for directories from before VARFILE_STRATEGY, it is inferred from search.state, where
+#  the two bracketing strategies cannot be told apart, and are both BRACKET_DIR)
+def recorded_strategy():
+	if exists(VARFILE_STRATEGY):
+		return stripped_lines(VARFILE_STRATEGY)[0]
+	if not exists('search.state'):
+		return None
+
+	state = load_loop_state('search.state')
+	if isinstance(state, EndLoop):
+		state = state.value
+	if state == ():
+		return None
+	if isinstance(state, dict):
+		return state['strategy']
+	return STRATEGY_GRID if len(state) == 5 else BRACKET_DIR
+
+# Why a grid search should end after this depth, or None to continue.
+def grid_stop_reason(newmin, newmax, *, depth, ntrials, converged, stop_width, stop_rel_width, start_width,
+		max_depth, max_trials):
+	width = abs(newmax - newmin)
+	if converged:
+		return 'the range was reported as converged'
+	if stop_width is not None and width <= stop_width:
+		return 'range width {} <= {}'.format(width, stop_width)
+	if stop_rel_width is not None and width <= stop_rel_width * abs(start_width):
+		return 'relative range width {} <= {}'.format(width / abs(start_width), stop_rel_width)
+	if max_depth is not None and depth >= max_depth:
+		return 'reached max depth {}'.format(max_depth)
+	if max_trials is not None and ntrials >= max_trials:
+		return 'ran {} trials (max {})'.format(ntrials, max_trials)
+	return None
+
+# The best trial of a depth of a grid search, as a dict with 'trial', 'x', and (if cmd_value
+#  is given) 'value'.
+def best_grid_trial(names, *, minval, maxval, target, cmd_value):
+	from numpy import linspace # noqa
+	xs = list(map(float, linspace(minval, maxval, len(names))))
+	if cmd_value is not None:
+		values = [invoke_cmd_value(cmd_value, name) for name in names]
+		i = min(range(len(names)), key=lambda i: values[i])
+		return {'trial': names[i], 'x': xs[i], 'value': values[i]}
+	i = min(range(len(names)), key=lambda i: abs(xs[i] - target))
+	return {'trial': names[i], 'x': xs[i]}
+
+def make_search_dir(name, files):
+	with timed_event('setup', where=name):
+		mkdir(name)
+		with pushd(name):
+			for fname in files:
+				symlink(join('..', fname), fname)
 
-def do_subsearch(cmd_run, *, minval, maxval, npoints, cmd_init):
+# cache_lookup(value) -> path or None     Find a cached trial. (see lookup_cached_trial)
+# cache_record(value, trialdir)           Add a completed trial to the cache.
+def do_subsearch(cmd_run, *, minval, maxval, npoints, cmd_init, max_parallel, loop, cache_lookup, cache_record):
 	from numpy import linspace # noqa
+	from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, CancelledError
 
 	# These values are only used if this is our first time running the stage.
 	# When resuming an interrupted run, we use the names/sizes originally chosen for that run.
@@ -135,35 +397,422 @@ def do_subsearch(cmd_run, *, minval, maxval, npoints, cmd_init):
 	values_if_new = list(map(float, linspace(minval, maxval, npoints)))
 	assert len(names_if_new) == len(values_if_new)
 
-	def do_iter(i=0, values=values_if_new, names=names_if_new): # pylint: disable=dangerous-default-value
+	# Runs in a worker thread, so it must not touch the working directory (no pushd!)
+	def run_trial(name, value):
+		# [Re]generate trial directory
+		invoke_cmd_init(cmd_init, name, value)
+		invoke_cmd_run(cmd_run, cwd=name)
+
+	# Bookkeeping for trials in flight.  This is deliberately NOT part of the state tuple;
+	#  after an interruption, nothing is running anymore.
+	running = {}   # trial index -> future
+	failures = []
+
+	# state tuple contents:
+	#   i:       Number of leading trials known to be complete.
+	#   values:  Parameter value for each trial.
+	#   names:   Directory name for each trial.
+	#   done:    Indices >= i of other trials known to be complete.
+	#             (when running in parallel, trials may finish out of order)
+	#
+	# Each iteration waits for at least one trial to finish, so that every completed trial is
+	#  recorded as soon as possible, and resuming an interrupted depth only reruns unfinished trials.
+	def do_iter(i=0, values=values_if_new, names=names_if_new, done=()): # pylint: disable=dangerous-default-value
 		if i == len(values):
 			# let code after the loop know the names that were actually used,
 			# since they may differ from `names_if_new`
 			return EndLoop(names)
 
-		name, value = names[i], values[i]
+		if failures and not running:
+			raise failures[0]
+
+		done = set(done)
+		if not failures:
+			for k in range(i, len(values)):
+				if k in done or k in running:
+					continue
+				if use_cached_trial(names[k], values[k], cache_lookup):
+					done.add(k)
+					continue
+				running[k] = executor.submit(run_trial, names[k], values[k])
+
+		finished = set()
+		if running:
+			finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+
+		for k, future in list(running.items()):
+			if future not in finished:
+				continue
+			del running[k]
+
+			try: future.result()
+			except CancelledError: continue
+			except Exception as e: # pylint: disable=broad-except
+				# Stop launching trials, but let the ones already running finish
+				#  (and get recorded) before reraising.
+				failures.append(e)
+				for other in running.values():
+					other.cancel()
+				continue
+
+			cache_record(values[k], names[k])
+			done.add(k)
+
+		while i in done:
+			done.remove(i)
+			i += 1
+
+		return i, values, names, tuple(sorted(done))
+
+	with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+		true_names = loop(do_iter, path='subsearch.state')
+	return true_names
 
-		# [Re]generate trial directory
-		invoke_cmd_init(cmd_init, name, value)
+# Adaptive minimization of the value reported by cmd-value (strategies 'golden' and 'brent').
+# Returns (x, value, trialname) for the best trial.
+def do_bracket_search(cmd_run, *, minval, maxval, cmd_init, cmd_value, files, method, tolerance, max_evals, loop,
+		cache_lookup, cache_record):
+	curdir = BRACKET_DIR
+	make_search_dir(curdir, files)
 
-		with pushd(name):
-			invoke_cmd_run(cmd_run)
+	# state tuple contents:
+	#   xs:     Parameter values of all trials so far, in the order they were run.
+	#   values: Result of cmd-value for each trial.
+	#   names:  Trial directory names (inside curdir).
+	#
+	# The next point is a function of only these, so an interrupted trial is simply redone.
+	def do_iter(xs=(), values=(), names=()):
+		x = next_bracket_point(xs, values, lo=minval, hi=maxval, method=method,
+			tolerance=tolerance, max_evals=max_evals)
+		if x is None:
+			best = min(range(len(xs)), key=lambda i: values[i])
+			return EndLoop((xs[best], values[best], join(curdir, names[best])))
+
+		name = '{:03d}'.format(len(xs) + 1)
+		with pushd(curdir):
+			if not use_cached_trial(name, x, cache_lookup):
+				invoke_cmd_init(cmd_init, name, x)
+				invoke_cmd_run(cmd_run, cwd=name)
+				cache_record(x, name)
+			value = invoke_cmd_value(cmd_value, name)
 
-		return i+1, values, names
+		extend_lines(VARFILE_ALLDIRS, known=[join(curdir, s) for s in names], new=[join(curdir, name)])
+		return xs + (x,), values + (value,), names + (name,)
 
-	true_names = persistent_loop(do_iter, path='subsearch.state')
-	return true_names
+	return loop(do_iter, path='search.state')
+
+# Choose where to evaluate next in order to minimize a function on [lo, hi], given all
+#  of the points evaluated so far.  Returns None once converged (the bracket is no wider
+#  than `tolerance`), or after `max_evals` points.
+#
+# The minimum is bracketed by the best point and its nearest neighbors on either side.
+# ('golden')  The next point is a golden-section step into the larger side of the bracket,
+#             or its midpoint if that step would land too close to an existing point.
+# ('brent')   The next point is the minimum of a parabola through the bracket, if that lies
+#             safely inside it; otherwise a golden-section step is taken.
+def next_bracket_point(xs, values, *, lo, hi, method, tolerance, max_evals):
+	# Initial points:  both endpoints, then a golden-section point.
+	for x in [lo, hi, lo + GOLDEN_STEP * (hi - lo)]:
+		if x not in xs:
+			return x
+
+	if len(xs) >= max_evals:
+		return None
+
+	xa, xb, xc = bracket_minimum(xs, values)
+	if xc - xa <= tolerance:
+		return None
+
+	def too_close(u):
+		return min(abs(u - x) for x in xs) < tolerance / 4
+
+	# the larger side of the bracket
+	far = xa if xb - xa > xc - xb else xc
+
+	# Like Brent's method, only trust the parabola while the bracket is shrinking quickly
+	#  enough; i.e. to at most half of its width from two trials ago.
+	if method == STRATEGY_BRENT and xa < xb < xc:
+		old_xa, _, old_xc = bracket_minimum(xs[:-2], values[:-2])
+		if xc - xa <= 0.5 * (old_xc - old_xa):
+			f = dict(zip(xs, values))
+			fa, fb, fc = f[xa], f[xb], f[xc]
+
+			# vertex of the parabola through the three points
+			p = (xb - xa)**2 * (fb - fc) - (xb - xc)**2 * (fb - fa)
+			q = (xb - xa) * (fb - fc) - (xb - xc) * (fb - fa)
+			if q != 0:
+				u = xb - 0.5 * p / q
+				if too_close(u):
+					# a minimal step, to test whether the bracket can be tightened around xb
+					u = xb + 0.5 * tolerance * (1 if far > xb else -1)
+				if xa < u < xc and not too_close(u):
+					return u
+
+	u = xb + GOLDEN_STEP * (far - xb)
+	if too_close(u):
+		# The larger side is then narrower than about 0.65 * tolerance, but (as the bracket is
+		#  still wider than tolerance) at least tolerance / 2, so its midpoint is always far
+		#  enough from both xb and `far`.
+		u = 0.5 * (xb + far)
+	return u
+
+# Returns (xa, xb, xc), where xb is the best point and xa, xc are its nearest neighbors.
+# (xa or xc may equal xb if it lies at the edge of the points)
+def bracket_minimum(xs, values):
+	points = sorted(zip(xs, values))
+	b = min(range(len(points)), key=lambda i: points[i][1])
+	return points[max(b-1, 0)][0], points[b][0], points[min(b+1, len(points)-1)][0]
 
 #-----------------------------------------------------
+# Trial cache
+#
+# VARFILE_CACHE has one JSON object per line:
+#
+#     {"key": {...}, "value": 0.25, "dir": "set-001/002"}
+#
+# where "dir" is relative to the directory containing VARFILE_CACHE.
+
+def trial_cache_key(*, cmd_init, cmd_run, files):
+	return {
+		CONF_CMD_INIT: cmd_init,
+		CONF_CMD_RUN: cmd_run,
+		CONF_FILES: hash_files(files),
+	}
+
+# Find the recorded trial with a matching key whose value is closest to `value`, within
+#  `tolerance`.  Returns its absolute path, or None.
+def lookup_cached_trial(path, value, *, key, tolerance):
+	from json import loads
+	from os.path import dirname
+	if not exists(path):
+		return None
+
+	best = None
+	with open(path) as f:
+		for line in f:
+			try: record = loads(line)
+			except ValueError: continue # partially written
+			if record['key'] != key:
+				continue
+			diff = abs(record['value'] - value)
+			if diff <= tolerance and (best is None or diff < best[0]):
+				best = (diff, record['dir'])
+
+	if best is None:
+		return None
+	trialdir = join(dirname(path), best[1])
+	return trialdir if isdir(trialdir) else None
+
+# A trial that was recorded just before the search was killed (but not yet marked complete in
+#  the loop state) is run again on resume, and must not be recorded twice.
+def record_cached_trial(path, value, trialdir, *, key):
+	from json import dumps, loads
+	from os.path import abspath, dirname, islink
+	if islink(trialdir):
+		return # already cached under its real name
+	record = {'key': key, 'value': value, 'dir': relpath(abspath(trialdir), dirname(path))}
+	if exists(path):
+		with open(path) as f:
+			for line in f:
+				try: old = loads(line)
+				except ValueError: continue # partially written
+				if old['dir'] == record['dir'] and old['key'] == key:
+					return
+	with open(path, 'a') as f:
+		f.write(dumps(record, sort_keys=True) + '\n')
+
+# If a trial dir for `value` can be (or already has been) linked from the cache, returns True.
+def use_cached_trial(name, value, cache_lookup):
+	from os.path import islink, lexists
+	if islink(name):
+		return True # linked by an earlier, interrupted attempt
+	if lexists(name):
+		return False # a real trial was already started here; let it finish
+
+	hit = cache_lookup(value)
+	if hit is None:
+		return False
+	print('{}: reusing cached trial {}'.format(name, hit))
+	symlink(relpath(hit, '.'), name)
+	return True
+
+# Hash of the contents of files and directories (following symlinks)
+def hash_files(paths):
+	from hashlib import sha256
+	from os import walk
+	h = sha256()
+
+	def add_file(name, path):
+		h.update(name.encode() + b'\0')
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1<<20), b''):
+				h.update(chunk)
+
+	for path in sorted(paths):
+		if isdir(path):
+			for root, dirs, fnames in walk(path, followlinks=True):
+				dirs.sort()
+				for fname in sorted(fnames):
+					add_file(relpath(join(root, fname)), join(root, fname))
+		else:
+			add_file(path, path)
+	return h.hexdigest()
 
-def invoke_cmd_next(cmd_next, dirnames):
+#-----------------------------------------------------
+# Parsed trial output (for next-function)
+
+# A trial directory, as seen by next-function.
+#
+#   trial.name       Directory (relative to the current directory)
+#   trial.value      Parameter value
+#   trial.oszicar    Ionic steps from OSZICAR, as a dict of numpy arrays with a key for each
+#                    field ('step', 'F', 'E0', ...)  (see parse_oszicar)
+#   trial.energy     The final free energy F (or None if there are no ionic steps)
+#   trial.structure  The final structure from CONTCAR, as a dict (see parse_poscar)
+#
+# Outputs are parsed on first access, and looked up in the ParsedCache before that.
+class Trial:
+	def __init__(self, name, value, parsed_cache):
+		self.name = name
+		self.value = value
+		self._cache = parsed_cache
+
+	def __repr__(self):
+		return 'Trial({!r}, {!r})'.format(self.name, self.value)
+
+	@property
+	def oszicar(self):
+		return self._cache.get(join(self.name, 'OSZICAR'), parse_oszicar)
+
+	@property
+	def energy(self):
+		F = self.oszicar.get('F', ())
+		return float(F[-1]) if len(F) else None
+
+	@property
+	def structure(self):
+		return self._cache.get(join(self.name, 'CONTCAR'), parse_poscar)
+
+# Results of parsing files, kept in a pickle file so that they survive across depths
+#  (and restarts).  An entry is reused only while the file's size and mtime are unchanged.
+# Entries are keyed on real paths, so trials linked from the trial cache share them.
+class ParsedCache:
+	def __init__(self, path):
+		from pickle import load
+		self.path = path
+		self.entries = {}  # realpath -> (parser name, (mtime_ns, size), data)
+		self.dirty = False
+		if exists(path):
+			try:
+				with open(path, 'rb') as f:
+					self.entries = load(f)
+			except Exception: # pylint: disable=broad-except
+				pass # (it's only a cache)
+
+	def get(self, path, parser):
+		from os import stat
+		from os.path import realpath
+		key = realpath(path)
+		st = stat(key)
+		stamp = (st.st_mtime_ns, st.st_size)
+
+		entry = self.entries.get(key)
+		if entry is not None and entry[:2] == (parser.__name__, stamp):
+			return entry[2]
+
+		data = parser(key)
+		self.entries[key] = (parser.__name__, stamp, data)
+		self.dirty = True
+		return data
+
+	def save(self):
+		from os import rename
+		from pickle import dump
+		if not self.dirty:
+			return
+		with open(self.path + '.tmp', 'wb') as f:
+			dump(self.entries, f)
+		rename(self.path + '.tmp', self.path)
+		self.dirty = False
+
+# Read the ionic steps of an OSZICAR from any kind of run (relaxation, MD, ...).
+# Lines of the form
+#
+#      3 F= -.12345678E+03 E0= -.12345678E+03  d E =-.123456E-02  mag=     2.0000
+#
+# are parsed into a dict of numpy arrays, with 'step' and one key for each KEY= field, with
+#  spaces removed (e.g. 'dE').  Fields missing from some steps are NaN there.
+# (vaspmd.md.read_oszicar_arrays is not used here, because it reads only the fixed fields of MD
+#  steps, and skips any step without a 'T=', such as every step of a relaxation)
+def parse_oszicar(path):
+	import re
+	import numpy as np
+	step_re = re.compile(r'^\s*(\d+)\s+[A-Za-z]')
+	field_re = re.compile(r'([A-Za-z][A-Za-z0-9 ]*?)\s*=\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[EeDd][-+]?\d+)?)')
+
+	rows = []
+	with open(path) as f:
+		for line in f:
+			if not step_re.match(line):
+				continue
+			row = {'step': float(line.split()[0])}
+			for key, value in field_re.findall(line):
+				row[key.replace(' ', '')] = float(value.replace('D', 'E').replace('d', 'e'))
+			rows.append(row)
+
+	keys = []
+	for row in rows:
+		keys += [k for k in row if k not in keys]
+	return {k: np.array([row.get(k, np.nan) for row in rows]) for k in keys}
+
+# Read a POSCAR/CONTCAR into a dict with 'cell' (3x3 array of lattice vectors as rows, in
+#  angstrom), 'species' (list of str, or None), 'counts' (list of int), and 'frac' (fractional
+#  coordinates, shape (natoms, 3)).
+def parse_poscar(path):
+	import numpy as np
+	with open(path) as f:
+		lines = f.read().splitlines()
+
+	scale = float(lines[1].split()[0])
+	cell = np.array([[float(x) for x in line.split()[:3]] for line in lines[2:5]])
+	if scale < 0: # a volume
+		scale = (-scale / abs(np.linalg.det(cell))) ** (1/3)
+	cell *= scale
+
+	i = 5
+	species = None
+	if not lines[i].split()[0].lstrip('-').isdigit():
+		species = lines[i].split()
+		i += 1
+	counts = [int(x) for x in lines[i].split()]
+	i += 1
+	if lines[i].strip()[:1] in 'sS': # selective dynamics
+		i += 1
+	cartesian = lines[i].strip()[:1] in 'cCkK'
+	i += 1
+
+	natoms = sum(counts)
+	coords = np.array([[float(x) for x in line.split()[:3]] for line in lines[i:i+natoms]])
+	if cartesian:
+		coords = np.linalg.solve(cell.T, scale * coords.T).T
+	return {'cell': cell, 'species': species, 'counts': counts, 'frac': coords}
+
+#-----------------------------------------------------
+
+# Returns (minval, maxval, converged), where `converged` is whether cmd_next exited
+#  with `converged_code`.
+def invoke_cmd_next(cmd_next, dirnames, *, converged_code=None):
 	assert isinstance(cmd_next, str)
 	assert not isinstance(dirnames, str)
 	from shlex import split
 	from subprocess import Popen, PIPE
 	args = split(cmd_next)
 	args.extend(dirnames)
-	(out, _) = Popen(args, stdout=PIPE).communicate()
+	with timed_event('subprocess', where='.', cmd='cmd-next') as ev:
+		p = Popen(args, stdout=PIPE)
+		(out, _) = p.communicate()
+		ev['exit'] = p.returncode
+	converged = converged_code is not None and p.returncode == converged_code
 
 	words = out.split()
 	floats = list(map(float, words))
@@ -174,7 +823,55 @@ def invoke_cmd_next(cmd_next, dirnames):
 			f.write(out)
 		raise RuntimeError('cmd_next did not produce two floats! Output of cmd_next logged to bad_next.out')
 
-	return minval,maxval
+	return minval,maxval,converged
+
+# Import "module:function" (for next-function), with the current directory on sys.path.
+def load_next_function(spec):
+	import sys
+	from importlib import import_module
+	from os import getcwd
+	modname, _, funcname = spec.partition(':')
+	if not modname or not funcname:
+		raise ValueError('{!r} must look like "module:function", not {!r}'.format(CONF_NEXT_FUNCTION, spec))
+	sys.path.insert(0, getcwd())
+	return getattr(import_module(modname), funcname)
+
+# In-process counterpart to invoke_cmd_next.
+def invoke_next_function(function, dirnames, *, minval, maxval, parsed_cache):
+	from numpy import linspace # noqa
+	xs = list(map(float, linspace(minval, maxval, len(dirnames))))
+	trials = [Trial(name, x, parsed_cache) for (name, x) in zip(dirnames, xs)]
+	try:
+		with timed_event('next-function', where='.'):
+			out = function(trials)
+	finally:
+		parsed_cache.save()
+
+	try: minval,maxval,*rest = out
+	except (TypeError, ValueError):
+		raise RuntimeError('next-function returned {!r}, not (min, max) or (min, max, converged)'.format(out))
+	if len(rest) > 1:
+		raise RuntimeError('next-function returned {!r}, not (min, max) or (min, max, converged)'.format(out))
+	converged = bool(rest[0]) if rest else False
+	return float(minval),float(maxval),converged
+
+def invoke_cmd_value(cmd_value, dirname):
+	assert isinstance(cmd_value, str)
+	assert isinstance(dirname, str)
+	from shlex import split
+	from subprocess import check_output
+	args = split(cmd_value)
+	args.append(dirname)
+	with timed_event('subprocess', where=dirname, cmd='cmd-value'):
+		out = check_output(args)
+
+	try: value, = map(float, out.split())
+	except ValueError:
+		with open('bad_value.out', 'wb') as f:
+			f.write(out)
+		raise RuntimeError('cmd_value did not produce a float! Output of cmd_value logged to bad_value.out')
+
+	return value
 
 def invoke_cmd_init(cmd_init, dirname, value):
 	assert isinstance(cmd_init, str)
@@ -184,160 +881,14 @@ def invoke_cmd_init(cmd_init, dirname, value):
 	args = split(cmd_init)
 	args.append(dirname)
 	args.append(str(value))
-	check_call(args)
+	with timed_event('subprocess', where=dirname, cmd='cmd-init'):
+		check_call(args)
 
-def invoke_cmd_run(cmd_run):
+def invoke_cmd_run(cmd_run, cwd=None):
 	assert isinstance(cmd_run, str)
 	from subprocess import check_call
-	check_call(cmd_run, shell=True)
-
-#------------------------------------------------
-# file utils
-
-# Get the stripped, non-empty lines from a file,
-#  as a list of strings
-def stripped_lines(path):
-	with open(path, 'rt') as f:
-		lines = [s.strip() for s in f]
-		lines = [s for s in lines if s]
-		return lines
-
-def write_lines(lines, path):
-	with open(path, 'wt') as f:
-		f.writelines('%s\n' % x for x in lines)
-
-# like ln -sf
-def symlink(src, dest):
-	from os import symlink as _symlink, unlink
-	if exists(dest):
-		unlink(dest)
-	_symlink(src, dest)
-
-# like mkdir -p
-def mkdir(path):
-	from os import mkdir as _mkdir
-	if exists(path) and isdir(path):
-		return # nothing to do
-	_mkdir(path)
-
-# like cp -T
-def copy_file(src, dest):
-	from shutil import copyfile
-	copyfile(src, dest)
-
-# like cp -fT
-def copy_if_exists(src, dest):
-	if exists(src):
-		copy_file(src, dest)
-
-# touch. might not update timestamps
-def touch(path):
-	with open(path, 'a'):
-		pass
-
-#----------------------------------------------------
-# Some very un-Pythonic syntax hacks in an attempt to make the code
-#  easier to read and verify
-
-class EndLoop():
-	def __init__(self, value):
-		self.value = value
-
-# Make a sort of iterator that records its current state in a file.
-#
-#  f(*args) -> nextargs  A function performed each iteration, which either returns:
-#                         a) A tuple containing the next values for the arguments
-#                         b) EndLoop(result), or
-#                         c) EndLoop (equivalent to EndLoop(None))
-#                        Arguments must be pickleable.
-#  path                  Where to save the state.
-#
-# Use like this:
-#
-#     # `sum(i for i in range(10))`  written as a persistent loop
-#     def do_iter(acc=0, i=0, n=10):
-#         if i >= n:
-#             return EndLoop(acc)
-#         return acc+i, i+1, n
-#
-#     s = persistent_loop(do_iter, 'numbers')
-#
-# The function must anticipate the following contingencies:
-#   * That any number of iterations at the beginning may be skipped
-#     (because they already ran in a previous run of the program)
-#   * That the state of the environment at the beginning of any given iteration may
-#     reflect changes from a previously interrupted run of the same iteration
-#
-# One must be cautious when allowing the function to close over variables.
-# While it may seem odd to keep passing `n` around in the above snippet, consider the following:
-#
-#     n = 10
-#     def do_iter(acc=0, i=0):
-#         if i >= n:
-#             return EndLoop(acc)
-#         return acc+i, i+1
-#
-#     s = persistent_loop(do_iter, 'numbers')
-#
-# These snippets will have different behavior if one were to interrupt a computation and then
-#  modify the value of `n`; upon resuming, the first snippet would continue to use 'n=10' (because
-#  it is part of the recorded state), while the second snippet would use the new value (because it
-#  gathers the value from outside the function).
-#
-# On that note, please think VERY CAREFULLY before putting a 'nonlocal' declaration in the
-#  function.  Chances are it will be much easier to avoid a logic error by simply keeping the
-#  variable in the state tuple instead, and returning it as part of the end result.
-#
-# This is partly the reason why `persistent_loop` has such an unusual API, rather than behaving
-#  more like an iterator.  In truth, several iterator-like designs were tried out prior to this
-#  design, but each were found to encourage making a variety of logic errors with regards to
-#  modification of local variables not preserved in the state tuple.
-def persistent_loop(f, path, initialstate=()):
-	def load():
-		from pickle import load as _load
-		with open(path, 'rb') as f:
-			return _load(f)
-
-	def save(st):
-		from pickle import dump
-		from os import rename
-		tmppath = path + '.tmp'
-		with open(tmppath, 'wb') as f:
-			dump(st, f)
-		rename(tmppath, path)
-
-	if not exists(path):
-		save(initialstate)
-
-	while True:
-		state = load()
-
-		if isinstance(state, EndLoop):
-			return state.value
-
-		state = f(*state)
-		# Support returning just EndLoop (without instantiation)
-		if state is EndLoop:
-			state = EndLoop(None)
-
-		save(state)
-
-# Like a shell pushd/popd pair
-# Use via 'with' syntax, like this:
-#
-#     with pushd('some_dir'):
-#         ... # do things inside the directory
-from os import getcwd,chdir
-class pushd:
-	def __init__(self, path):
-		self.path = path
-		self.prev = getcwd()
-	def __enter__(self):
-		chdir(self.path)
-		print('entered: {}'.format(getcwd()))
-	def __exit__(self, exc_type, exc_val, traceback):
-		chdir(self.prev)
-		print('exited to: {}'.format(getcwd()))
+	with timed_event('vasp', where=cwd or '.', cmd='cmd-run'):
+		check_call(cmd_run, shell=True, cwd=cwd)
 
 if __name__ == '__main__':
 	main()
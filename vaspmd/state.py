@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Prints the state recorded by persistent_loop in md.state, nve.state, segments.state,
+#  search.state and subsearch.state files (from either state backend), so that nobody has to unpickle them by hand.
+#
+# Given a directory, prints md.state or search.state, and follows it into the state file of
+#  the stage or depth currently in progress.
+
+from os.path import join, exists, isdir, basename
+
+from vaspmd.md import read_loop_journal, stage_dir_name, stage_state_file, START_NUM, STAGE_LINEAR
+
+# Names of the elements of each kind of state tuple, for each layout that the file may have.
+# (keep these in sync with the `do_iter` functions in md.py and search.py)
+STATE_FIELDS = {
+	'md.state':        [['num', 'stage', 'prevtemp', 'prevdir', 'leaves']],
+	'nve.state':       [
+		['i', 'sizes', 'names', 'prev'],
+		['i', 'sizes', 'names', 'prev', 'secs'],
+	],
+	'search.state':    [
+		['depth', 'minval', 'maxval', 'curdir', 'leaves'], # grid
+		['xs', 'values', 'names'],                         # golden/brent
+	],
+	'segments.state':  [['i', 'sizes', 'names', 'prev']],
+	'subsearch.state': [['i', 'values', 'names', 'done']],
+}
+
+# Sequences longer than this are abbreviated
+MAX_ITEMS = 6
+
+def main():
+	from argparse import ArgumentParser
+	parser = ArgumentParser(description='print the state of md-run or vasp-search loops')
+	parser.add_argument('PATH', nargs='*', default=['.'], help='state files, or md/search directories')
+	parser.add_argument('--full', action='store_true', help='do not abbreviate long sequences')
+	args = parser.parse_args()
+
+	for path in args.PATH:
+		for statefile in state_files(path):
+			print_state(statefile, full=args.full)
+
+# The state files to show for a path.
+def state_files(path):
+	if not isdir(path):
+		return [path]
+
+	out = []
+	if exists(join(path, 'md.state')):
+		out.append(join(path, 'md.state'))
+		state = read_loop_journal(out[-1])[0]
+		if isinstance(state, tuple):
+			num, stage = state[:2] if state else (START_NUM, STAGE_LINEAR)
+			sub = join(path, stage_dir_name(num=num, stage=stage), stage_state_file(stage))
+			if exists(sub):
+				out.append(sub)
+
+	if exists(join(path, 'search.state')):
+		out.append(join(path, 'search.state'))
+		state = read_loop_journal(out[-1])[0]
+		if isinstance(state, tuple) and len(state) == 5:
+			sub = join(path, state[3], 'subsearch.state')
+			if exists(sub):
+				out.append(sub)
+
+	if not out:
+		raise SystemExit('{}: no state files found'.format(path))
+	return out
+
+def print_state(path, *, full):
+	state, _, nrecords, _ = read_loop_journal(path)
+
+	print('{}:  ({} record{} on disk)'.format(path, nrecords, '' if nrecords == 1 else 's'))
+	if type(state).__name__ == 'EndLoop':
+		print('  finished, with result:')
+		print('    {}'.format(abbreviate(state.value, full=full)))
+		return
+
+	if state == ():
+		print('  (not started)')
+		return
+
+	names = field_names(basename(path), len(state))
+	width = max([len(x) for x in names] + [1])
+	for name, value in zip(names, state):
+		print('  {:{}} = {}'.format(name, width, abbreviate(value, full=full)))
+
+def field_names(fname, n):
+	layouts = STATE_FIELDS.get(fname, [])
+	for names in layouts:
+		if len(names) == n:
+			return names
+	# an older layout with fewer fields, or something unknown
+	names = max(layouts, key=len) if layouts else []
+	return (names + ['?'] * n)[:n]
+
+def abbreviate(value, *, full):
+	if full or not isinstance(value, (tuple, list)) or len(value) <= MAX_ITEMS:
+		return repr(value)
+	tail = ', '.join(repr(x) for x in value[-(MAX_ITEMS // 2):])
+	return '({} items) ..., {}'.format(len(value), tail)
+
+if __name__ == '__main__':
+	main()